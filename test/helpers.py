@@ -0,0 +1,27 @@
+"""
+Networks shared by the tests of rendering, rotation and the daemon.
+"""
+import base64
+from configparser import ConfigParser
+
+HUBS = 10
+
+
+def make_network(n: int, hubs: int = HUBS) -> ConfigParser:
+    """
+    `hubs` servers peering with every device, and clients peering with the servers
+    """
+    parser = ConfigParser()
+    hub_names = ", ".join(f"hub-{i}" for i in range(hubs))
+    sections = {}
+    for i in range(n):
+        key = base64.b64encode(i.to_bytes(32, "big")).decode("ascii")
+        name = f"hub-{i}" if i < hubs else f"pc-{i}"
+        section = {"private key": key, "public key": key[::-1], "address": f"10.{i >> 16}.{i >> 8 & 255}.{i & 255}/32"}
+        if i < hubs:
+            section["endpoint"] = f"hub-{i}.example.com:51820"
+        else:
+            section["peers"] = hub_names
+        sections[name] = section
+    parser.read_dict(sections)
+    return parser
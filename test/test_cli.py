@@ -0,0 +1,101 @@
+"""
+Test the command line interface, and that its startup doesn't import heavy modules.
+"""
+from wg_config_manager.command_line_interface import main
+
+import os
+import sys
+import time
+import subprocess
+from pathlib import Path
+from configparser import ConfigParser
+from tempfile import TemporaryDirectory
+from unittest import main as unittest_main, TestCase
+
+ROOT = Path(__file__).parent.parent
+# modules that must not be imported by `--help`
+HEAVY_MODULES = {"tkinter", "json", "asyncio", "subprocess", "typing", "logging", "configparser",
+                 "wg_config_manager.logger", "wg_config_manager.load_plugin", "wg_config_manager.profiling",
+                 "wg_config_manager.storage", "wg_config_manager.wireguard_core",
+                 "wg_config_manager.graphic_interface"}
+STARTUP_BUDGET = 0.08  # seconds of `--help` over a bare interpreter
+
+WG_QUICK = """[Interface]
+PrivateKey = bGFwdG9wLXByaXZhdGU=
+Address = 10.0.0.2/32
+
+[Peer]
+# server
+PublicKey = c2VydmVyLWtleQ==
+AllowedIPs = 10.0.0.0/24
+Endpoint = wg.example.com:51820
+PersistentKeepalive = 25
+"""
+
+
+def run(*args: str) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, *args], cwd=ROOT, capture_output=True, text=True,
+                          env=dict(os.environ, PYTHONPATH=str(ROOT)))
+
+
+class TestStartup(TestCase):
+    def test_importtime(self):
+        r = run("-X", "importtime", "-m", "wg_config_manager", "--help")
+        self.assertEqual(r.returncode, 0, r.stderr)
+        self.assertIn("render", r.stdout)
+        imported = {}
+        for line in r.stderr.splitlines():
+            if line.startswith("import time:") and "|" in line:
+                _, cumulative, name = line.split("|")
+                if cumulative.strip().isdigit():
+                    imported[name.strip()] = int(cumulative)
+        heavy = {name for name in imported if name.split(".")[0] in HEAVY_MODULES or name in HEAVY_MODULES}
+        self.assertSetEqual(heavy, set())
+        self.assertIn("wg_config_manager.command_line_interface", imported)
+
+    def test_help_time(self):
+        def best(*args):
+            times = []
+            for _ in range(5):
+                start = time.perf_counter()
+                run(*args)
+                times.append(time.perf_counter() - start)
+            return min(times)
+
+        bare = best("-c", "pass")
+        cli = best("-m", "wg_config_manager", "--help")
+        self.assertLess(cli - bare, STARTUP_BUDGET)
+
+
+class TestCommands(TestCase):
+    def test_import_and_render(self):
+        with TemporaryDirectory() as directory:
+            network = f"{directory}/network.ini"
+            conf = Path(directory, "laptop.conf")
+            conf.write_text(WG_QUICK, encoding="utf-8")
+            self.assertEqual(main(["import", network, str(conf)]), 0)
+            parser = ConfigParser()
+            parser.read(network, encoding="utf-8")
+            self.assertListEqual(parser.sections(), ["laptop", "server"])
+            parser.read_dict({"server": {"private key": "c2VydmVyLXByaXZhdGU=", "address": "10.0.0.1/24"},
+                              "laptop": {"public key": "bGFwdG9wLWtleQ=="}})
+            with open(network, "w", encoding="utf-8") as fp:
+                parser.write(fp)
+            self.assertEqual(main(["render", network, "server", "-o", f"{directory}/server.conf"]), 0)
+            rendered = Path(directory, "server.conf").read_text(encoding="utf-8")
+            self.assertIn("PrivateKey = c2VydmVyLXByaXZhdGU=", rendered)
+            self.assertIn("[Peer]\n# laptop\n", rendered)
+            self.assertIn("AllowedIPs = 10.0.0.2/32", rendered)
+
+            self.assertEqual(main(["render", network, "laptop", "-o", f"{directory}/laptop.conf"]), 0)
+            rendered = Path(directory, "laptop.conf").read_text(encoding="utf-8")
+            self.assertIn("PublicKey = c2VydmVyLWtleQ==", rendered)
+            self.assertIn("PersistentKeepalive = 25", rendered)
+
+            r = run("-m", "wg_config_manager", "render", network, "nothing")
+            self.assertEqual(r.returncode, 1)
+            self.assertEqual(r.stderr.count("nothing"), 1)
+
+
+if __name__ == "__main__":
+    unittest_main()
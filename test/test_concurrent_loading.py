@@ -0,0 +1,80 @@
+"""
+Test loading plugins on a thread pool.
+"""
+from wg_config_manager import load_plugin as lp
+
+import sys
+import json
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from configparser import ConfigParser
+from unittest import main, TestCase
+
+SLOW_PLUGIN = '''
+import time
+time.sleep(0.2)  # simulate a heavy import
+VERSION_REQ = ">=0.0.1-alpha"
+BACKGROUND_SERVICE_slow = {}
+'''
+BROKEN_PLUGIN = '''
+VERSION_REQ = ""
+raise ImportError("missing dependency")
+'''
+NO_VERSION_PLUGIN = '''
+ENCRYPT_TYPE_NONE = {}
+'''
+TOO_NEW_PLUGIN = '''
+VERSION_REQ = ">=99.0.0"
+'''
+
+
+class TestConcurrentLoading(TestCase):
+    def setUp(self):
+        self._tmp = TemporaryDirectory()
+        self.directory = Path(self._tmp.name) / "concurrent_plugins"
+        self.directory.mkdir()
+        sources = {f"slow_{i}": SLOW_PLUGIN for i in range(4)}
+        sources.update(broken=BROKEN_PLUGIN, no_version=NO_VERSION_PLUGIN, too_new=TOO_NEW_PLUGIN)
+        for name, source in sources.items():
+            with open(self.directory / f"{name}.py", "w", encoding="utf-8") as fp:
+                fp.write(source)
+        self.parser = ConfigParser()
+        self.parser["Extension"] = {"plugins": ", ".join(f'"{n}"' for n in sources)}
+        for name in sources:
+            self.parser["Extension"][f"plugin_dir-{name}"] = str(self.directory)
+
+    def test_failures_do_not_block(self):
+        """
+        failed plugins are reported and skipped, the others are loaded
+        """
+        plugins, report = lp.load_plugins_concurrently(self.parser, max_workers=8)
+        self.assertListEqual(sorted(plugins), [f"slow_{i}" for i in range(4)])
+        self.assertListEqual(sorted(i.name for i in report.failures), ["broken", "no_version", "too_new"])
+        self.assertEqual(plugins["slow_0"].get_service_names(), ["slow"])
+        self.assertNotIn(f"{self.directory.name}.broken", sys.modules)
+        self.assertIn("broken", report.format_table())
+        # structured report
+        data = json.loads(json.dumps(report.as_dict()))
+        self.assertEqual(len(data["timings"]), 7)
+        self.assertSetEqual(set(data["timings"][0]), {"name", "import_time", "scan_time", "error"})
+
+    def test_concurrent_is_faster(self):
+        """
+        the slow imports run at the same time
+        """
+        start = time.perf_counter()
+        _, report = lp.load_plugins_concurrently(self.parser, max_workers=8)
+        elapsed = time.perf_counter() - start
+        serial = sum(i.import_time for i in report.timings)
+        self.assertLess(elapsed, 0.2 * 4)
+        self.assertLess(elapsed, serial)
+
+    def tearDown(self):
+        for key in [k for k in sys.modules if k.startswith(f"{self.directory.name}.")]:
+            del sys.modules[key]
+        self._tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Test the control daemon, its protocol and the latency against cold command line runs.
+"""
+from wg_config_manager.daemon import ControlDaemon, DaemonClient, send_message, recv_message
+from wg_config_manager.errors import DaemonError
+from wg_config_manager.wireguard_core import get_config_for
+
+import os
+import sys
+import time
+import socket
+import threading
+import subprocess
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from configparser import ConfigParser
+from unittest import main, skipUnless, TestCase
+
+from helpers import make_network
+
+ROOT = Path(__file__).parent.parent
+
+
+@skipUnless(hasattr(socket, "AF_UNIX"), "unix sockets")
+class TestDaemon(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.network_path = Path(self.directory.name, "network.ini")
+        self.network = make_network(50, hubs=5)
+        self.write_network()
+        self.daemon = ControlDaemon(ConfigParser(), Path(self.directory.name, "daemon.sock"))
+        self.daemon.bind()
+        self.thread = threading.Thread(target=self.daemon.serve_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.daemon.shutdown()
+        self.thread.join(10)
+        self.assertFalse(os.path.exists(self.daemon.socket_path))
+        self.directory.cleanup()
+
+    def write_network(self):
+        with open(self.network_path, "w", encoding="utf-8") as fp:
+            self.network.write(fp)
+
+    def test_requests(self):
+        self.assertEqual(os.stat(self.daemon.socket_path).st_mode & 0o777, 0o600)
+        with DaemonClient(self.daemon.socket_path) as client:
+            self.assertEqual(client.request("ping"), "pong")
+            self.assertEqual(client.render(self.network_path, "pc-12"), get_config_for("pc-12", self.network))
+            # parsed again after the file changes
+            self.network.set("hub-1", "endpoint", "moved.example.com:51820")
+            self.write_network()
+            self.assertIn("Endpoint = moved.example.com:51820", client.render(self.network_path, "pc-12"))
+            with self.assertRaisesRegex(DaemonError, "pc-99"):
+                client.render(self.network_path, "pc-99")
+            with self.assertRaisesRegex(DaemonError, "unknown command"):
+                client.request("nothing")
+            # the connection is still usable after errors
+            stats = client.stats()
+        self.assertEqual(stats["requests"]["render"], 3)
+        self.assertEqual(stats["errors"], {"render": 1, "nothing": 1})
+        self.assertListEqual(stats["networks"], [str(self.network_path)])
+        with self.assertRaises(DaemonError):
+            ControlDaemon(ConfigParser(), self.daemon.socket_path).bind()
+
+    def test_invalid_message(self):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.daemon.socket_path)
+            sock.sendall(b"\0\0\0\2[]")
+            response = recv_message(sock)
+            self.assertFalse(response["ok"])
+            # the connection is closed
+            with self.assertRaises((EOFError, ConnectionError)):
+                send_message(sock, {"command": "ping"})
+                recv_message(sock)
+
+    def test_concurrent_clients(self):
+        active = []
+        overlapped = []
+
+        def probe():
+            active.append(1)
+            overlapped.append(len(active) > 1)
+            time.sleep(0.001)
+            active.pop()
+            return True
+
+        self.daemon.handlers["probe"] = probe
+        errors = []
+
+        def run(i):
+            try:
+                with DaemonClient(self.daemon.socket_path) as client:
+                    for _ in range(20):
+                        self.assertTrue(client.request("probe"))
+                        self.assertEqual(client.render(self.network_path, f"pc-{10 + i}"),
+                                         get_config_for(f"pc-{10 + i}", self.network))
+            except Exception as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+        for i in threads:
+            i.start()
+        for i in threads:
+            i.join()
+        self.assertListEqual(errors, [])
+        self.assertEqual(len(overlapped), 160)
+        self.assertFalse(any(overlapped))
+        self.assertEqual(self.daemon.requests["render"], 160)
+
+    def test_benchmark(self):
+        """
+        the latency of a request against a cold command line run
+        """
+        n = 200
+        with DaemonClient(self.daemon.socket_path) as client:
+            client.render(self.network_path, "pc-12")
+            start = time.perf_counter()
+            for _ in range(n):
+                client.render(self.network_path, "pc-12")
+            warm = (time.perf_counter() - start) / n
+
+        def best(*args):
+            times = []
+            for _ in range(3):
+                start = time.perf_counter()
+                r = subprocess.run([sys.executable, "-m", "wg_config_manager", *args], cwd=ROOT, capture_output=True,
+                                   env=dict(os.environ, PYTHONPATH=str(ROOT)))
+                times.append(time.perf_counter() - start)
+                self.assertEqual(r.returncode, 0, r.stderr)
+            return min(times)
+
+        cold = best("render", str(self.network_path), "pc-12")
+        # the thin command line works, its time is mostly the interpreter startup
+        best("--daemon", "--socket", self.daemon.socket_path, "render", str(self.network_path), "pc-12")
+        self.assertLess(warm * 5, cold)
+
+
+if __name__ == "__main__":
+    main()
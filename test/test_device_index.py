@@ -0,0 +1,143 @@
+"""
+Test the device search index and the device browser.
+"""
+from wg_config_manager.device_index import DeviceIndex, DeviceRow, PeerView
+
+import time
+import base64
+import random
+import tkinter as tk
+from configparser import ConfigParser
+from unittest import main, TestCase, skipIf
+
+CONFIG = """
+[server]
+public key = c2VydmVyLWtleQ==
+address = 10.0.0.1/24
+endpoint = wg.example.com:51820
+
+[Laptop]
+public key = bGFwdG9wLWtleQ==
+address = 10.0.0.2/32
+
+[phone]
+public key = cGhvbmUta2V5
+address = 10.0.0.3/32
+peers = server, unknown
+"""
+
+
+def make_index(n: int) -> DeviceIndex:
+    rng = random.Random(0)
+    return DeviceIndex(DeviceRow(f"device-{i}", base64.b64encode(rng.randbytes(32)).decode("ascii"),
+                                 f"10.{i >> 16}.{i >> 8 & 255}.{i & 255}/32") for i in range(n))
+
+
+def has_display() -> bool:
+    try:
+        tk.Tk().destroy()
+    except tk.TclError:
+        return False
+    return True
+
+
+class TestDeviceIndex(TestCase):
+    def setUp(self):
+        parser = ConfigParser()
+        parser.read_string(CONFIG)
+        self.index = DeviceIndex.from_config(parser)
+
+    def names(self, query: str) -> list[str]:
+        return [self.index.rows[i].name for i in self.index.search(query)]
+
+    def test_search(self):
+        self.assertListEqual(self.names(""), ["server", "Laptop", "phone"])
+        self.assertListEqual(self.names("laptop"), ["Laptop"])
+        self.assertListEqual(self.names("cGhvbm"), ["phone"])
+        self.assertListEqual(self.names("10.0.0."), ["server", "Laptop", "phone"])
+        self.assertListEqual(self.names("10.0.0.3"), ["phone"])
+        self.assertListEqual(self.names("nothing"), [])
+        # a query does not match across fields or rows
+        self.assertListEqual(self.names("/32\nphone"), [])
+        self.assertListEqual(self.names("24\tlaptop"), [])
+        self.assertEqual(self.index.rows[self.index.by_name["server"]].endpoint, "wg.example.com:51820")
+
+    def test_incremental(self):
+        index = make_index(1000)
+        for query in ("d", "de", "device-", "device-9", "device-99", "device-999", "device-99", "10.0.3"):
+            expected = [i for i, row in enumerate(index.rows)
+                        if query in f"{row.name}\t{row.public_key}\t{row.address}".lower()]
+            self.assertListEqual(list(index.search(query)), expected, query)
+
+    def test_peer_view(self):
+        view = PeerView(5, 2)
+        self.assertListEqual(list(view), [0, 1, 3, 4])
+        self.assertListEqual(view[1:3], [1, 3])
+        self.assertEqual(view[-1], 4)
+        self.assertEqual(len(PeerView(5, -1)), 5)
+
+    def test_peers(self):
+        by_name = self.index.by_name
+        self.assertEqual(self.index.rows[by_name["phone"]].peers, ("server", "unknown"))
+        # the set `peers` without unknown names, or all other devices
+        self.assertListEqual(list(self.index.get_peers(by_name["phone"])), [by_name["server"]])
+        self.assertListEqual(list(self.index.get_peers(by_name["server"])), [by_name["Laptop"], by_name["phone"]])
+
+    def test_large(self):
+        """
+        build and search 20k devices, every query of typing a name should fit a 50 ms frame
+        """
+        n = 20000
+        start = time.perf_counter()
+        index = make_index(n)
+        self.assertLess(time.perf_counter() - start, 5)
+        key = index.rows[12345].public_key
+        worst = 0.0
+        for query in ["device-12345"[:i] for i in range(1, 13)] + [key[:8], "10.0.48.57", ""]:
+            start = time.perf_counter()
+            result = index.search(query)
+            worst = max(worst, time.perf_counter() - start)
+        self.assertListEqual(list(index.search(key[:8])), [12345])
+        self.assertListEqual(list(index.search("device-12345")), [12345])
+        self.assertLess(worst, 0.05)
+
+
+@skipIf(not has_display(), "no display")
+class TestDeviceBrowser(TestCase):
+    def setUp(self):
+        from wg_config_manager.graphic_interface.widgets import DeviceBrowser
+        self.root = tk.Tk()
+        self.root.geometry("900x600")
+        self.browser = DeviceBrowser(self.root, make_index(20000))
+        self.browser.pack(fill="both", expand=True)
+        self.root.update()
+
+    def test_frames(self):
+        devices = self.browser.devices
+        self.assertLess(len(devices.tree.get_children()), 100)
+        worst = 0.0
+        for _ in range(200):
+            start = time.perf_counter()
+            devices.yview("scroll", 1, "pages")
+            self.root.update()
+            worst = max(worst, time.perf_counter() - start)
+        devices.yview("moveto", 1.0)
+        self.assertEqual(devices.tree.item(devices.tree.get_children()[-1], "values")[0], "device-19999")
+        for text in "device-1234":
+            start = time.perf_counter()
+            self.browser.entry.insert("end", text)
+            self.browser.apply_filter()
+            self.root.update()
+            worst = max(worst, time.perf_counter() - start)
+        self.assertEqual(len(self.browser.matches), 11)
+        devices.tree.selection_set(devices.tree.get_children()[0])
+        self.root.update()
+        self.assertEqual(len(self.browser.peers.rows), 19999)
+        self.assertLess(worst, 0.05)
+
+    def tearDown(self):
+        self.root.destroy()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""
+Test rendering the configs of many devices to files.
+"""
+from wg_config_manager import export
+from wg_config_manager.errors import WireguardConfError
+from wg_config_manager.command_line_interface import main as cli_main
+from wg_config_manager.gpg.gpg import GpgEncryptStream
+from wg_config_manager.wireguard_core import read_config, get_config_for
+
+import io
+import os
+import json
+import stat
+import time
+import codecs
+import tarfile
+import zipfile
+import subprocess
+import tracemalloc
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from configparser import ConfigParser
+from unittest import main, skipUnless, TestCase
+from unittest.mock import patch
+
+from helpers import HUBS, make_network
+
+
+class TestRenderDevices(TestCase):
+    def test_select(self):
+        network = make_network(30)
+        self.assertListEqual(export.select_devices(network, ["pc-2?", "hub-1"]),
+                             ["hub-1"] + [f"pc-{i}" for i in range(20, 30)])
+        self.assertEqual(len(export.select_devices(network)), 30)
+        with self.assertRaises(WireguardConfError):
+            export.select_devices(network, ["pc-99"])
+
+    def test_render(self):
+        network = make_network(30)
+        network.read_dict({"bad": {"public key": "YmFk", "address": "10.9.9.9/32", "peers": "hub-0"}})
+        with TemporaryDirectory() as directory:
+            report = export.render_devices(network, directory, jobs=2)
+            self.assertIn(export.WORKER_START_METHOD, ("forkserver", "spawn"))
+            self.assertEqual(len(report.timings), 31)
+            self.assertListEqual([i.device for i in report.failures], ["bad"])
+            path = Path(directory, "pc-12.conf")
+            self.assertEqual(stat.S_IMODE(path.stat().st_mode), 0o600)
+            self.assertEqual(path.read_text(encoding="utf-8"), get_config_for("pc-12", network) + "\n")
+            self.assertEqual(path.read_text(encoding="utf-8").count("[Peer]"), HUBS)
+            self.assertEqual(Path(directory, "hub-0.conf").read_text(encoding="utf-8").count("[Peer]"), 30)
+            self.assertListEqual(sorted(os.listdir(directory)), sorted(f"{i.device}.conf" for i in report.timings
+                                                                       if i.error is None))
+            self.assertIn("1 failed", report.format_table())
+        with self.assertRaises(WireguardConfError):
+            export.get_config_path(directory, "../escape")
+
+    def test_benchmark(self):
+        """
+        render 10k devices serially and with all CPUs
+        """
+        n = 10000
+        network = make_network(n)
+        jobs = max(2, export.get_default_jobs())
+        with TemporaryDirectory() as serial, TemporaryDirectory() as parallel:
+            start = time.perf_counter()
+            report = export.render_devices(network, serial, jobs=1)
+            serial_time = time.perf_counter() - start
+            start = time.perf_counter()
+            parallel_report = export.render_devices(network, parallel, jobs=jobs)
+            parallel_time = time.perf_counter() - start
+            self.assertListEqual(report.failures + parallel_report.failures, [])
+            for name in ("hub-3.conf", "pc-5000.conf", "pc-9999.conf"):
+                self.assertEqual(Path(serial, name).read_bytes(), Path(parallel, name).read_bytes())
+        if export.get_default_jobs() >= 2:
+            self.assertGreater(serial_time / parallel_time, 1.3)
+
+
+class TestIncrementalRender(TestCase):
+    def test_changes(self):
+        network = make_network(30)
+        with TemporaryDirectory() as directory:
+            report = export.render_devices(network, directory, incremental=True)
+            self.assertEqual(len(report.get_changes()["added"]), 30)
+            self.assertTrue(Path(directory, export.MANIFEST_NAME).is_file())
+            mtimes = {i: os.stat(Path(directory, i)).st_mtime_ns for i in os.listdir(directory)}
+
+            report = export.render_devices(network, directory, jobs=2, incremental=True)
+            self.assertDictEqual(report.get_changes(), {"added": [], "changed": [], "removed": [], "failed": []})
+            self.assertTrue(all(i.status == export.UNCHANGED for i in report.timings))
+            for name in (f"{i.device}.conf" for i in report.timings):
+                self.assertEqual(os.stat(Path(directory, name)).st_mtime_ns, mtimes[name])
+
+            network.set("pc-12", "address", "10.8.0.12/32")
+            network.remove_section("pc-13")
+            network.read_dict({"pc-new": {"private key": "bmV3", "public key": "d2Vu", "address": "10.8.0.99/32", "peers": "hub-0"}})
+            Path(directory, "pc-20.conf").write_text("edited by hand", encoding="utf-8")
+            report = export.render_devices(network, directory, jobs=2, incremental=True)
+            changes = report.get_changes()
+            self.assertListEqual(changes["added"], ["pc-new"])
+            self.assertListEqual(changes["changed"], [f"hub-{i}" for i in range(HUBS)] + ["pc-12", "pc-20"])
+            self.assertListEqual(changes["removed"], ["pc-13"])
+            self.assertFalse(Path(directory, "pc-13.conf").exists())
+            self.assertEqual(os.stat(Path(directory, "pc-11.conf")).st_mtime_ns, mtimes["pc-11.conf"])
+            self.assertIn("pc-20", export.read_manifest(directory))
+            self.assertNotIn("pc-13", export.read_manifest(directory))
+            self.assertEqual(Path(directory, "pc-20.conf").read_text(encoding="utf-8"),
+                             get_config_for("pc-20", network) + "\n")
+
+    def test_command(self):
+        network = make_network(12, hubs=2)
+        with TemporaryDirectory() as directory:
+            path = f"{directory}/network.ini"
+            with open(path, "w", encoding="utf-8") as fp:
+                network.write(fp)
+            changes = f"{directory}/changes.json"
+            self.assertEqual(cli_main(["render-all", path, f"{directory}/out", "--changes", changes]), 0)
+            self.assertEqual(len(json.loads(Path(changes).read_text(encoding="utf-8"))["added"]), 12)
+            self.assertEqual(cli_main(["render-all", path, f"{directory}/out", "pc-*", "--changes", changes]), 0)
+            self.assertDictEqual(json.loads(Path(changes).read_text(encoding="utf-8")),
+                                 {"added": [], "changed": [], "removed": [], "failed": []})
+
+
+def make_ring(n: int) -> ConfigParser:
+    """
+    devices peering with the next one, every config has the same size
+    """
+    parser = make_network(n, hubs=0)
+    for i in range(n):
+        parser.set(f"pc-{i}", "peers", f"pc-{(i + 1) % n}")
+    return parser
+
+
+class CountingSink:
+    """
+    a write-only stream counting the bytes
+    """
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class TestArchive(TestCase):
+    def test_tar(self):
+        network = make_network(30)
+        network.read_dict({"bad": {"address": "10.9.9.9/32", "peers": "hub-0"}})
+        archives = []
+        for _ in range(2):
+            archives.append(io.BytesIO())
+            report = export.write_archive(network, archives[-1], "tar.gz", ["pc-*", "bad"])
+            self.assertEqual(report.members, 20)
+            self.assertListEqual([i.device for i in report.failures], ["bad"])
+        self.assertEqual(archives[0].getvalue(), archives[1].getvalue())
+        with tarfile.open(fileobj=io.BytesIO(archives[0].getvalue()), mode="r:gz") as archive:
+            members = archive.getmembers()
+            self.assertListEqual([i.name for i in members], sorted(f"pc-{i}.conf" for i in range(10, 30)))
+            self.assertSetEqual({(i.mtime, i.mode, i.uid, i.gid, i.uname) for i in members}, {(0, 0o600, 0, 0, "")})
+            self.assertEqual(archive.extractfile("pc-12.conf").read().decode("utf-8"),
+                             get_config_for("pc-12", network) + "\n")
+
+    def test_zip(self):
+        network = make_network(30)
+        archives = []
+        for _ in range(2):
+            archives.append(io.BytesIO())
+            export.write_archive(network, archives[-1], "zip")
+        self.assertEqual(archives[0].getvalue(), archives[1].getvalue())
+        with zipfile.ZipFile(archives[0]) as archive:
+            infos = archive.infolist()
+            self.assertEqual(len(infos), 30)
+            self.assertListEqual([i.filename for i in infos], sorted(i.filename for i in infos))
+            self.assertSetEqual({(i.date_time, i.external_attr >> 16 & 0o777) for i in infos},
+                                {(export.ZIP_EPOCH, 0o600)})
+            self.assertEqual(archive.read("hub-3.conf").decode("utf-8"), get_config_for("hub-3", network) + "\n")
+        with self.assertRaises(WireguardConfError):
+            export.write_archive(network, io.BytesIO(), "rar")
+        self.assertEqual(export.get_archive_format("configs.tgz.gpg"), "tar.gz")
+
+    def test_command(self):
+        network = make_network(12, hubs=2)
+        with TemporaryDirectory() as directory:
+            path = f"{directory}/network.ini"
+            with open(path, "w", encoding="utf-8") as fp:
+                network.write(fp)
+            output = Path(directory, "configs.zip")
+            self.assertEqual(cli_main(["export", path, "hub-*", "-o", str(output)]), 0)
+            self.assertEqual(stat.S_IMODE(output.stat().st_mode), 0o600)
+            with zipfile.ZipFile(output) as archive:
+                self.assertListEqual(archive.namelist(), ["hub-0.conf", "hub-1.conf"])
+
+    @skipUnless(os.name == "posix", "a shell script as gpg")
+    def test_encrypt_stream(self):
+        network = make_network(12, hubs=2)
+        with TemporaryDirectory() as directory:
+            fake_gpg = Path(directory, "gpg")
+            # rot13 instead of encryption
+            fake_gpg.write_text("#!/bin/sh\nexec tr 'A-Za-z' 'N-ZA-Mn-za-m'\n", encoding="utf-8")
+            fake_gpg.chmod(0o700)
+            expected = io.BytesIO()
+            export.write_archive(network, expected, "tar")
+            # to a pipe of gpg writing to a file, and to a stream gpg cannot write to
+            with open(Path(directory, "configs.tar.gpg"), "wb") as fp, \
+                    GpgEncryptStream(fp, str(fake_gpg)) as stream:
+                export.write_archive(network, stream, "tar")
+            in_memory = io.BytesIO()
+            with GpgEncryptStream(in_memory, str(fake_gpg)) as stream:
+                export.write_archive(network, stream, "tar")
+            for data in (Path(directory, "configs.tar.gpg").read_bytes(), in_memory.getvalue()):
+                self.assertEqual(len(data), len(expected.getvalue()))
+                self.assertNotEqual(data, expected.getvalue())
+                self.assertEqual(codecs.decode(data.decode("latin-1"), "rot13"), expected.getvalue().decode("latin-1"))
+            with self.assertRaises(subprocess.CalledProcessError):
+                with GpgEncryptStream(io.BytesIO(), "false") as stream:
+                    stream.write(b"data")
+
+    def test_benchmark(self):
+        """
+        stream 10k configs, and check the archive is not kept in memory
+        """
+        n = 10000
+        network = make_network(n, hubs=2)
+        sink = CountingSink()
+        start = time.perf_counter()
+        report = export.write_archive(network, sink, "tar.gz")
+        self.assertLess(time.perf_counter() - start, 30)
+        self.assertEqual(report.members, n)
+        self.assertLess(sink.size, report.size)
+        # the peak memory stays flat while the tar grows with the configs, the peer cache is bounded below them
+        n = 5000
+        network = make_ring(n)
+        sink = CountingSink()
+        tracemalloc.start()
+        with patch.object(export, "ARCHIVE_PEER_CACHE_SIZE", 256):
+            export.write_archive(network, sink, "tar")
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.assertLess(peak, sink.size / 3)
+
+
+if __name__ == "__main__":
+    main()
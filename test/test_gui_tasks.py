@@ -0,0 +1,259 @@
+"""
+Test the task runner and the log buffer of the gui without a display, tkinter calls are made to stubs.
+"""
+from wg_config_manager import logger as lg
+from wg_config_manager.graphic_interface import core
+
+import time
+import logging
+import threading
+from unittest import main, TestCase
+
+
+class StubMaster:
+    """
+    `after` and `after_cancel` of a tk widget, the callbacks run when `run_pending` is called
+    """
+
+    def __init__(self):
+        self.jobs: dict[int, tuple] = {}
+        self.scheduled = 0
+        self._next = 0
+
+    def after(self, ms, func, *args):
+        self._next += 1
+        self.scheduled += 1
+        self.jobs[self._next] = (func, args)
+        return self._next
+
+    def after_cancel(self, job):
+        self.jobs.pop(job, None)
+
+    def run_pending(self):
+        jobs, self.jobs = self.jobs, {}
+        for func, args in jobs.values():
+            func(*args)
+
+    def run_until(self, predicate, timeout: float = 5.0):
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            if time.monotonic() > deadline:
+                raise TimeoutError
+            time.sleep(0.01)
+            self.run_pending()
+
+
+class TestTaskRunner(TestCase):
+    def setUp(self):
+        self.master = StubMaster()
+        self.runner = core.TaskRunner(self.master, max_workers=2)
+        self.ui_thread = threading.current_thread()
+
+    def test_done_in_ui_thread(self):
+        results = []
+
+        def on_done(value):
+            results.append((value, threading.current_thread()))
+
+        task = self.runner.submit(sum, [1, 2, 3], on_done=on_done)
+        self.master.run_until(lambda: task.finished)
+        self.assertEqual(task.state, core.DONE)
+        self.assertListEqual(results, [(6, self.ui_thread)])
+        # the polling stops when every task is finished
+        self.assertDictEqual(self.master.jobs, {})
+
+    def test_error(self):
+        errors = []
+        task = self.runner.submit(int, "x", on_error=errors.append)
+        unhandled = self.runner.submit(int, "y")
+        self.master.run_until(lambda: task.finished and unhandled.finished)
+        self.assertEqual(task.state, core.FAILED)
+        self.assertIsInstance(errors[0], ValueError)
+        self.assertIsInstance(unhandled.error, ValueError)
+
+    def test_progress_coalesced(self):
+        progress = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def work(task: core.Task, n):
+            started.set()
+            for i in range(n):
+                task.report((i + 1) / n, f"{i + 1} of {n}")
+            release.wait(5)
+            return n
+
+        task = self.runner.submit(work, 10000, pass_task=True, on_progress=lambda *p: progress.append(p))
+        started.wait(5)
+        self.master.run_until(lambda: progress and progress[-1][0] == 1.0)
+        release.set()
+        self.master.run_until(lambda: task.finished)
+        self.assertLess(len(progress), 100)
+        self.assertEqual(progress[-1], (1.0, "10000 of 10000"))
+        self.assertEqual(task.result, 10000)
+
+    def test_cancel(self):
+        running = threading.Event()
+        done = []
+
+        def work(task: core.Task):
+            running.set()
+            while True:
+                task.check_cancelled()
+                time.sleep(0.005)
+
+        busy = [self.runner.submit(work, pass_task=True, on_done=done.append) for _ in range(2)]
+        pending = self.runner.submit(sum, [1], on_done=done.append)
+        running.wait(5)
+        self.assertTrue(pending.cancel())
+        for task in busy:
+            task.cancel()
+        self.master.run_until(lambda: all(task.finished for task in busy + [pending]))
+        self.assertListEqual([task.state for task in busy + [pending]], [core.CANCELLED] * 3)
+        self.assertListEqual(done, [])
+        self.assertFalse(pending.cancel())
+
+    def test_queue_view_and_history(self):
+        changes = []
+        self.runner.history_size = 5
+        self.runner.listeners.append(lambda runner: changes.append(len(runner.pending)))
+        tasks = [self.runner.submit(time.sleep, 0.001) for _ in range(20)]
+        self.master.run_until(lambda: all(task.finished for task in tasks))
+        self.assertEqual(len(self.runner.tasks), 5)
+        self.assertEqual(changes[0], 1)
+        self.assertEqual(changes[-1], 0)
+        # a poll is scheduled at most once at a time
+        self.assertLess(self.master.scheduled, 100)
+
+    def test_function_part(self):
+        part = core.FunctionPart(self.runner)
+        event = threading.Event()
+        task = part.submit(event.wait, 5)
+        part.cancel_tasks()
+        event.set()
+        self.master.run_until(lambda: task.finished)
+        self.assertEqual(task.state, core.CANCELLED)
+        with self.assertRaises(RuntimeError):
+            core.FunctionPart().submit(sum, [1])
+
+    def tearDown(self):
+        self.runner.shutdown(wait=True)
+
+
+class StubText:
+    """
+    `insert`, `delete` and `tag_configure` of a `tk.Text`, lines are kept with their tags
+    """
+
+    def __init__(self):
+        self.lines: list[tuple[str, set[str]]] = []
+        self.elide: dict[str, bool] = {}
+        self.calls = 0
+
+    def insert(self, index, *chunks):
+        assert index == "end"
+        self.calls += 1
+        for i in range(0, len(chunks), 2):
+            tags = set(chunks[i + 1].split())
+            self.lines += [(line, tags) for line in chunks[i].splitlines(keepends=True)]
+
+    def delete(self, start, end):
+        self.calls += 1
+        assert start == "1.0"
+        del self.lines[:int(end.split(".")[0]) - 1]
+
+    def tag_configure(self, tag, elide):
+        self.calls += 1
+        self.elide[tag] = elide is True
+
+    def visible(self) -> list[str]:
+        return [line for line, tags in self.lines if not any(self.elide.get(tag) for tag in tags)]
+
+
+class TestLogBuffer(TestCase):
+    def setUp(self):
+        self.handle = lg.UILoggingHandle(capacity=100000)
+        self.text = StubText()
+
+    def test_format_and_filter(self):
+        buffer = core.LogBuffer(max_lines=10)
+        lg.Logger("wg.plugin", ui_handle=self.handle).info("loaded %s", "v2ray")
+        lg.Logger("wg.service", ui_handle=self.handle).warning("restart %d", 3)
+        lg.Logger("wg.service", ui_handle=self.handle).debug("bad %d", "x")
+        buffer.feed(self.handle.drain())
+        self.assertEqual(buffer.flush(self.text), 3)
+        self.assertEqual(self.text.calls, 1 + 3 + 2)  # one insert, the new tags
+        line = self.text.visible()[0]
+        self.assertTrue(line.endswith(" INFO     wg.plugin: loaded v2ray\n"))
+        self.assertTrue(self.text.visible()[2].endswith("wg.service: bad %d ('x',)\n"))
+
+        buffer.set_filter(self.text, logging.INFO)
+        self.assertEqual(len(self.text.visible()), 2)
+        buffer.set_filter(self.text, logging.INFO, "SERVICE")
+        self.assertEqual(len(self.text.visible()), 1)
+        self.assertIn("restart 3", self.text.visible()[0])
+        # new lines follow the filter
+        lg.Logger("wg.other", ui_handle=self.handle).error("hidden")
+        buffer.feed(self.handle.drain())
+        buffer.flush(self.text)
+        self.assertEqual(len(self.text.visible()), 1)
+        buffer.set_filter(self.text)
+        self.assertEqual(len(self.text.visible()), 4)
+
+    def test_trim(self):
+        buffer = core.LogBuffer(max_lines=100)
+        log = lg.Logger("wg.burst", ui_handle=self.handle)
+        for i in range(250):
+            log.info("record %d", i)
+            if i % 40 == 0:
+                buffer.feed(self.handle.drain())
+                buffer.flush(self.text)
+        buffer.feed(self.handle.drain())
+        buffer.flush(self.text)
+        self.assertEqual(len(self.text.lines), 100)
+        self.assertEqual(buffer.lines, 100)
+        self.assertIn("record 150", self.text.lines[0][0])
+        self.assertIn("record 249", self.text.lines[-1][0])
+        # a multi-line message counts all its lines
+        log.error("traceback\n  line 1\n  line 2")
+        buffer.feed(self.handle.drain())
+        buffer.flush(self.text)
+        self.assertEqual(len(self.text.lines), 100)
+        self.assertIn("record 153", self.text.lines[0][0])
+        self.assertEqual(self.text.lines[-1][0], "  line 2\n")
+
+    def test_record_time(self):
+        """
+        a line has the time of its record, not the time of the flush
+        """
+        buffer = core.LogBuffer()
+        lg.Logger("wg.time", ui_handle=self.handle).info("early")
+        name, level, msg, args, kws, created = self.handle.drain()[0]
+        created -= 3600
+        buffer.feed([(name, level, msg, args, kws, created)])
+        buffer.flush(self.text)
+        self.assertTrue(self.text.lines[0][0].startswith(time.strftime("%H:%M:%S ", time.localtime(created))))
+
+    def test_burst(self):
+        """
+        10k records per second, flushed every 100 ms: each flush is one insert and at most one delete
+        """
+        buffer = core.LogBuffer()
+        log = lg.Logger("wg.burst", ui_handle=self.handle)
+        worst = 0.0
+        for second in range(3):
+            for tick in range(10):
+                for i in range(1000):
+                    log.debug("service output %d", i)
+                start = time.perf_counter()
+                buffer.feed(self.handle.drain(core.LOG_BATCH_SIZE))
+                calls = self.text.calls
+                buffer.flush(self.text)
+                worst = max(worst, time.perf_counter() - start)
+                self.assertLessEqual(self.text.calls - calls, 2 + 2)
+        self.assertEqual(len(self.text.lines), core.LOG_MAX_LINES)
+        self.assertLess(worst, 0.05)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,386 @@
+"""
+Test the log decorators of logger.py.
+"""
+from wg_config_manager import logger as lg
+
+import gc
+import copy
+import json
+import time
+import logging
+import weakref
+import threading
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from configparser import ConfigParser
+from unittest import main, TestCase
+
+logger = lg.Logger("test_logger")
+
+
+@logger.important_function(print_parameters=["target", "key"])
+def encrypt(target: bytes, key, mode="xor"):
+    return bytes(i ^ key for i in target)
+
+
+class Plugin:
+    @logger.important_method(print_parameters=["name", "self"])
+    def render(self, name, size: int = 10):
+        return "x" * size
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records: list[logging.LogRecord] = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestImportantFunction(TestCase):
+    def setUp(self):
+        self.handler = ListHandler()
+        logger.logger.addHandler(self.handler)
+        logger.logger.setLevel(logging.INFO)
+
+    def messages(self) -> list[str]:
+        return [r.getMessage() for r in self.handler.records]
+
+    def test_parameters_and_summary(self):
+        secret = b"plaintext" * 1000
+        encrypt(secret, 1)
+        call, exited = self.messages()
+        self.assertEqual(call, 'call function "encrypt", with target=<bytes: 9000 bytes>, key=1')
+        self.assertEqual(exited, 'function "encrypt" exited, returned <bytes: 9000 bytes>')
+        self.assertNotIn("plaintext", "".join(self.messages()))
+
+    def test_method(self):
+        plugin = Plugin()
+        plugin.render("a", size=1000)
+        call, exited = self.messages()
+        self.assertTrue(call.startswith('call method "render", with name=a, self=<'))
+        self.assertTrue(exited.startswith('method "render" exited, returned \'xxx'))
+        self.assertTrue(exited.endswith("... (1000 chars)"))
+
+    def test_disabled(self):
+        logger.logger.setLevel(logging.WARNING)
+        self.assertEqual(Plugin().render("a"), "x" * 10)
+        self.assertListEqual(self.handler.records, [])
+
+    def test_warning_level(self):
+        logger.warning("careful")
+        self.assertEqual(self.handler.records[0].levelno, logging.WARNING)
+
+    def test_summarize(self):
+        self.assertEqual(lg.summarize(list(range(100))), "<list: 100 items>")
+        self.assertEqual(lg.summarize([1, 2]), [1, 2])
+        self.assertEqual(lg.summarize(memoryview(b"abc")), "<memoryview: 3 bytes>")
+
+    def test_overhead(self):
+        """
+        per-call overhead with logging on and off
+        """
+        payload = b"\0" * (4 * 1024 * 1024)
+        n = 2000
+        results = {}
+        for level in (logging.INFO, logging.WARNING):
+            logger.logger.setLevel(level)
+            start = time.perf_counter()
+            for _ in range(n):
+                Plugin().render("a")
+            results[logging.getLevelName(level)] = (time.perf_counter() - start) / n
+        # a large returned payload costs the same as a small one
+        logger.logger.setLevel(logging.INFO)
+        start = time.perf_counter()
+        for _ in range(100):
+            logger.function_called(lambda: payload, logging.INFO, None)
+        large = (time.perf_counter() - start) / 100
+        self.assertLess(results["WARNING"], results["INFO"])
+        self.assertLess(large, 0.001)
+
+    def tearDown(self):
+        logger.logger.removeHandler(self.handler)
+        logger.logger.setLevel(logging.NOTSET)
+
+
+class Slotted:
+    __slots__ = ()
+
+    @logger.important_method()
+    def ping(self):
+        return self
+
+
+class TestImportantMethodDescriptor(TestCase):
+    def setUp(self):
+        logger.logger.setLevel(logging.WARNING)
+
+    def test_bound(self):
+        plugin = Plugin()
+        self.assertEqual(plugin.render, plugin.render)
+        self.assertNotEqual(plugin.render, Plugin().render)
+        self.assertIs(plugin.render.__self__, plugin)
+        self.assertIs(type(Plugin.__dict__["render"]), lg.ImportantMethod)
+        self.assertIs(type(Plugin.__dict__["render"]), type(Slotted.__dict__["ping"]))
+        self.assertEqual(plugin.render.__name__, "render")
+        slotted = Slotted()
+        self.assertIs(slotted.ping(), slotted)
+
+    def test_instance_untouched(self):
+        """
+        nothing is stored in the instance, a copy binds to itself and the instance is freed without the gc
+        """
+        plugin = Plugin()
+        plugin.render("a")
+        self.assertDictEqual(vars(plugin), {})
+        copied = copy.copy(plugin)
+        self.assertIs(copied.render.__self__, copied)
+        reference = weakref.ref(plugin)
+        gc.disable()
+        try:
+            del plugin
+            self.assertIsNone(reference())
+        finally:
+            gc.enable()
+
+    def tearDown(self):
+        logger.logger.setLevel(logging.NOTSET)
+
+
+class TestPipeline(TestCase):
+    def setUp(self):
+        # measure the pipeline alone, without the capturing handlers of the test runner
+        self.root_handlers = logging.getLogger().handlers[:]
+        for handler in self.root_handlers:
+            logging.getLogger().removeHandler(handler)
+
+    def test_ui_ring_buffer(self):
+        handle = lg.UILoggingHandle(capacity=100)
+        received = []
+        handle.log_hook = lambda *record: received.append(record)
+        ui_logger = lg.Logger("test_logger.ui", ui_handle=handle)
+        for i in range(150):
+            ui_logger.debug("record %d", i)
+        self.assertEqual(handle.dropped, 50)
+        self.assertEqual(len(handle.drain(10)), 10)
+        self.assertEqual(handle.flush(), 90)
+        self.assertEqual(received[0][2:4], ("record %d", (60,)))
+        self.assertEqual(received[-1][3], (149,))
+        self.assertEqual(handle.flush(), 0)
+
+    def test_slow_handler(self):
+        """
+        callers are not blocked by a slow handler, under a load of 100k records
+        """
+
+        class SlowHandler(ListHandler):
+            def flush(self):
+                time.sleep(0.05)  # like a slow disk
+
+        handler = SlowHandler()
+        lg.setup_logging(handlers=[handler])
+        pipeline_logger = lg.Logger("test_logger.pipeline", ui_handle=lg.UILoggingHandle(capacity=1000))
+        n = 100000
+        start = time.perf_counter()
+        for i in range(n):
+            pipeline_logger.info("record %d", i)
+        elapsed = time.perf_counter() - start
+        lg.stop_logging()
+        self.assertEqual(len(handler.records), n)
+        self.assertEqual(handler.records[-1].getMessage(), f"record {n - 1}")
+        self.assertGreater(n / elapsed, 50000)
+        self.assertEqual(pipeline_logger.ui_handle.dropped, n - 1000)
+
+    def test_prepare(self):
+        """
+        the args are merged and the exception rendered before the record is queued
+        """
+        handler = ListHandler()
+        handler.setFormatter(lg.JsonLineFormatter())
+        lg.setup_logging(handlers=[handler])
+        pipeline_logger = logging.getLogger("test_logger.prepare")
+        value = ["before"]
+        pipeline_logger.warning("value %s", value)
+        value[0] = "after"
+        try:
+            raise ValueError("bad value")
+        except ValueError:
+            pipeline_logger.exception("failed")
+        lg.stop_logging()
+        self.assertListEqual([i.getMessage() for i in handler.records], ["value ['before']", "failed"])
+        self.assertListEqual([(i.args, i.exc_info) for i in handler.records], [(None, None)] * 2)
+        line = json.loads(handler.format(handler.records[1]))
+        self.assertIn("ValueError: bad value", line["exc"])
+
+    def test_rotating_size(self):
+        """
+        the size for the rollover is counted in bytes
+        """
+        with TemporaryDirectory() as directory:
+            path = Path(directory, "test.log")
+            handler = lg.BufferedRotatingFileHandler(path, max_bytes=1000, backup_count=10)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            for _ in range(20):
+                handler.emit(logging.makeLogRecord({"msg": "\u65e5\u5fd7" * 50}))
+            handler.close()
+            sizes = [i.stat().st_size for i in Path(directory).glob("test.log*")]
+            self.assertEqual(sum(sizes), 20 * 301)
+            self.assertTrue(all(i <= 1000 + 301 for i in sizes), sizes)
+
+    def test_rotating_file(self):
+        with TemporaryDirectory() as directory:
+            parser = ConfigParser()
+            parser.read_dict({"Common": {"log": f"{directory}/test.log", "log max bytes": str(1024 * 1024),
+                                         "log backup count": "100"}})
+            lg.setup_logging(parser)
+            pipeline_logger = lg.Logger("test_logger.pipeline", ui_handle=lg.UILoggingHandle())
+            n, threads = 25000, 4
+
+            def work():
+                for i in range(n):
+                    pipeline_logger.info("record %d", i)
+
+            workers = [threading.Thread(target=work) for _ in range(threads)]
+            for t in workers:
+                t.start()
+            for t in workers:
+                t.join()
+            lg.stop_logging()
+            lines = 0
+            for path in Path(directory).glob("test.log*"):
+                self.assertLessEqual(path.stat().st_size, 1024 * 1024 + 200)
+                with open(path, "r", encoding="utf-8") as fp:
+                    lines += sum(1 for line in fp if "test_logger.pipeline" in line)
+            self.assertEqual(lines, n * threads)
+            self.assertGreater(len(list(Path(directory).glob("test.log.*"))), 0)
+
+    def tearDown(self):
+        lg.stop_logging()
+        logging.getLogger().setLevel(logging.WARNING)
+        for handler in self.root_handlers:
+            logging.getLogger().addHandler(handler)
+
+
+class Loader:
+    plugin_name = "demo"
+
+    @logger.important_method()
+    def run_service(self, service_name, process_name, **kwargs):
+        return process_name
+
+
+class TestStructuredLog(TestCase):
+    def setUp(self):
+        self.handler = ListHandler()
+        logger.logger.addHandler(self.handler)
+        logger.logger.setLevel(logging.INFO)
+
+    def test_json_schema(self):
+        Loader().run_service("v2ray", "main")
+        with self.assertRaises(ValueError):
+            encrypt(b"x", 1000)
+        formatter = lg.JsonLineFormatter()
+        call, returned, _, error = [json.loads(formatter.format(r)) for r in self.handler.records]
+        self.assertEqual(set(call), {"ts", "level", "logger", "msg", "event", "function", "plugin", "service"})
+        self.assertEqual(call["event"], "call")
+        self.assertEqual(call["function"], f"{__name__}.Loader.run_service")
+        self.assertEqual(call["plugin"], "demo")
+        self.assertEqual(call["service"], "main")
+        self.assertEqual(returned["event"], "return")
+        self.assertEqual(returned["outcome"], "ok")
+        self.assertIsInstance(returned["duration"], float)
+        self.assertEqual(error["level"], "ERROR")
+        self.assertEqual(error["outcome"], "error")
+        self.assertEqual(error["function"], f"{__name__}.encrypt")
+
+        record = logging.LogRecord("x", logging.INFO, __file__, 1, 'quote " and \n %s', ("é",), None)
+        record.service = 'a"b'
+        record.duration = float("nan")
+        line = json.loads(formatter.format(record))
+        self.assertEqual(line["msg"], 'quote " and \n é')
+        self.assertEqual(line["service"], 'a"b')
+        self.assertIsNone(line["duration"])
+
+    def test_sampling(self):
+        sampling = lg.SamplingFilter({"call": 0.1, f"{__name__}.Plugin.render:return": 0.25}, default_rate=0.5)
+        self.handler.addFilter(sampling)
+        plugin = Plugin()
+        for _ in range(1000):
+            plugin.render("a")
+        for i in range(100):
+            logger.info("free %d", i)
+        logger.warning("always")
+        events = [getattr(r, "event", r.name) for r in self.handler.records]
+        self.assertEqual(events.count("call"), 100)
+        self.assertEqual(events.count("return"), 250)
+        self.assertEqual(events.count("test_logger"), 50 + 1)
+        self.assertEqual(sampling.dropped["call"], 900)
+        self.assertEqual(self.handler.records[0].event, "call")
+        self.assertEqual(self.handler.records[-1].getMessage(), "always")
+
+    def test_sampling_short_name(self):
+        sampling = lg.SamplingFilter({"render:return": 0.1, "render:call": 0.5,
+                                      f"{__name__}.Plugin.render:call": 0.2})
+        self.handler.addFilter(sampling)
+        plugin = Plugin()
+        for _ in range(100):
+            plugin.render("a")
+        events = [r.event for r in self.handler.records]
+        self.assertEqual(events.count("return"), 10)
+        # the qualified name first
+        self.assertEqual(events.count("call"), 20)
+        self.assertEqual(sampling.dropped["render:return"], 90)
+
+    def test_rate_limit(self):
+        now = [0.0]
+        sampling = lg.SamplingFilter(rate_limit=10, clock=lambda: now[0])
+        self.handler.addFilter(sampling)
+        for i in range(100):
+            now[0] = i * 0.01  # 100 records per second for a second
+            logger.info("flood")
+        # the burst of 10, then 10 per second
+        self.assertEqual(len(self.handler.records), 10 + 9)
+        self.assertEqual(sampling.dropped["test_logger"], 100 - 19)
+
+    def test_config(self):
+        self.assertDictEqual(lg.parse_sample_rates("call: 0.01, a.b:return: 0.5"), {"call": 0.01, "a.b:return": 0.5})
+        with self.assertRaises(ValueError):
+            lg.parse_sample_rates("call: 2")
+        with TemporaryDirectory() as directory:
+            parser = ConfigParser()
+            parser.read_dict({"Common": {"log": f"{directory}/test.log", "log format": "json",
+                                         "log sample rates": "call: 0.5"}})
+            handlers = lg.get_log_handlers(parser)
+            self.assertIsInstance(handlers[1].formatter, lg.JsonLineFormatter)
+            self.assertIsInstance(handlers[1].filters[0], lg.SamplingFilter)
+            for handler in handlers:
+                handler.close()
+
+    def test_format_speed(self):
+        """
+        the json line formatter against json.dumps of a dict of the same fields
+        """
+        Loader().run_service("v2ray", "main")
+        record = self.handler.records[-1]
+        formatter = lg.JsonLineFormatter()
+        n = 20000
+        start = time.perf_counter()
+        for _ in range(n):
+            formatter.format(record)
+        joined = (time.perf_counter() - start) / n
+        start = time.perf_counter()
+        for _ in range(n):
+            json.dumps({"ts": record.created, "level": record.levelname, "logger": record.name,
+                        "msg": record.getMessage(), **{k: getattr(record, k) for k in formatter.FIELDS}})
+        dumped = (time.perf_counter() - start) / n
+        self.assertLess(joined, 0.0001)
+        self.assertLess(joined, dumped * 1.5)
+
+    def tearDown(self):
+        logger.logger.removeHandler(self.handler)
+        logger.logger.setLevel(logging.NOTSET)
+
+
+if __name__ == "__main__":
+    main()
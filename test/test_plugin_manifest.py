@@ -0,0 +1,130 @@
+"""
+Test lazy plugin loading with the plugin manifest cache.
+"""
+from wg_config_manager import load_plugin as lp
+
+import os
+import sys
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from configparser import ConfigParser
+from unittest import main, TestCase
+
+PLUGIN_SOURCE = '''
+from wg_config_manager.load_plugin import FunctionParameter, AcquireValue
+
+_TABLE = [i * i for i in range(20000)]  # simulate a heavy module body
+
+
+def xor_callback(target: bytes, xor_keyword: bytes):
+    return bytes(i ^ xor_keyword[0] for i in target)
+
+
+parameters = [FunctionParameter(name="target", default=AcquireValue("TARGET DATA")),
+              FunctionParameter(name="xor_keyword", default="k", before_pass=str.encode)]
+
+VERSION_REQ = ">=0.0.1-alpha"
+ENCRYPT_TYPE_XOR = {{"encrypt": [xor_callback, parameters], "decrypt": [xor_callback, parameters]}}
+ENCRYPT_TYPE_OFF = {{"encrypt": [xor_callback, parameters], "disable": True}}
+BACKGROUND_SERVICE_idle_{index} = {{}}
+'''
+
+
+def make_plugins(directory: Path, count: int) -> ConfigParser:
+    """
+    write `count` synthetic plugins to `directory`, return the config to load them
+    """
+    names = []
+    for i in range(count):
+        name = f"plg_{i}"
+        with open(directory / f"{name}.py", "w", encoding="utf-8") as fp:
+            fp.write(PLUGIN_SOURCE.format(index=i))
+        names.append(name)
+    parser = ConfigParser()
+    parser["Extension"] = {"plugins": ", ".join(f'"{n}"' for n in names)}
+    for n in names:
+        parser["Extension"][f"plugin_dir-{n}"] = str(directory)
+    return parser
+
+
+def forget_modules(directory: Path):
+    for key in [k for k in sys.modules if k.startswith(f"{directory.name}.")]:
+        del sys.modules[key]
+
+
+class TestPluginManifest(TestCase):
+    def setUp(self):
+        self._tmp = TemporaryDirectory()
+        self.directory = Path(self._tmp.name) / "plugins"
+        self.directory.mkdir()
+        self.cache_path = Path(self._tmp.name) / "plugin manifest.json"
+
+    def test_scan_without_import(self):
+        """
+        keywords are listed from manifest, and the module is imported at first use
+        """
+        parser = make_plugins(self.directory, 2)
+        plugins = lp.load_plugins(parser, lazy=True, manifest_cache=lp.PluginManifestCache(self.cache_path))
+        plugin = plugins["plg_1"]
+        self.assertFalse(plugin.is_imported)
+        self.assertNotIn(f"{self.directory.name}.plg_1", sys.modules)
+        self.assertListEqual(plugin.get_encrypt_type_names(), ["XOR"])
+        self.assertListEqual(plugin.get_service_names(), ["idle_1"])
+        plugin.check_plugin_version_req()
+        self.assertFalse(plugin.is_imported)
+        # use a keyword
+        self.assertEqual(plugin.exec_decrypt("XOR", plugin.exec_encrypt("XOR", b"data")), b"data")
+        self.assertTrue(plugin.is_imported)
+        self.assertFalse(plugins["plg_0"].is_imported)
+
+    def test_cache_invalidation(self):
+        """
+        the cache is reused when the file is touched, and updated when the file is modified
+        """
+        make_plugins(self.directory, 1)
+        file_path = self.directory / "plg_0.py"
+        cache = lp.PluginManifestCache(self.cache_path)
+        first = cache.get(file_path, "plg_0")
+        cache.save()
+        self.assertTrue(self.cache_path.is_file())
+
+        os.utime(file_path, ns=(first.mtime_ns + 10 ** 9, first.mtime_ns + 10 ** 9))
+        touched = lp.PluginManifestCache(self.cache_path).get(file_path, "plg_0")
+        self.assertEqual(touched.sha256, first.sha256)
+        self.assertEqual(touched.mtime_ns, first.mtime_ns + 10 ** 9)
+
+        with open(file_path, "a", encoding="utf-8") as fp:
+            fp.write("BACKGROUND_SERVICE_extra = {}\n")
+        modified = lp.PluginManifestCache(self.cache_path).get(file_path, "plg_0")
+        self.assertNotEqual(modified.sha256, first.sha256)
+        self.assertListEqual(modified.background_services, ["idle_0", "extra"])
+
+    def test_benchmark_startup(self):
+        """
+        compare the startup time of 50 synthetic plugins, eager vs lazy
+        """
+        parser = make_plugins(self.directory, 50)
+
+        start = time.perf_counter()
+        lp.load_plugins(parser)
+        eager = time.perf_counter() - start
+        forget_modules(self.directory)
+
+        # the first lazy load fills the manifest cache
+        lp.load_plugins(parser, lazy=True, manifest_cache=lp.PluginManifestCache(self.cache_path))
+
+        start = time.perf_counter()
+        plugins = lp.load_plugins(parser, lazy=True, manifest_cache=lp.PluginManifestCache(self.cache_path))
+        warm = time.perf_counter() - start
+
+        self.assertFalse(any(p.is_imported for p in plugins.values()))
+        self.assertLess(warm, eager)
+
+    def tearDown(self):
+        forget_modules(self.directory)
+        self._tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Test the timing instrumentation and profiling report.
+"""
+from wg_config_manager import profiling
+from wg_config_manager.logger import Logger
+
+import os
+import sys
+import time
+import threading
+import subprocess
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import main, TestCase
+
+logger = Logger("test_profiling")
+BUSY_CODE = "import time\nend = time.process_time() + 0.5\nwhile time.process_time() < end:\n    pass\n"
+
+
+@logger.important_function()
+def outer(n):
+    with profiling.PROFILER.span("inner"):
+        time.sleep(0.01)
+    if n < 0:
+        raise ValueError(n)
+    return n
+
+
+class Keygen:
+    @logger.important_method()
+    def gen(self):
+        return profiling.run_subprocess([sys.executable, "-c", "pass"]).returncode
+
+
+class TestProfiler(TestCase):
+    def setUp(self):
+        profiling.PROFILER.reset()
+        profiling.PROFILER.enabled = True
+
+    def test_histogram(self):
+        h = profiling.Histogram()
+        for i in range(1, 101):
+            h.add(i / 1000)
+        self.assertEqual(h.count, 100)
+        self.assertAlmostEqual(h.total, 5.05)
+        self.assertLessEqual(h.quantile(0.5), 0.0656)
+        self.assertGreaterEqual(h.quantile(0.5), 0.05)
+        self.assertEqual(h.quantile(1), 0.1)
+        self.assertIsNone(profiling.Histogram().quantile(0.5))
+
+    def test_important_function(self):
+        outer(1)
+        with self.assertRaises(ValueError):
+            outer(-1)
+        timings = {i["name"]: i for i in profiling.PROFILER.snapshot()}
+        self.assertEqual(timings[f"{__name__}.outer"]["count"], 2)
+        self.assertEqual(timings[f"{__name__}.outer"]["errors"], 1)
+        self.assertGreaterEqual(timings["inner"]["wall_total"], 0.02)
+        folded = profiling.PROFILER.format_folded()
+        self.assertIn(f"{__name__}.outer;inner ", folded)
+        # the self time of outer excludes inner
+        self.assertLess(profiling.PROFILER.stacks[f"{__name__}.outer"], 10000)
+
+    def test_subprocess_span(self):
+        self.assertEqual(Keygen().gen(), 0)
+        timings = {i["name"]: i for i in profiling.PROFILER.snapshot()}
+        name = f"subprocess {Path(sys.executable).stem}"
+        self.assertEqual(timings[name]["count"], 1)
+        self.assertIn(f"{__name__}.Keygen.gen;{name.replace(' ', '_')} ", profiling.PROFILER.format_folded())
+
+    def test_subprocess_cpu(self):
+        """
+        the CPU time of a subprocess span is its own child's, not the one of a busy child of another thread
+        """
+        busy = threading.Thread(target=subprocess.run, args=([sys.executable, "-c", BUSY_CODE],))
+        busy.start()
+        result = profiling.run_subprocess([sys.executable, "-c", "import sys, time; time.sleep(1);"
+                                           "sys.stdout.write(sys.stdin.read())"],
+                                          input=b"x", capture_output=True, check=True)
+        busy.join()
+        self.assertEqual(result.stdout, b"x")
+        name = f"subprocess {Path(sys.executable).stem}"
+        self.assertLess(profiling.PROFILER.timings[name].cpu.total, 0.3)
+        with self.assertRaises(subprocess.CalledProcessError):
+            profiling.run_subprocess([sys.executable, "-c", "exit(3)"], check=True)
+        self.assertEqual(profiling.PROFILER.timings[name].errors, 1)
+        with self.assertRaises(subprocess.TimeoutExpired):
+            profiling.run_subprocess([sys.executable, "-c", "import time; time.sleep(10)"], timeout=0.5)
+        self.assertEqual(profiling.PROFILER.timings[name].errors, 2)
+
+    def test_disabled_overhead(self):
+        profiling.PROFILER.enabled = False
+        n = 20000
+        start = time.perf_counter()
+        for _ in range(n):
+            with profiling.PROFILER.span("x"):
+                pass
+        disabled = (time.perf_counter() - start) / n
+        profiling.PROFILER.enabled = True
+        start = time.perf_counter()
+        for _ in range(n):
+            with profiling.PROFILER.span("x"):
+                pass
+        enabled = (time.perf_counter() - start) / n
+        self.assertEqual(profiling.PROFILER.timings["x"].wall.count, n)
+        self.assertLess(disabled, enabled)
+
+    def test_parse_modes(self):
+        self.assertSetEqual(profiling.parse_modes("1"), {"time"})
+        self.assertSetEqual(profiling.parse_modes("cprofile, tracemalloc"), {"cprofile", "tracemalloc"})
+        with self.assertRaises(ValueError):
+            profiling.parse_modes("perf")
+
+    def test_env(self):
+        """
+        profile a run by the environment variable
+        """
+        with TemporaryDirectory() as directory:
+            prefix = Path(directory) / "profile"
+            code = ("from wg_config_manager import wireguard_core\n"
+                    "from wg_config_manager.profiling import PROFILER\n"
+                    "with PROFILER.span('render'):\n"
+                    "    sum(range(100000))\n")
+            env = dict(os.environ, WGCM_PROFILE="time,cprofile,tracemalloc", WGCM_PROFILE_OUTPUT=str(prefix))
+            subprocess.run([sys.executable, "-c", code], check=True, env=env,
+                           cwd=Path(__file__).parent.parent)
+            report = Path(f"{prefix}.txt").read_text(encoding="utf-8")
+            self.assertIn("== timings ==", report)
+            self.assertIn("render", report)
+            self.assertIn("== cProfile ==", report)
+            self.assertIn("== tracemalloc ==", report)
+            self.assertTrue(Path(f"{prefix}.pstats").is_file())
+            self.assertRegex(Path(f"{prefix}.folded").read_text(encoding="utf-8"), r"^render \d+\n$")
+
+    def tearDown(self):
+        profiling.PROFILER.enabled = False
+        profiling.PROFILER.reset()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Test bulk key generation and the transactional key rotation.
+"""
+from wg_config_manager import keys, rotation
+from wg_config_manager.command_line_interface import main as cli_main
+from wg_config_manager.errors import WireguardConfError
+from wg_config_manager.wireguard_core import get_config_for, read_config
+
+import io
+import os
+import stat
+import time
+import base64
+from contextlib import redirect_stdout
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import main, TestCase
+
+from helpers import make_network
+
+# RFC 7748 section 6.1
+RFC_KEYS = [("77076d0a7318a57d3c16c17251b26645df4c2f87ebc0992ab177fba51db92c2a",
+             "8520f0098930a754748b7ddcb43ef75a0dbf3a0d26381af4eba4a98eaa9b4e6a"),
+            ("5dab087e624a8a4b79e17f8b83800ee66f3bb1292618b6fd1c2f8b27ff88e0eb",
+             "de9edb7d7b7dc1b4d35b61c2ece435373f8343c85b78674dadfc7e146f882b4f")]
+
+
+def b64(data: bytes) -> str:
+    return base64.b64encode(data).decode("ascii")
+
+
+class TestKeys(TestCase):
+    def test_public_keys(self):
+        private_keys = [b64(bytes.fromhex(i)) for i, _ in RFC_KEYS]
+        self.assertListEqual(keys.derive_public_keys(private_keys), [b64(bytes.fromhex(i)) for _, i in RFC_KEYS])
+        private_keys = keys.gen_private_keys(50)
+        self.assertEqual(len(set(private_keys)), 50)
+        for i in private_keys:
+            raw = base64.b64decode(i)
+            self.assertEqual((raw[0] & 7, raw[31] & 192), (0, 64))
+        self.assertListEqual([len(base64.b64decode(i)) for i in keys.gen_pre_shared_keys(3)], [32] * 3)
+        with self.assertRaises(ValueError):
+            keys.derive_public_keys(["c2hvcnQ="])
+
+
+class TestRotation(TestCase):
+    def setUp(self):
+        self.network = make_network(30, hubs=3)
+        self.network.set("pc-12", "pre-shared key[hub-0]", b64(b"1" * 32))
+        self.network.set("hub-0", "pre-shared key[pc-12]", b64(b"1" * 32))
+
+    def test_rotate(self):
+        before = get_config_for("pc-20", self.network)
+        result = rotation.rotate(self.network, ["pc-12"])
+        self.assertListEqual(result.affected, ["hub-0", "hub-1", "hub-2", "pc-12"])
+        config = result.config
+        self.assertNotEqual(config.get("pc-12", "private key"), self.network.get("pc-12", "private key"))
+        self.assertEqual(config.get("pc-12", "public key"),
+                         keys.derive_public_keys([config.get("pc-12", "private key")])[0])
+        self.assertIn(f"PublicKey = {config.get('pc-12', 'public key')}", get_config_for("hub-1", config))
+        self.assertEqual(get_config_for("pc-20", config), before)
+        # the original config is not changed
+        self.assertEqual(self.network.get("pc-12", "public key"), make_network(30, hubs=3).get("pc-12", "public key"))
+        # a mesh device without `peers` is affected by any rotation
+        self.network.remove_option("pc-20", "peers")
+        self.assertIn("pc-20", rotation.rotate(self.network, ["pc-12"]).affected)
+
+    def test_psk(self):
+        result = rotation.rotate(self.network, ["pc-1?"], keys=False, psks=True)
+        self.assertListEqual(result.psk_pairs, [("hub-0", "pc-12")])
+        self.assertListEqual(result.affected, ["hub-0", "pc-12"])
+        psk = result.config.get("pc-12", "pre-shared key[hub-0]")
+        self.assertNotEqual(psk, b64(b"1" * 32))
+        self.assertEqual(result.config.get("hub-0", "pre-shared key[pc-12]"), psk)
+        self.assertIn(f"PresharedKey = {psk}", get_config_for("hub-0", result.config))
+        with self.assertRaises(WireguardConfError):
+            rotation.rotate(self.network, ["pc-12"], psks=True, staged=True)
+
+    def test_staged(self):
+        before = get_config_for("pc-12", self.network)
+        staged = rotation.rotate(self.network, ["pc-12"], staged=True)
+        self.assertListEqual(staged.affected, ["hub-0", "hub-1", "hub-2"])
+        config = staged.config
+        self.assertEqual(get_config_for("pc-12", config), before)
+        hub = get_config_for("hub-0", config)
+        next_key = config.get("pc-12", rotation.NEXT_PUBLIC_KEY)
+        self.assertIn(f"PublicKey = {self.network.get('pc-12', 'public key')}", hub)
+        self.assertIn(f"[Peer]\n# pc-12 (next key)\nPublicKey = {next_key}\nPresharedKey = ", hub)
+        # the next key carries no traffic, the address ranges stay with the current key
+        self.assertNotIn("AllowedIPs", hub.split("# pc-12 (next key)")[1].split("[Peer]")[0])
+        self.assertEqual(hub.count("AllowedIPs = "), get_config_for("hub-0", self.network).count("AllowedIPs = "))
+
+        result = rotation.cutover(config)
+        self.assertListEqual(result.rotated, ["pc-12"])
+        self.assertListEqual(result.affected, ["hub-0", "hub-1", "hub-2", "pc-12"])
+        self.assertEqual(result.config.get("pc-12", "public key"), next_key)
+        self.assertFalse(result.config.has_option("pc-12", rotation.NEXT_PRIVATE_KEY))
+        self.assertEqual(get_config_for("hub-0", result.config).count("PublicKey = "),
+                         get_config_for("hub-0", self.network).count("PublicKey = "))
+        self.assertIn(f"PublicKey = {next_key}", get_config_for("hub-0", result.config))
+
+        result = rotation.cutover(config, discard=True)
+        self.assertListEqual(result.affected, ["hub-0", "hub-1", "hub-2"])
+        self.assertEqual(get_config_for("hub-0", result.config), get_config_for("hub-0", self.network))
+
+    def test_commit(self):
+        with TemporaryDirectory() as directory:
+            network_path = Path(directory, "network.ini")
+            with open(network_path, "w", encoding="utf-8") as fp:
+                self.network.write(fp)
+            data = network_path.read_bytes()
+            self.network.remove_option("hub-2", "address")
+            result = rotation.rotate(self.network, ["pc-12"])
+            with self.assertRaisesRegex(WireguardConfError, "hub-2"):
+                rotation.commit(result, network_path, Path(directory, "out"))
+            self.assertEqual(network_path.read_bytes(), data)
+            self.assertListEqual(os.listdir(Path(directory, "out")), [])
+
+            result = rotation.rotate(read_config(data.decode("utf-8")), ["pc-12"])
+            rotation.commit(result, network_path, Path(directory, "out"))
+            self.assertEqual(stat.S_IMODE(network_path.stat().st_mode), 0o600)
+            network = read_config(network_path.read_text(encoding="utf-8"))
+            self.assertEqual(network.get("pc-12", "private key"), result.config.get("pc-12", "private key"))
+            self.assertListEqual(sorted(os.listdir(Path(directory, "out"))),
+                                 ["hub-0.conf", "hub-1.conf", "hub-2.conf", "pc-12.conf"])
+            self.assertEqual(Path(directory, "out", "hub-1.conf").read_text(encoding="utf-8"),
+                             get_config_for("hub-1", network) + "\n")
+
+    def test_cli(self):
+        with TemporaryDirectory() as directory:
+            path = str(Path(directory, "network.ini"))
+            with open(path, "w", encoding="utf-8") as fp:
+                self.network.write(fp)
+            output = io.StringIO()
+            with redirect_stdout(output):
+                self.assertEqual(cli_main(["rotate", path, "pc-12", "--staged", "-o", f"{directory}/out"]), 0)
+            self.assertListEqual(output.getvalue().split(), ["hub-0", "hub-1", "hub-2"])
+            next_key = read_config(Path(path).read_text(encoding="utf-8")).get("pc-12", rotation.NEXT_PUBLIC_KEY)
+            self.assertIn(next_key, Path(directory, "out", "hub-0.conf").read_text(encoding="utf-8"))
+            with redirect_stdout(io.StringIO()):
+                self.assertEqual(cli_main(["rotate", path, "--cutover"]), 0)
+            self.assertEqual(read_config(Path(path).read_text(encoding="utf-8")).get("pc-12", "public key"), next_key)
+
+    def test_benchmark(self):
+        """
+        rotate the keys of 10k devices, and of 100 devices among them
+        """
+        n = 10000
+        network = make_network(n)
+        with TemporaryDirectory() as directory:
+            start = time.perf_counter()
+            result = rotation.rotate(network)
+            rotation.commit(result, Path(directory, "network.ini"), Path(directory, "out"))
+            full = time.perf_counter() - start
+            self.assertEqual(len(os.listdir(Path(directory, "out"))), n)
+            self.assertLessEqual({"keygen", "derive", "render", "write"}, set(result.timings))
+            start = time.perf_counter()
+            result = rotation.rotate(network, [f"pc-{i}" for i in range(100, 200)])
+            rotation.commit(result, Path(directory, "network.ini"), Path(directory, "out"))
+            self.assertLess(time.perf_counter() - start, full)
+            self.assertEqual(len(result.affected), 110)
+
+
+if __name__ == "__main__":
+    main()
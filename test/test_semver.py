@@ -2,9 +2,13 @@
 Test functions and methods in load_plugin about Semantic Versioning 2.0.0.
 """
 from wg_config_manager.load_plugin import check_version_req_format, semver_lg, check_version_is_req
+from wg_config_manager.load_plugin import check_version_is_req_list
+from wg_config_manager.load_plugin import SemVer, VersionConstraint, parse_semver, satisfies, sort_versions, best_match
 from wg_config_manager.load_plugin import _RE_GET_VERSION as re_semver
 from wg_config_manager.errors import ConfigParseError
 
+import time
+import random
 import unittest
 
 
@@ -60,6 +64,115 @@ class TestSemver(unittest.TestCase):
                                              # 1.0.0-beta+exp.sha.5114f85 >= 0.0.1
                                              "0.0.1"))
 
+        self.assertFalse(check_version_is_req(("<", "1", "0", "0", None, None), "1.0.0"))
+
+
+def random_identifier(rng: random.Random) -> str:
+    if rng.random() < 0.5:
+        return str(rng.randint(0, 12))
+    return "".join(rng.choice("abc-") for _ in range(rng.randint(1, 3))) + rng.choice(["", "1"])
+
+
+def random_version(rng: random.Random) -> str:
+    """
+    generate a random valid semantic version, with small numbers to get more equal parts
+    """
+    s = ".".join(str(rng.randint(0, 2)) for _ in range(3))
+    if rng.random() < 0.6:
+        s += "-" + ".".join(random_identifier(rng) for _ in range(rng.randint(1, 3)))
+    if rng.random() < 0.3:
+        s += "+build." + str(rng.randint(0, 99))
+    return s
+
+
+class TestSemVerProperties(unittest.TestCase):
+    """
+    property-based tests for `SemVer`, `VersionConstraint` and `satisfies`, on seeded random versions
+    """
+    EXAMPLES = 300
+
+    def setUp(self):
+        self.rng = random.Random(20240125)
+        self.versions = [random_version(self.rng) for _ in range(self.EXAMPLES)]
+
+    def test_precedence_examples(self):
+        """
+        the precedence example from https://semver.org
+        """
+        ordered = ["1.0.0-alpha", "1.0.0-alpha.1", "1.0.0-alpha.beta", "1.0.0-beta", "1.0.0-beta.2",
+                   "1.0.0-beta.11", "1.0.0-rc.1", "1.0.0", "2.0.0", "2.1.0", "2.1.1"]
+        shuffled = ordered.copy()
+        self.rng.shuffle(shuffled)
+        self.assertListEqual([str(v) for v in sort_versions(shuffled)], ordered)
+
+    def test_round_trip(self):
+        for v in self.versions:
+            self.assertEqual(str(parse_semver(v)), v)
+            self.assertIs(parse_semver(v), parse_semver(v))
+
+    def test_total_order(self):
+        """
+        exactly one of `<`, `==`, `>` holds, and the order agrees with `semver_lg`
+        """
+        parsed = [parse_semver(v) for v in self.versions]
+        for a, b in zip(parsed, reversed(parsed)):
+            self.assertEqual((a < b) + (a == b) + (a > b), 1)
+            self.assertEqual(a <= b, not a > b)
+            self.assertEqual(a > b, semver_lg(semver_format(str(a)), semver_format(str(b))))
+            if a == b:
+                self.assertEqual(hash(a), hash(b))
+
+    def test_sorting_is_transitive(self):
+        ordered = sort_versions(self.versions)
+        for a, b in zip(ordered, ordered[1:]):
+            self.assertLessEqual(a, b)
+        self.assertListEqual(ordered, sort_versions(sorted(self.versions)))
+
+    def test_build_metadata_ignored(self):
+        self.assertEqual(SemVer.parse("1.0.0+hello"), SemVer.parse("1.0.0"))
+        self.assertEqual(len({SemVer.parse("1.0.0+a"), SemVer.parse("1.0.0+b")}), 1)
+
+    def test_satisfies_agrees_with_check_version_is_req(self):
+        for _ in range(self.EXAMPLES):
+            a, b, c = (random_version(self.rng) for _ in range(3))
+            req = f"{self.rng.choice(['>', '>=', '<', '<=', '==', '!='])}{a}, " \
+                  f"{self.rng.choice(['>', '>=', '<', '<=', '==', '!='])}{b}"
+            constraint = VersionConstraint.parse(req)
+            self.assertEqual(satisfies(c, req), check_version_is_req_list(check_version_req_format(req), c))
+            self.assertEqual(satisfies(c, req), satisfies(parse_semver(c), constraint))
+            self.assertEqual(satisfies(c, req), not constraint.unsatisfied(parse_semver(c)))
+        self.assertTrue(satisfies("0.0.1", ""))
+        with self.assertRaises(ConfigParseError):
+            satisfies("0.0.1", "~0.0.1")
+
+    def test_best_match(self):
+        for _ in range(50):
+            req = f">={random_version(self.rng)}"
+            matched = [v for v in sort_versions(self.versions) if satisfies(v, req)]
+            best = best_match(self.versions, req)
+            self.assertEqual(best, matched[-1] if matched else None)
+
+    def test_benchmark(self):
+        """
+        compare checking a requirement with strings and with the memoized `satisfies`
+        """
+        reqs = [f">={random_version(self.rng)}, !={random_version(self.rng)}" for _ in range(20)]
+        candidates = self.versions[:100]
+        start = time.perf_counter()
+        old = [check_version_is_req_list(check_version_req_format(r), v) for r in reqs for v in candidates]
+        t_old = time.perf_counter() - start
+        start = time.perf_counter()
+        new = [satisfies(v, r) for r in reqs for v in candidates]
+        t_new = time.perf_counter() - start
+        self.assertListEqual(old, new)
+        start = time.perf_counter()
+        for _ in range(10):
+            for r in reqs:
+                best_match(candidates, r)
+        t_best = time.perf_counter() - start
+        self.assertLess(t_new, t_old)
+        self.assertLess(t_best, 1.0)
+
 
 if __name__ == "__main__":
     unittest.main()
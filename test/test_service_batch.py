@@ -0,0 +1,142 @@
+"""
+Test starting and stopping all services concurrently.
+"""
+from wg_config_manager import load_plugin as lp
+from wg_config_manager.errors import PluginRuntimeError
+
+import sys
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from configparser import ConfigParser
+from unittest import main, TestCase
+from unittest.mock import patch
+
+WORKERS = 16
+PLUGIN_SOURCE = '''
+import sys
+import subprocess
+from wg_config_manager.load_plugin import FunctionParameter, ServiceSelfObject
+
+STARTED = []
+STOPPED = []
+CHILD = """
+import sys, time, signal
+if sys.argv[1] == "ignore":
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+elif sys.argv[1]:
+    # exit after a slow cleanup
+    signal.signal(signal.SIGTERM, lambda *_: (time.sleep(float(sys.argv[1])), sys.exit(0)))
+print("ready", flush=True)
+time.sleep(60)
+"""
+
+
+class FakeService:
+    def __init__(self, name, ignore_term):
+        STARTED.append(name)
+        self.name = name
+        self.process = subprocess.Popen([sys.executable, "-c", CHILD, ignore_term], stdout=subprocess.PIPE)
+        self.process.stdout.readline()  # the signal handler is set
+
+    def down(self):
+        STOPPED.append(self.name)
+        self.process.wait()
+        self.process.stdout.close()
+
+
+def declare(name, ignore_term="", **kwargs):
+    parameters = [FunctionParameter(name="name", default=name),
+                  FunctionParameter(name="ignore_term", default=ignore_term)]
+    return dict(new=[FakeService, parameters], teardown=[FakeService.down, [ServiceSelfObject]], **kwargs)
+
+
+VERSION_REQ = ""
+BACKGROUND_SERVICE_db = declare("db")
+BACKGROUND_SERVICE_app = declare("app", depends=["db"])
+BACKGROUND_SERVICE_web = declare("web", depends=["app"])
+BACKGROUND_SERVICE_stubborn = declare("stubborn", "ignore")
+BACKGROUND_SERVICE_manual = declare("manual", autostart=False)
+BACKGROUND_SERVICE_slow_base = declare("slow_base", "0.3", autostart=False)
+BACKGROUND_SERVICE_slow_top = declare("slow_top", "ignore", depends=["slow_base"], autostart=False)
+''' + "\n".join(f'BACKGROUND_SERVICE_worker_{i} = declare("worker_{i}")' for i in range(WORKERS))
+
+
+class TestServiceBatch(TestCase):
+    def setUp(self):
+        self._tmp = TemporaryDirectory()
+        directory = Path(self._tmp.name) / "batch_plugins"
+        directory.mkdir()
+        with open(directory / "fake.py", "w", encoding="utf-8") as fp:
+            fp.write(PLUGIN_SOURCE)
+        self.supervisor = lp.ServiceSupervisor()
+        self.module = lp.load_plugin_module(str(directory), "fake")
+        self.plugin = lp.LoadPluginModule(self.module, ConfigParser(), supervisor=self.supervisor)
+        self.plugins = {"fake": self.plugin}
+
+    def test_failed_watch(self):
+        """
+        a service is not kept when the supervisor can't watch it, and the name can be used again
+        """
+        with patch.object(self.supervisor, "watch", side_effect=RuntimeError("no watch")):
+            with self.assertRaises(RuntimeError):
+                self.plugin.run_service("manual", "manual")
+        self.assertNotIn("manual", self.plugin.list_running_services())
+        self.assertListEqual(self.module.STOPPED, ["manual"])
+        self.plugin.run_service("manual", "manual")
+        self.assertIsNotNone(self.supervisor.get("fake/manual"))
+
+    def test_dependency_levels(self):
+        levels = lp.get_service_dependency_levels(self.plugins, ["fake/web"])
+        self.assertListEqual(levels, [["fake/db"], ["fake/app"], ["fake/web"]])
+        self.module.BACKGROUND_SERVICE_db["depends"] = ["web"]
+        self.plugin._services_index_cache = None
+        with self.assertRaises(PluginRuntimeError):
+            lp.get_service_dependency_levels(self.plugins)
+
+    def test_start_and_stop_all(self):
+        report = lp.start_all(self.plugins)
+        self.assertDictEqual(report.failed, {})
+        self.assertNotIn("manual", self.plugin.list_running_services())
+        started = self.module.STARTED
+        self.assertLess(started.index("db"), started.index("app"))
+        self.assertLess(started.index("app"), started.index("web"))
+        self.assertEqual(len(self.supervisor.keys()), WORKERS + 4)
+
+        report = lp.stop_all(self.plugins, timeout=1.0)
+        self.assertDictEqual(report.failed, {})
+        self.assertListEqual(report.killed, ["fake/stubborn"])
+        self.assertLess(report.elapsed, 1.0 + 2.0)  # not one deadline per service
+        stopped = self.module.STOPPED
+        self.assertLess(stopped.index("web"), stopped.index("app"))
+        self.assertLess(stopped.index("app"), stopped.index("db"))
+        self.assertListEqual(self.plugin.list_running_services(), [])
+        self.assertListEqual(self.supervisor.keys(), [])
+
+    def test_slow_first_stage(self):
+        report = lp.start_all(self.plugins, ["fake/slow_top"])
+        self.assertListEqual(report.done, ["fake/slow_base", "fake/slow_top"])
+        # slow_top uses up the deadline, slow_base still gets its share to exit by SIGTERM
+        report = lp.stop_all(self.plugins, timeout=1.0)
+        self.assertDictEqual(report.failed, {})
+        self.assertListEqual(report.killed, ["fake/slow_top"])
+        self.assertListEqual(report.done, ["fake/slow_top", "fake/slow_base"])
+        self.assertLess(report.elapsed, 1.0 + 1.0)
+
+    def test_terminate_process(self):
+        import subprocess
+        process = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+        start = time.monotonic()
+        self.assertFalse(lp.terminate_process(process, 5))
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertFalse(lp.terminate_process(process, 5))  # exited
+
+    def tearDown(self):
+        lp.stop_all(self.plugins, timeout=0)
+        self.supervisor.shutdown()
+        sys.modules.pop("batch_plugins.fake", None)
+        self._tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
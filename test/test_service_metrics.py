@@ -0,0 +1,122 @@
+"""
+Test runtime metrics of services.
+"""
+from wg_config_manager import load_plugin as lp
+from wg_config_manager import service_metrics as sm
+
+import sys
+import time
+import subprocess
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from configparser import ConfigParser
+from unittest import main, TestCase, skipUnless
+
+BUSY_CHILD = "import time\nend = time.time() + 0.3\nwhile time.time() < end: pass\ntime.sleep(60)"
+PLUGIN_SOURCE = f'''
+import sys
+import subprocess
+from wg_config_manager.load_plugin import FunctionParameter, ServiceSelfObject
+
+
+class BusyService:
+    def __init__(self, crash):
+        code = "import sys; sys.exit(7)" if crash else {BUSY_CHILD!r}
+        self.process = subprocess.Popen([sys.executable, "-c", code])
+
+    def respawn(self):
+        self.process = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+        return self.process
+
+    def down(self):
+        self.process.kill()
+        self.process.wait()
+
+
+VERSION_REQ = ""
+BACKGROUND_SERVICE_busy = {{"new": [BusyService, [FunctionParameter("crash", default="", before_pass=bool)]],
+                           "teardown": [BusyService.down, [ServiceSelfObject]]}}
+'''
+
+
+class TestServiceMetrics(TestCase):
+    def setUp(self):
+        self._tmp = TemporaryDirectory()
+        directory = Path(self._tmp.name) / "metrics_plugins"
+        directory.mkdir()
+        with open(directory / "busy.py", "w", encoding="utf-8") as fp:
+            fp.write(PLUGIN_SOURCE)
+        self.supervisor = lp.ServiceSupervisor(backoff_base=0.01, jitter=0)
+        self.plugin = lp.LoadPluginModule(lp.load_plugin_module(str(directory), "busy"), ConfigParser(),
+                                          supervisor=self.supervisor)
+
+    @skipUnless(Path("/proc/self/stat").is_file(), "needs /proc")
+    def test_sample_cpu_and_rss(self):
+        self.plugin.run_service("busy", "busy 0")
+        time.sleep(0.4)
+        self.supervisor.sample()
+        stats = self.plugin.get_service_stats(history=True)["busy/busy 0"]
+        self.assertEqual(stats["service"], "busy")
+        self.assertGreater(stats["cpu_seconds"], 0.1)
+        self.assertGreater(stats["rss_bytes"], 1024 * 1024)
+        self.assertIsNotNone(stats["cpu_percent"])
+        self.assertEqual(len(stats["history"]), 2)
+        self.assertEqual(stats["restarts"], 0)
+
+    def test_restarts_and_exit_code(self):
+        self.plugin.run_service("busy", "crash", crash="1")
+        deadline = time.monotonic() + 5
+        while self.supervisor.get("busy/crash").restarts < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        stats = self.plugin.get_service_stats(history=True)["busy/crash"]
+        self.assertEqual(stats["restarts"], 1)
+        self.assertEqual(stats["last_exit_code"], 7)
+        self.assertIsNotNone(stats["pid"])
+        if Path("/proc/self/stat").is_file():
+            # the samples of the crashed process are kept
+            self.assertEqual(len({i[3] for i in stats["history"]}), 2)
+            self.assertIsNone(self.supervisor.get("busy/crash").stats.cpu_percent)
+        self.supervisor.get("busy/crash").stats.reset()
+        self.assertListEqual(self.plugin.get_service_stats(history=True)["busy/crash"]["history"], [])
+
+    def test_textfile(self):
+        self.plugin.run_service("busy", "busy 0")
+        path = Path(self._tmp.name) / "services.prom"
+        self.plugin.export_service_stats(path)
+        text = path.read_text(encoding="utf-8")
+        self.assertIn("# TYPE wg_config_manager_service_restarts_total counter", text)
+        self.assertIn('wg_config_manager_service_restarts_total{plugin="busy",process="busy 0"} 0', text)
+
+    def test_percentile(self):
+        values = [i / 100 for i in range(1, 101)]
+        self.assertEqual(sm.percentile(values, 50), 0.5)
+        self.assertEqual(sm.percentile(values, 95), 0.95)
+        self.assertIsNone(sm.percentile([], 50))
+
+    @skipUnless(Path("/proc/self/stat").is_file(), "needs /proc")
+    def test_sampling_overhead(self):
+        """
+        sampling dozens of services costs a negligible time
+        """
+        processes = [subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"]) for _ in range(50)]
+        stats = [sm.ServiceStats(f"p/{i}", pid=p.pid) for i, p in enumerate(processes)]
+        start = time.perf_counter()
+        for _ in range(20):
+            for s in stats:
+                s.sample()
+        elapsed = (time.perf_counter() - start) / 20
+        self.assertLess(elapsed, 0.05)
+        self.assertTrue(all(len(s.history) == 20 for s in stats))
+        for p in processes:
+            p.kill()
+            p.wait()
+
+    def tearDown(self):
+        lp.stop_all({"busy": self.plugin}, timeout=0)
+        self.supervisor.shutdown()
+        sys.modules.pop("metrics_plugins.busy", None)
+        self._tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
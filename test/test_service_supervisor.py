@@ -0,0 +1,132 @@
+"""
+Test the shared service supervisor with a fake crashing child.
+"""
+from wg_config_manager import load_plugin as lp
+
+import os
+import sys
+import time
+import threading
+import subprocess
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from configparser import ConfigParser
+from unittest import main, TestCase
+
+FAKE_CHILD = f'''#!{sys.executable}
+import sys, time
+with open(sys.argv[0] + ".starts", "a") as fp:
+    fp.write("start\\n")
+time.sleep(float(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1] != "run" else 0.05)
+sys.exit(3)
+'''
+
+
+def write_fake_child(directory: Path) -> Path:
+    """
+    write an executable which exits with code 3 soon, and counts the starts at `{path}.starts`
+    """
+    path = directory / "fake-child"
+    with open(path, "w", encoding="utf-8") as fp:
+        fp.write(FAKE_CHILD)
+    os.chmod(path, 0o755)
+    return path
+
+
+def count_starts(child: Path) -> int:
+    try:
+        with open(f"{child}.starts", "r", encoding="utf-8") as fp:
+            return len(fp.readlines())
+    except FileNotFoundError:
+        return 0
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class CrashingService:
+    def __init__(self, child: Path, lifetime: str = "0.05"):
+        self.args = [str(child), lifetime]
+        self.spawn_times = []
+        self.process = self.respawn()
+
+    def respawn(self):
+        self.spawn_times.append(time.monotonic())
+        self.process = subprocess.Popen(self.args)
+        return self.process
+
+    def down(self):
+        self.process.kill()
+        self.process.wait()
+
+
+class TestServiceSupervisor(TestCase):
+    def setUp(self):
+        self._tmp = TemporaryDirectory()
+        self.child = write_fake_child(Path(self._tmp.name))
+        self.supervisor = lp.ServiceSupervisor(backoff_base=0.05, backoff_max=0.4, jitter=0.1, stable_time=10)
+
+    def test_restart_with_backoff(self):
+        """
+        a crashed child is restarted soon, and the delay grows exponentially
+        """
+        service = CrashingService(self.child)
+        self.supervisor.watch("crash", service)
+        self.assertTrue(wait_until(lambda: len(service.spawn_times) >= 5))
+        record = self.supervisor.unwatch("crash")
+        self.assertEqual(record.last_exit_code, 3)
+        self.assertGreaterEqual(record.restarts, 4)
+        gaps = [b - a for a, b in zip(service.spawn_times, service.spawn_times[1:])]
+        self.assertLess(gaps[0], 0.5)  # not the old 60 seconds poll
+        self.assertGreater(gaps[3], gaps[0])
+        # unwatched, no more restarts
+        count = len(service.spawn_times)
+        time.sleep(0.6)
+        self.assertEqual(len(service.spawn_times), count)
+        service.down()
+
+    def test_backoff_reset_and_limit(self):
+        for failures in range(1, 12):
+            delay = self.supervisor.get_backoff(failures)
+            self.assertLessEqual(delay, 0.4 * 1.1)
+            self.assertGreaterEqual(delay, min(0.4, 0.05 * 2 ** (failures - 1)) * 0.9)
+
+    def test_one_thread_for_many_services(self):
+        services = [CrashingService(self.child, "30") for _ in range(10)]
+        self.supervisor.watch("first", services[0])
+        threads = threading.active_count()
+        for i, service in enumerate(services[1:]):
+            self.supervisor.watch(f"service {i}", service)
+        self.assertEqual(threading.active_count(), threads)
+        for key in self.supervisor.keys():
+            self.supervisor.unwatch(key)
+        for service in services:
+            service.down()
+
+    def test_v2ray_service(self):
+        """
+        `run_service` hands the v2ray process to the supervisor, and `stop_service` takes it back
+        """
+        loader = lp.LoadPluginModule(lp.load_plugin_module("{APP_DIR}/v2ray", "v2ray"), ConfigParser(),
+                                     supervisor=self.supervisor)
+        service = loader.run_service("v2ray", "fake v2ray", v2ray_path=str(self.child), config_path="config.json")
+        self.assertIsNotNone(self.supervisor.get("v2ray/fake v2ray"))
+        self.assertTrue(wait_until(lambda: count_starts(self.child) >= 3))
+        self.assertGreaterEqual(self.supervisor.get("v2ray/fake v2ray").restarts, 2)
+        loader.stop_service("fake v2ray")
+        self.assertIsNone(self.supervisor.get("v2ray/fake v2ray"))
+        self.assertIsNone(service.returned.process)
+
+    def tearDown(self):
+        self.supervisor.shutdown()
+        self._tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""
+Test the file locks, the versioned writes and concurrent updates of a config by many processes.
+"""
+from wg_config_manager import storage
+from wg_config_manager.errors import StorageConflictError, StorageLockError
+
+import os
+import time
+import threading
+import multiprocessing
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from configparser import ConfigParser
+from unittest import main, skipUnless, TestCase
+
+PROCESSES = 8
+UPDATES = 40
+
+
+def increment(path: str, worker: int, n: int):
+    """
+    increment a counter and add an option per update, by `update_config`
+    """
+    for i in range(n):
+        def update(parser):
+            if not parser.has_section("counter"):
+                parser.add_section("counter")
+            parser.set("counter", "value", str(parser.getint("counter", "value", fallback=0) + 1))
+            parser.set("counter", f"worker {worker} update {i}", "done")
+
+        storage.update_config(path, update, retries=1000)
+
+
+def increment_unlocked(path: str, worker: int, n: int):
+    """
+    the same read-modify-write without locks and versions
+    """
+    for _ in range(n):
+        while True:
+            parser = ConfigParser()
+            parser.read(path, encoding="utf-8")
+            if parser.has_section("counter"):
+                break
+        parser.set("counter", "value", str(parser.getint("counter", "value") + 1))
+        storage.write_file_atomic(path, storage._dump_parser(parser))
+
+
+def read_loop(path: str, seconds: float) -> tuple[int, int]:
+    """
+    read the counter until `seconds` pass, return the reads and the values going backwards
+    """
+    reads = backwards = last = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        data, _ = storage.read_versioned(path)
+        parser = ConfigParser()
+        parser.read_string(data.decode("utf-8"))
+        value = parser.getint("counter", "value", fallback=0)
+        backwards += value < last
+        last = value
+        reads += 1
+    return reads, backwards
+
+
+class TestStorage(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.path = str(Path(self.directory.name, "config.ini"))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_versioned(self):
+        self.assertTupleEqual(storage.read_versioned(self.path), (b"", None))
+        version = storage.write_versioned(self.path, b"[a]\n", None)
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+        self.assertEqual(storage.read_versioned(self.path), (b"[a]\n", version))
+        with self.assertRaises(StorageConflictError):
+            storage.write_versioned(self.path, b"[b]\n", None)
+        storage.write_versioned(self.path, b"[b]\n", version)
+        # a stale version, the file keeps the newer content
+        with self.assertRaises(StorageConflictError):
+            storage.write_versioned(self.path, b"[c]\n", version)
+        self.assertEqual(Path(self.path).read_bytes(), b"[b]\n")
+        self.assertListEqual(sorted(os.listdir(self.directory.name)), [".config.ini.lock", "config.ini"])
+
+    def test_update_retries(self):
+        storage.write_versioned(self.path, b"[a]\nn = 0\n", None)
+        calls = []
+
+        def update(parser):
+            calls.append(parser.get("a", "n"))
+            if len(calls) == 1:
+                # another writer wins the race
+                storage.write_versioned(self.path, b"[a]\nn = 1\n", storage.read_versioned(self.path)[1])
+            parser.set("a", "n", str(int(parser.get("a", "n")) + 10))
+
+        self.assertEqual(storage.update_config(self.path, update).get("a", "n"), "11")
+        self.assertListEqual(calls, ["0", "1"])
+
+        def update(parser):
+            storage.write_versioned(self.path, os.urandom(8).hex().encode(), storage.read_versioned(self.path)[1])
+
+        with self.assertRaises(StorageConflictError):
+            storage.update_config(self.path, update, read=lambda _: ConfigParser(), retries=2)
+
+    def test_locks(self):
+        with storage.file_lock(self.path, exclusive=False):
+            # shared locks don't block each other, even in one process
+            with storage.file_lock(self.path, exclusive=False, timeout=0):
+                pass
+            with self.assertRaises(StorageLockError):
+                with storage.file_lock(self.path, timeout=0.05):
+                    pass
+        with storage.file_lock(self.path):
+            with self.assertRaises(StorageLockError):
+                storage.read_versioned(self.path, timeout=0.05)
+            # a waiting reader gets the lock once the writer is done
+            result = []
+            reader = threading.Thread(target=lambda: result.append(storage.read_versioned(self.path, timeout=5)))
+            reader.start()
+            time.sleep(0.1)
+            self.assertListEqual(result, [])
+        reader.join(5)
+        self.assertListEqual(result, [(b"", None)])
+
+    def test_config_file(self):
+        config_dir, config_file = storage.PathMap.CONFIG_DIR, storage.PathMap.CONFIG_FILE
+        storage.PathMap.CONFIG_DIR = Path(self.directory.name, "app")
+        storage.PathMap.CONFIG_FILE = storage.PathMap.CONFIG_DIR / "config.ini"
+        try:
+            parsers = []
+            threads = [threading.Thread(target=lambda: parsers.append(storage.get_parser_from_config()))
+                       for _ in range(8)]
+            for i in threads:
+                i.start()
+            for i in threads:
+                i.join()
+            default = ConfigParser(allow_no_value=True)
+            default.read(storage.DEFAULT_CONFIG_PATH, encoding="utf-8")
+            self.assertTrue(all(i.sections() == default.sections() for i in parsers))
+            path = storage.PathMap.CONFIG_FILE
+            os.chmod(path, 0o640)
+            parser = storage.get_parser_from_config()
+            parser.add_section("extra")
+            storage.dump_parser_to_config(parser, str(path))
+            self.assertIn("extra", storage.get_parser_from_config().sections())
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+        finally:
+            storage.PathMap.CONFIG_DIR, storage.PathMap.CONFIG_FILE = config_dir, config_file
+
+    @skipUnless(storage.fcntl is not None, "fcntl locks")
+    def test_stress(self):
+        """
+        many processes increment one counter while others read it, no update is lost
+        """
+        storage.write_versioned(self.path, b"[counter]\nvalue = 0\n", None)
+        context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else None)
+        with context.Pool(PROCESSES + 2) as pool:
+            readers = [pool.apply_async(read_loop, (self.path, 1.0)) for _ in range(2)]
+            writers = [pool.apply_async(increment, (self.path, i, UPDATES)) for i in range(PROCESSES)]
+            for i in writers:
+                i.get(120)
+            reads = [i.get(120) for i in readers]
+        parser = ConfigParser()
+        parser.read(self.path, encoding="utf-8")
+        self.assertEqual(parser.getint("counter", "value"), PROCESSES * UPDATES)
+        self.assertEqual(len(parser.options("counter")), PROCESSES * UPDATES + 1)
+        self.assertListEqual([i[1] for i in reads], [0, 0])
+        self.assertTrue(all(i[0] > 0 for i in reads))
+
+        # without the locks and versions, concurrent updates are lost
+        storage.write_versioned(self.path, b"[counter]\nvalue = 0\n", storage.read_versioned(self.path)[1])
+        with context.Pool(PROCESSES) as pool:
+            for i in [pool.apply_async(increment_unlocked, (self.path, i, UPDATES)) for i in range(PROCESSES)]:
+                i.get(120)
+        parser = ConfigParser()
+        parser.read(self.path, encoding="utf-8")
+        self.assertLessEqual(parser.getint("counter", "value"), PROCESSES * UPDATES)
+
+    def test_read_benchmark(self):
+        """
+        the cost of the shared lock for a reader
+        """
+        storage.write_versioned(self.path, Path(storage.DEFAULT_CONFIG_PATH).read_bytes(), None)
+        n = 2000
+        start = time.perf_counter()
+        for _ in range(n):
+            with open(self.path, "rb") as fp:
+                fp.read()
+        plain = (time.perf_counter() - start) / n
+        start = time.perf_counter()
+        for _ in range(n):
+            storage.read_versioned(self.path)
+        locked = (time.perf_counter() - start) / n
+        self.assertLess(locked, plain + 0.001)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Test the multi-instance v2ray pool with a fake v2ray binary.
+"""
+from wg_config_manager import load_plugin as lp
+
+import os
+import sys
+import json
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from configparser import ConfigParser
+from unittest import main, TestCase
+
+# a thread starts at once, like the Go runtime
+FAKE_V2RAY = (f"#!{sys.executable}\nimport time, threading\n"
+              "threading.Thread(target=time.sleep, args=(60,), daemon=True).start()\ntime.sleep(60)\n")
+
+
+class TestV2rayPool(TestCase):
+    def setUp(self):
+        self._tmp = TemporaryDirectory()
+        directory = Path(self._tmp.name)
+        self.v2ray_path = directory / "fake-v2ray"
+        with open(self.v2ray_path, "w", encoding="utf-8") as fp:
+            fp.write(FAKE_V2RAY)
+        os.chmod(self.v2ray_path, 0o755)
+        self.template_path = directory / "template.json"
+        with open(self.template_path, "w", encoding="utf-8") as fp:
+            json.dump({"inbounds": [{"port": 10000, "protocol": "vless"}, {"port": "env:PORT"}]}, fp)
+        self.work_dir = directory / "pool"
+        self.supervisor = lp.ServiceSupervisor(backoff_base=0.01, jitter=0)
+        self.loader = lp.LoadPluginModule(lp.load_plugin_module("{APP_DIR}/v2ray", "v2ray"), ConfigParser(),
+                                          supervisor=self.supervisor)
+
+    def run_pool(self, instances: int, **kwargs):
+        return self.loader.run_service("v2ray_pool", "pool", v2ray_path=str(self.v2ray_path),
+                                       template_path=str(self.template_path), work_dir=str(self.work_dir),
+                                       instances=str(instances), **kwargs).returned
+
+    def pids(self, pool) -> dict[int, int]:
+        return {i: s.process.pid for i, s in pool.instances.items()}
+
+    def test_configs_and_scale(self):
+        pool = self.run_pool(3, port_stride="10")
+        for i in range(3):
+            with open(self.work_dir / f"instance-{i}.json", "r", encoding="utf-8") as fp:
+                config = json.load(fp)
+            self.assertEqual(config["inbounds"][0]["port"], 10000 + i * 10)
+            self.assertEqual(config["inbounds"][1]["port"], "env:PORT")
+        self.assertListEqual(sorted(self.supervisor.keys()), [f"v2ray/pool#{i}" for i in range(3)])
+        before = self.pids(pool)
+        # scale up, the running instances are not restarted
+        self.loader.call_service("scale", "pool", instances="5")
+        after = self.pids(pool)
+        self.assertEqual(len(after), 5)
+        self.assertDictEqual({i: after[i] for i in before}, before)
+        # scale down
+        removed = pool.instances[4].process
+        self.loader.call_service("scale", "pool", instances="2", timeout="1")
+        self.assertDictEqual(self.pids(pool), {i: before[i] for i in range(2)})
+        self.assertIsNotNone(removed.poll())
+        self.assertEqual(len(self.supervisor.keys()), 2)
+        self.assertIn("v2ray/pool#1", self.loader.get_service_stats())
+
+    def test_restart_one_instance(self):
+        pool = self.run_pool(3)
+        before = self.pids(pool)
+        pool.instances[1].process.kill()
+        deadline = time.monotonic() + 5
+        while self.supervisor.get("v2ray/pool#1").restarts < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        after = self.pids(pool)
+        self.assertNotEqual(after[1], before[1])
+        self.assertEqual((after[0], after[2]), (before[0], before[2]))
+
+    def test_reuse_port_and_cpus(self):
+        pool = self.run_pool(2, reuse_port="true", cpus="0")
+        self.assertEqual(pool.instance_config(1)["inbounds"][0]["port"], 10000)
+        if hasattr(os, "sched_getaffinity"):
+            for instance in pool.instances.values():
+                deadline = time.monotonic() + 5
+                while len(os.listdir(f"/proc/{instance.process.pid}/task")) < 2 and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                threads = os.listdir(f"/proc/{instance.process.pid}/task")
+                self.assertEqual(len(threads), 2)
+                # the pid is v2ray itself after the exec
+                self.assertNotIn(b"sched_setaffinity", Path(f"/proc/{instance.process.pid}/cmdline").read_bytes())
+                for tid in threads:
+                    self.assertSetEqual(os.sched_getaffinity(int(tid)), {0})
+        self.loader.stop_service("pool")
+        pool = self.run_pool(2, reuse_port="0")
+        self.assertEqual(pool.instance_config(1)["inbounds"][0]["port"], 10001)
+        with self.assertRaises(ValueError):
+            self.loader.stop_service("pool")
+            self.run_pool(2, reuse_port="maybe")
+
+    def test_str2bool(self):
+        for value in ("1", "yes", "True", " on ", True):
+            self.assertIs(lp.str2bool(value), True)
+        for value in ("", "0", "no", "false", "OFF", False):
+            self.assertIs(lp.str2bool(value), False)
+        with self.assertRaises(ValueError):
+            lp.str2bool("2")
+
+    def test_stop_all_deadline(self):
+        """
+        the pool's teardown gets the rest of the stop_all deadline, not its own 10 s
+        """
+        stubborn = self.v2ray_path.with_name("stubborn-v2ray")
+        with open(stubborn, "w", encoding="utf-8") as fp:
+            fp.write(f"#!{sys.executable}\nimport time, signal\nsignal.signal(signal.SIGTERM, signal.SIG_IGN)\n"
+                     "print(flush=True)\ntime.sleep(60)\n")
+        os.chmod(stubborn, 0o755)
+        self.v2ray_path = stubborn
+        pool = self.run_pool(2)
+        time.sleep(0.3)  # the signal handlers are set
+        processes = [s.process for s in pool.instances.values()]
+        report = lp.stop_all({"v2ray": self.loader}, timeout=0.5)
+        self.assertLess(report.elapsed, 3)
+        self.assertDictEqual(report.failed, {})
+        self.assertTrue(all(p.poll() is not None for p in processes))
+
+    def test_stop(self):
+        pool = self.run_pool(3)
+        processes = [s.process for s in pool.instances.values()]
+        self.loader.stop_service("pool", timeout="1")
+        self.assertTrue(all(p.poll() is not None for p in processes))
+        self.assertListEqual(self.supervisor.keys(), [])
+
+    def tearDown(self):
+        lp.stop_all({"v2ray": self.loader}, timeout=0)
+        self.supervisor.shutdown()
+        self._tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Test health probes of the v2ray plugin with local fake listeners.
+"""
+from wg_config_manager import load_plugin as lp
+
+import gc
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import warnings
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from configparser import ConfigParser
+from unittest import main, TestCase
+
+v2ray = lp.load_plugin_module("{APP_DIR}/v2ray", "v2ray")
+
+FAKE_V2RAY = f"#!{sys.executable}\nimport time\ntime.sleep(60)\n"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def fake_socks5(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """
+    a minimal SOCKS5 server supports CONNECT by domain name
+    """
+    await reader.readexactly(3)
+    writer.write(b"\x05\x00")
+    _, cmd, _, atyp = await reader.readexactly(4)
+    host = (await reader.readexactly((await reader.readexactly(1))[0])).decode()
+    port = int.from_bytes(await reader.readexactly(2), "big")
+    up_reader, up_writer = await asyncio.open_connection(host, port)
+    writer.write(b"\x05\x00\x00\x01" + bytes(4) + bytes(2))
+
+    async def pipe(src, dst):
+        while data := await src.read(4096):
+            dst.write(data)
+        dst.close()
+
+    await asyncio.gather(pipe(reader, up_writer), pipe(up_reader, writer))
+
+
+class TestProbes(TestCase):
+    def test_tcp_probe(self):
+        listener = socket.create_server(("127.0.0.1", 0))
+        port = listener.getsockname()[1]
+        monitor = v2ray.HealthMonitor([v2ray.TcpProbe("127.0.0.1", port)], timeout=1)
+        self.assertIsNotNone(asyncio.run(monitor.probe_once()))
+        listener.close()
+        self.assertIsNone(asyncio.run(monitor.probe_once()))
+        self.assertEqual(len(monitor.latencies[f"tcp 127.0.0.1:{port}"]), 1)
+
+    def test_proxy_echo_probe(self):
+        async def run():
+            proxy = await asyncio.start_server(fake_socks5, "127.0.0.1", 0)
+            echo = await v2ray.start_echo_server()
+            probe = v2ray.ProxyEchoProbe(*proxy.sockets[0].getsockname()[:2], *echo.sockets[0].getsockname()[:2])
+            monitor = v2ray.HealthMonitor([probe], timeout=1)
+            ok = [await monitor.probe_once() for _ in range(20)]
+            echo.close()
+            await echo.wait_closed()
+            failed = await monitor.probe_once()
+            proxy.close()
+            return ok, failed, monitor.get_latency_percentiles()[probe.name]
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always", ResourceWarning)
+            ok, failed, percentiles = asyncio.run(run())
+            gc.collect()
+        self.assertTrue(all(i is not None for i in ok))
+        self.assertIsNone(failed)
+        self.assertLessEqual(percentiles["p50"], percentiles["p99"])
+        # the probe connections are closed, not left to the garbage collector
+        self.assertListEqual([str(i.message) for i in caught if "unclosed" in str(i.message)], [])
+
+    def test_read_inbounds(self):
+        inbounds = v2ray.read_inbounds(lp.PathMap.APP_DIR / ".." / "data" / "v2ray config example.json")
+        self.assertListEqual(inbounds, [("127.0.0.1", 51234, "vless")])
+
+
+class TestHealthMonitor(TestCase):
+    def setUp(self):
+        self._tmp = TemporaryDirectory()
+        directory = Path(self._tmp.name)
+        self.v2ray_path = directory / "fake-v2ray"
+        with open(self.v2ray_path, "w", encoding="utf-8") as fp:
+            fp.write(FAKE_V2RAY)
+        os.chmod(self.v2ray_path, 0o755)
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.config_path = directory / "config.json"
+        with open(self.config_path, "w", encoding="utf-8") as fp:
+            json.dump({"inbounds": [{"listen": "0.0.0.0", "port": self.listener.getsockname()[1],
+                                     "protocol": "vless"}]}, fp)
+        self.supervisor = lp.ServiceSupervisor(backoff_base=0.01, jitter=0)
+        self.loader = lp.LoadPluginModule(v2ray, ConfigParser(), supervisor=self.supervisor)
+
+    def test_restart_after_failures(self):
+        """
+        a running but wedged v2ray is restarted after K failed probes
+        """
+        self.loader.run_service("v2ray", "probed", v2ray_path=str(self.v2ray_path),
+                                config_path=str(self.config_path),
+                                probe_interval="0.02", probe_timeout="0.5", probe_failures="3")
+        record = self.supervisor.get("v2ray/probed")
+        deadline = time.monotonic() + 5
+        while len(record.stats.probes) < 5 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(record.restarts, 0)
+        stats = self.loader.get_service_stats()["v2ray/probed"]
+        self.assertIsNotNone(stats["probe_latency_p95"])
+        # stop forwarding
+        self.listener.close()
+        while record.restarts < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(record.restarts, 1)
+        self.assertGreaterEqual(record.stats.probe_failures, 3)
+
+    def tearDown(self):
+        self.listener.close()
+        lp.stop_all({"v2ray": self.loader}, timeout=0)
+        self.supervisor.shutdown()
+        self._tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+Test the hash-gated config reload of the v2ray plugin with a fake v2ray binary.
+"""
+from wg_config_manager import load_plugin as lp
+
+import os
+import sys
+import json
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from configparser import ConfigParser
+from unittest import main, TestCase
+
+v2ray = lp.load_plugin_module("{APP_DIR}/v2ray", "v2ray")
+
+FAKE_V2RAY = f"#!{sys.executable}\nimport time\ntime.sleep(60)\n"
+
+
+class TestConfigReload(TestCase):
+    def setUp(self):
+        self._tmp = TemporaryDirectory()
+        directory = Path(self._tmp.name)
+        self.v2ray_path = directory / "fake-v2ray"
+        with open(self.v2ray_path, "w", encoding="utf-8") as fp:
+            fp.write(FAKE_V2RAY)
+        os.chmod(self.v2ray_path, 0o755)
+        self.config_path = directory / "config.json"
+        self.config = {"log": {"loglevel": "warning"},
+                       "inbounds": [{"port": 10000, "protocol": "vless", "settings": {"clients": []}}]}
+        self.write(self.config)
+        self.supervisor = lp.ServiceSupervisor(backoff_base=0.01, jitter=0)
+        self.loader = lp.LoadPluginModule(v2ray, ConfigParser(), supervisor=self.supervisor)
+        self.service = self.loader.run_service("v2ray", "reload", v2ray_path=str(self.v2ray_path),
+                                               config_path=str(self.config_path), probe_interval="0",
+                                               reload_debounce="0.05", reload_overlap="0.05").returned
+        time.sleep(0.1)  # wait the watcher started
+
+    def write(self, config, **kwargs):
+        tmp = f"{self.config_path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as fp:
+            json.dump(config, fp, **kwargs)
+        os.replace(tmp, self.config_path)
+
+    def wait_reloads(self, n: int, timeout: float = 5.0):
+        deadline = time.monotonic() + timeout
+        while self.service.reloads < n and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_canonical_hash(self):
+        before = v2ray.canonical_config_hash(self.config_path)
+        self.write(dict(reversed(list(self.config.items()))), indent=4)
+        self.assertEqual(v2ray.canonical_config_hash(self.config_path), before)
+        with open(self.config_path, "w", encoding="utf-8") as fp:
+            fp.write("{")
+        self.assertIsNone(v2ray.canonical_config_hash(self.config_path))
+
+    def test_noop_rewrite(self):
+        """
+        rewriting the config with other white spaces and key order never restarts v2ray
+        """
+        pid = self.service.process.pid
+        for i in range(10):
+            self.write(dict(reversed(list(self.config.items()))) if i % 2 else self.config, indent=i)
+            time.sleep(0.02)
+        time.sleep(0.3)
+        self.assertEqual(self.service.reloads, 0)
+        self.assertEqual(self.service.process.pid, pid)
+        self.assertEqual(self.supervisor.get("v2ray/reload").restarts, 0)
+
+    def test_port_changed(self):
+        """
+        the new v2ray starts before the old one retires
+        """
+        old = self.service.process
+        # burst of writes is debounced into one reload
+        for port in (10001, 10002, 10003):
+            self.config["inbounds"][0]["port"] = port
+            self.write(self.config)
+        self.wait_reloads(1)
+        time.sleep(0.3)
+        self.assertEqual(self.service.reloads, 1)
+        self.assertSetEqual(self.service.inbound_ports, {10003})
+        self.assertIsNotNone(old.poll())
+        record = self.supervisor.get("v2ray/reload")
+        self.assertIs(record.process, self.service.process)
+        self.assertIsNone(self.service.process.poll())
+        self.assertEqual(record.restarts, 0)
+
+    def live_v2ray_pids(self) -> list[int]:
+        """
+        the running fake v2ray processes, zombies excluded
+        """
+        pids = []
+        for pid in filter(str.isdigit, os.listdir("/proc")):
+            try:
+                with open(f"/proc/{pid}/cmdline", "rb") as fp:
+                    cmdline = fp.read()
+                with open(f"/proc/{pid}/stat", "rb") as fp:
+                    state = fp.read().rpartition(b")")[2].split()[0]
+            except OSError:
+                continue
+            if os.fsencode(self.v2ray_path) in cmdline and state != b"Z":
+                pids.append(int(pid))
+        return pids
+
+    def test_same_port_changed(self):
+        old = self.service.process
+        self.config["log"]["loglevel"] = "debug"
+        self.write(self.config)
+        self.wait_reloads(1)
+        self.assertEqual(self.service.reloads, 1)
+        self.assertIsNotNone(old.poll())
+        self.assertIsNone(self.service.process.poll())
+        # the exit of the old process is not a failure, and nothing is respawned behind the reload
+        time.sleep(0.3)
+        record = self.supervisor.get("v2ray/reload")
+        self.assertIs(record.process, self.service.process)
+        self.assertEqual((record.failures, record.restarts, record.last_exit_code), (0, 0, None))
+        if os.path.isdir("/proc/self"):
+            self.assertListEqual(self.live_v2ray_pids(), [self.service.process.pid])
+        # the supervisor still restarts the new process
+        self.service.process.kill()
+        record = self.supervisor.get("v2ray/reload")
+        deadline = time.monotonic() + 5
+        while record.restarts < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(record.restarts, 1)
+
+    def test_watch_config_false(self):
+        service = self.loader.run_service("v2ray", "static", v2ray_path=str(self.v2ray_path),
+                                          config_path=str(self.config_path), probe_interval="0",
+                                          watch_config="false", reload_debounce="0.05").returned
+        self.assertFalse(service.watch_config)
+        self.config["log"]["loglevel"] = "debug"
+        self.write(self.config)
+        self.wait_reloads(1)
+        time.sleep(0.2)
+        self.assertEqual(service.reloads, 0)
+
+    def test_invalid_config(self):
+        pid = self.service.process.pid
+        with open(self.config_path, "w", encoding="utf-8") as fp:
+            fp.write('{"inbounds": [')
+        time.sleep(0.3)
+        self.assertEqual(self.service.reloads, 0)
+        self.assertEqual(self.service.process.pid, pid)
+
+    def test_down_twice(self):
+        """
+        stopping a stopped service is a no-op, and it's not started again
+        """
+        process = self.service.process
+        self.loader.stop_service("reload")
+        self.service.down()
+        self.service.health_check()
+        self.assertIsNone(self.service.process)
+        self.assertIsNotNone(process.poll())
+
+    def tearDown(self):
+        lp.stop_all({"v2ray": self.loader}, timeout=0)
+        self.supervisor.shutdown()
+        self._tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Test generating VLESS configs from the wireguard_core config.
+"""
+from wg_config_manager import vless
+from wg_config_manager.errors import WireguardConfError
+
+import os
+import json
+import time
+import uuid
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from configparser import ConfigParser
+from unittest import main, TestCase
+
+CONFIG = """
+[server]
+address = 10.0.0.1/24
+endpoint = wg.example.com:51820
+
+[pc-1]
+address = 10.0.0.2/32
+vless uuid = aaaaaaaa-bbbb-cccc-4444-eeeeeeeeeeee
+
+[pc-2]
+address = 10.0.0.3/32
+endpoint = [2001:db8::3]:51821
+vless local port = 50000
+"""
+
+
+def make_config(n: int) -> ConfigParser:
+    parser = ConfigParser()
+    parser.read_dict({"server": {"endpoint": "wg.example.com:51820"}})
+    parser.read_dict({f"pc-{i}": {"address": f"10.{i >> 16}.{i >> 8 & 255}.{i & 255}/32"} for i in range(n)})
+    return parser
+
+
+class TestVless(TestCase):
+    def setUp(self):
+        self._tmp = TemporaryDirectory()
+        self.out_dir = Path(self._tmp.name)
+        self.config = ConfigParser()
+        self.config.read_string(CONFIG)
+        self.server = vless.VlessServer("proxy.example.com")
+
+    def test_mappings(self):
+        mappings = vless.get_endpoint_mappings(self.config, local_port_base=40000)
+        self.assertListEqual(mappings, [vless.EndpointMapping("server", 40000, "wg.example.com", 51820),
+                                        vless.EndpointMapping("pc-2", 50000, "2001:db8::3", 51821)])
+        self.config.set("pc-1", "endpoint", "1.2.3.4:1")
+        self.config.set("pc-1", "vless local port", "50000")
+        with self.assertRaises(WireguardConfError):
+            vless.get_endpoint_mappings(self.config)
+
+    def test_generate(self):
+        written = vless.generate_configs(self.config, self.server, self.out_dir)
+        self.assertDictEqual(written, {"server.json": True, "clients/server.json": True,
+                                       "clients/pc-1.json": True, "clients/pc-2.json": True})
+        with open(self.out_dir / "server.json", "r", encoding="utf-8") as fp:
+            server = json.load(fp)
+        clients = server["inbounds"][0]["settings"]["clients"]
+        self.assertListEqual([c["email"] for c in clients], ["server", "pc-1", "pc-2"])
+        self.assertEqual(clients[1]["id"], "aaaaaaaa-bbbb-cccc-4444-eeeeeeeeeeee")
+        # the generated uuid is kept in the config
+        uuid.UUID(self.config.get("server", "vless uuid"))
+        self.assertEqual(self.config.get("server", "vless uuid is auto generated"), "True")
+        with open(self.out_dir / "clients" / "pc-1.json", "r", encoding="utf-8") as fp:
+            client = json.load(fp)
+        self.assertListEqual([(i["port"], i["settings"]["address"]) for i in client["inbounds"]],
+                             [(41820, "wg.example.com"), (50000, "2001:db8::3")])
+        self.assertEqual(client["outbounds"][0]["settings"]["vnext"][0]["users"][0]["id"], clients[1]["id"])
+        # no inbound to itself
+        with open(self.out_dir / "clients" / "pc-2.json", "r", encoding="utf-8") as fp:
+            self.assertEqual(len(json.load(fp)["inbounds"]), 1)
+
+    def test_skip_unchanged(self):
+        vless.generate_configs(self.config, self.server, self.out_dir)
+        mtime = os.stat(self.out_dir / "clients" / "pc-1.json").st_mtime_ns
+        written = vless.generate_configs(self.config, self.server, self.out_dir)
+        self.assertFalse(any(written.values()))
+        self.assertEqual(os.stat(self.out_dir / "clients" / "pc-1.json").st_mtime_ns, mtime)
+        self.assertListEqual(sorted(os.listdir(self.out_dir / "clients")), ["pc-1.json", "pc-2.json", "server.json"])
+        # only the configs referring the changed endpoint are rewritten
+        self.config.set("pc-2", "endpoint", "[2001:db8::3]:51822")
+        written = vless.generate_configs(self.config, self.server, self.out_dir)
+        self.assertDictEqual(written, {"server.json": False, "clients/server.json": True,
+                                       "clients/pc-1.json": True, "clients/pc-2.json": False})
+
+    def test_peers_and_shared_endpoints(self):
+        """
+        a client listens only for the endpoints of its peers, once per local port
+        """
+        config = ConfigParser()
+        config.read_dict({f"hub-{i}": {"endpoint": f"hub-{i}.example.com:51820"} for i in range(2)})
+        config.read_dict({"hub-alias": {"endpoint": "hub-0.example.com:51820"}})
+        config.read_dict({f"pc-{i}": {"endpoint": f"10.0.0.{i}:51820", "peers": "hub-0, hub-1, hub-alias"}
+                          for i in range(200)})
+        mappings = vless.get_endpoint_mappings(config, local_port_base=40000)
+        self.assertEqual(mappings[2], vless.EndpointMapping("hub-alias", 40000, "hub-0.example.com", 51820))
+        client = vless.get_client_config("pc-7", config, self.server, mappings)
+        self.assertListEqual([(i["tag"], i["port"]) for i in client["inbounds"]],
+                             [("wg-hub-0", 40000), ("wg-hub-1", 40001)])
+        # a hub without `peers` has all others
+        hub = vless.get_client_config("hub-1", config, self.server, mappings)
+        self.assertEqual(len(hub["inbounds"]), 1 + 200)
+        self.assertEqual(len({i["port"] for i in hub["inbounds"]}), len(hub["inbounds"]))
+
+    def test_benchmark(self):
+        """
+        10k clients
+        """
+        config = make_config(10000)
+        start = time.perf_counter()
+        written = vless.generate_configs(config, self.server, self.out_dir)
+        first = time.perf_counter() - start
+        self.assertEqual(len(written), 10002)
+        self.assertTrue(all(written.values()))
+        start = time.perf_counter()
+        written = vless.generate_configs(config, self.server, self.out_dir)
+        second = time.perf_counter() - start
+        self.assertFalse(any(written.values()))
+        self.assertLess(second, first * 2)
+        with open(self.out_dir / "server.json", "r", encoding="utf-8") as fp:
+            self.assertEqual(len(json.load(fp)["inbounds"][0]["settings"]["clients"]), 10001)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+import os as _os
+
+# profile the run if `WGCM_PROFILE` is set, the profiler is not imported otherwise to keep the startup fast
+if _os.environ.get("WGCM_PROFILE"):
+    from .profiling import start_from_env as _start_profiling_from_env
+    _start_profiling_from_env()
@@ -0,0 +1,399 @@
+"""
+The command line interface.
+
+Only `argparse` is imported at startup, a command imports what it needs when it runs,
+so `--help` and light commands don't pay for tkinter, the plugins or the logging pipeline.
+"""
+import sys
+import argparse
+
+PROG = "wg_config_manager"
+
+
+def _read_network(path: str):
+    from ..wireguard_core import read_config
+
+    with open(path, "r", encoding="utf-8") as fp:
+        return read_config(fp.read())
+
+
+def _get_parser(args: argparse.Namespace):
+    # the app config, `--config` or the default config file
+    if args.config is None:
+        from ..storage import get_parser_from_config
+        return get_parser_from_config()
+    from configparser import ConfigParser
+    parser = ConfigParser(allow_no_value=True)
+    with open(args.config, "r", encoding="utf-8") as fp:
+        parser.read_file(fp)
+    return parser
+
+
+def _write_output(path: str | None, data: bytes):
+    if path is None or path == "-":
+        sys.stdout.buffer.write(data)
+        sys.stdout.flush()
+    else:
+        with open(path, "wb") as fp:
+            fp.write(data)
+
+
+def _open_output(path: str | None):
+    # an atomic 0600 file, or stdout
+    if path is None or path == "-":
+        import contextlib
+        return contextlib.nullcontext(sys.stdout.buffer)
+    from ..storage import open_atomic
+    return open_atomic(path)
+
+
+def _find_encrypt_plugin(args: argparse.Namespace, name: str):
+    # the plugin of the encrypt type `name`, None if not found
+    from ..load_plugin import load_plugins
+
+    plugins = load_plugins(_get_parser(args), lazy=True)
+    if args.plugin is not None:
+        plugins = {args.plugin: plugins[args.plugin]}
+    for plugin in plugins.values():
+        if name in plugin.get_encrypt_type_names():
+            return plugin
+    return None
+
+
+def _get_client(args: argparse.Namespace):
+    # a client of the daemon if `--daemon`, else None
+    if not args.daemon:
+        return None
+    from ..daemon import DaemonClient
+    return DaemonClient(args.socket)
+
+
+def command_render(args: argparse.Namespace) -> int:
+    """
+    render the wireguard config of a device
+    """
+    peers = [i.strip() for i in args.peers.split(",") if i.strip()] if args.peers else None
+    client = _get_client(args)
+    if client is not None:
+        with client:
+            text = client.render(args.network, args.device, peers)
+    else:
+        from ..wireguard_core import get_config_for
+        text = get_config_for(args.device, _read_network(args.network), peers)
+    _write_output(args.output, (text + "\n").encode("utf-8"))
+    return 0
+
+
+def command_render_all(args: argparse.Namespace) -> int:
+    """
+    render the configs of the selected devices to a directory
+    """
+    from ..export import render_devices
+
+    report = render_devices(_read_network(args.network), args.out_dir, args.devices, jobs=args.jobs,
+                            fsync=args.fsync, incremental=args.incremental or args.changes is not None)
+    if args.timings:
+        print(report.format_table(), file=sys.stderr)
+    if args.changes is not None:
+        import json
+        _write_output(args.changes, (json.dumps(report.get_changes(), indent=1) + "\n").encode("utf-8"))
+    for i in report.failures:
+        print(f"{PROG}: {i.device}: {i.error}", file=sys.stderr)
+    return 1 if report.failures else 0
+
+
+def command_export(args: argparse.Namespace) -> int:
+    """
+    stream the configs of the selected devices into a tar or zip archive, optionally encrypted by a plugin
+    """
+    from ..export import write_archive, get_archive_format
+
+    network = _read_network(args.network)
+    archive_format = args.format or get_archive_format(args.output)
+    plugin = None
+    if args.encrypt is not None:
+        plugin = _find_encrypt_plugin(args, args.encrypt)
+        if plugin is None:
+            print(f"{PROG}: unknown encrypt type `{args.encrypt}`", file=sys.stderr)
+            return 2
+    with _open_output(args.output) as fp:
+        if plugin is None:
+            report = write_archive(network, fp, archive_format, args.devices)
+        else:
+            with plugin.open_encrypt_stream(args.encrypt, fp) as stream:
+                report = write_archive(network, stream, archive_format, args.devices)
+    for i in report.failures:
+        print(f"{PROG}: {i.device}: {i.error}", file=sys.stderr)
+    return 1 if report.failures else 0
+
+
+def command_keygen(args: argparse.Namespace) -> int:
+    """
+    print a new private key, or the public key of the private key from stdin
+    """
+    client = _get_client(args)
+    if client is not None:
+        with client:
+            print(client.keygen(sys.stdin.read().strip() if args.pubkey else None))
+        return 0
+    from ..wireguard_core import gen_private_key, gen_public_key
+
+    wg_path = args.wg or _get_parser(args).get("WireGuard", "path", fallback="wg")
+    if args.pubkey:
+        print(gen_public_key(sys.stdin.read().strip(), wg_path).strip())
+    else:
+        print(gen_private_key(wg_path).strip())
+    return 0
+
+
+def command_encrypt(args: argparse.Namespace) -> int:
+    """
+    encrypt or decrypt stdin or a file by an encrypt type of the plugins
+    """
+    client = _get_client(args)
+    plugin = None if client is not None else _find_encrypt_plugin(args, args.name)
+    if client is None and plugin is None:
+        print(f"{PROG}: unknown encrypt type `{args.name}`", file=sys.stderr)
+        return 2
+    if args.input is None or args.input == "-":
+        data = sys.stdin.buffer.read()
+    else:
+        with open(args.input, "rb") as fp:
+            data = fp.read()
+    if client is not None:
+        with client:
+            _write_output(args.output, client.encrypt(args.name, data, args.decrypt, args.plugin))
+    elif args.decrypt:
+        _write_output(args.output, plugin.exec_decrypt(args.name, data))
+    else:
+        _write_output(args.output, plugin.exec_encrypt(args.name, data))
+    return 0
+
+
+def command_service(args: argparse.Namespace) -> int:
+    """
+    list the services of the plugins, or run a service until interrupted
+    """
+    from ..load_plugin import load_plugins
+    from ..logger import setup_logging
+
+    parser = _get_parser(args)
+    plugins = load_plugins(parser, lazy=True)
+    if args.plugin is None or args.service is None:
+        for name, plugin in plugins.items():
+            for service in plugin.get_service_names():
+                print(f"{name}/{service}")
+        return 0
+    import signal
+    import threading
+
+    setup_logging(parser)
+    plugin = plugins[args.plugin]
+    process_name = args.name or args.service
+    stopped = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stopped.set())
+    plugin.run_service(args.service, process_name)
+    try:
+        stopped.wait()
+    finally:
+        plugin.stop_service(process_name)
+    return 0
+
+
+def command_rotate(args: argparse.Namespace) -> int:
+    """
+    rotate the keys of the selected devices, and write the network config and the changed device configs
+    """
+    from ..storage import read_versioned
+    from ..rotation import rotate, cutover, commit
+    from ..wireguard_core import read_config
+
+    data, version = read_versioned(args.network)
+    network = read_config(data.decode("utf-8"))
+    if args.cutover or args.discard:
+        result = cutover(network, args.devices, discard=args.discard)
+    else:
+        result = rotate(network, args.devices, keys=not args.no_keys, psks=args.psk, staged=args.staged)
+    # fails if another process changed the network config meanwhile, rather than dropping its change
+    commit(result, args.network, args.out_dir, fsync=args.fsync, version=version)
+    if args.timings:
+        print(", ".join(f"{k} {v * 1000:.1f} ms" for k, v in result.timings.items()), file=sys.stderr)
+    for device in result.affected:
+        print(device)
+    return 0
+
+
+def command_daemon(args: argparse.Namespace) -> int:
+    """
+    serve requests on a unix socket until interrupted, or query or stop a running daemon
+    """
+    from ..daemon import ControlDaemon, DaemonClient
+
+    if args.stats or args.stop:
+        import json
+        with DaemonClient(args.socket) as client:
+            print(json.dumps(client.stats() if args.stats else client.shutdown(), indent=1))
+        return 0
+    import signal
+
+    daemon = ControlDaemon(_get_parser(args), args.socket)
+    daemon.bind()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: daemon.shutdown())
+    print(daemon.socket_path, flush=True)
+    daemon.serve_forever()
+    return 0
+
+
+def command_import(args: argparse.Namespace) -> int:
+    """
+    import wg-quick configs into the network config, the device name is the file name without `.conf`
+    """
+    from pathlib import Path
+    from ..storage import update_config
+    from ..wireguard_core import read_config, import_wg_quick
+
+    texts = {}
+    for path in args.files:
+        path = Path(path)
+        device = args.name if args.name and len(args.files) == 1 else path.stem
+        texts[device] = path.read_text(encoding="utf-8")
+    changed = []
+
+    def update(network):
+        # called again if another process changed the network config meanwhile
+        changed.clear()
+        for device, text in texts.items():
+            changed.extend(i for i in import_wg_quick(device, text, network) if i not in changed)
+
+    update_config(args.network, update, read=read_config)
+    for device in changed:
+        print(device)
+    return 0
+
+
+def get_argument_parser() -> argparse.ArgumentParser:
+    """
+    the parser of the command line
+    """
+    parser = argparse.ArgumentParser(prog=PROG, description="Manage WireGuard configs. Start the GUI without a command.")
+    parser.add_argument("--config", help="the app config file, default: ~/.config/wg_config_manager/config.ini")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log to stderr")
+    parser.add_argument("--profile", metavar="MODES",
+                        help='profile the command, modes are "time", "cprofile" and "tracemalloc"')
+    parser.add_argument("--profile-output", metavar="PREFIX", help="write the profile report to PREFIX.txt")
+    parser.add_argument("--daemon", action="store_true", help="send render, keygen and encrypt to the daemon")
+    parser.add_argument("--socket", help="the socket of the daemon, default: $XDG_RUNTIME_DIR/wg_config_manager.sock")
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+
+    render = commands.add_parser("render", help="render the wireguard config of a device")
+    render.add_argument("network", help="the network config, sections are devices")
+    render.add_argument("device")
+    render.add_argument("--peers", help="comma separated peers, all other devices by default")
+    render.add_argument("-o", "--output", help="the output file, stdout by default")
+    render.set_defaults(function=command_render)
+
+    render_all = commands.add_parser("render-all", help="render the configs of many devices to a directory")
+    render_all.add_argument("network", help="the network config, sections are devices")
+    render_all.add_argument("out_dir", help="write {device}.conf files here")
+    render_all.add_argument("devices", nargs="*", metavar="DEVICE",
+                            help="device names or glob patterns like 'pc-*', all devices by default")
+    render_all.add_argument("-j", "--jobs", type=int, default=None,
+                            help="the number of processes, the number of CPUs by default")
+    render_all.add_argument("--fsync", action="store_true", help="flush every file to disk")
+    render_all.add_argument("--timings", action="store_true", help="print the slowest devices to stderr")
+    render_all.add_argument("--incremental", action="store_true",
+                            help="write only the changed files and remove the files of removed devices")
+    render_all.add_argument("--changes", metavar="FILE",
+                            help="write the changed devices as json, '-' for stdout, implies --incremental")
+    render_all.set_defaults(function=command_render_all)
+
+    export = commands.add_parser("export", help="stream the configs of many devices into a tar or zip archive")
+    export.add_argument("network", help="the network config, sections are devices")
+    export.add_argument("devices", nargs="*", metavar="DEVICE",
+                        help="device names or glob patterns like 'pc-*', all devices by default")
+    export.add_argument("-o", "--output", help="the archive file, stdout by default")
+    export.add_argument("--format", choices=["tar", "tar.gz", "zip"],
+                        help="the archive format, by the suffix of --output or tar by default")
+    export.add_argument("--encrypt", metavar="NAME", help="encrypt the archive by an encrypt type, like GnuPG")
+    export.add_argument("--plugin", help="the plugin of the encrypt type, searched in all plugins by default")
+    export.set_defaults(function=command_export)
+
+    keygen = commands.add_parser("keygen", help="print a new private key")
+    keygen.add_argument("--pubkey", action="store_true", help="print the public key of the private key from stdin")
+    keygen.add_argument("--wg", help="path of wg, `[WireGuard] path` by default")
+    keygen.set_defaults(function=command_keygen)
+
+    encrypt = commands.add_parser("encrypt", help="encrypt or decrypt by a plugin")
+    encrypt.add_argument("name", help="the encrypt type, like gpg")
+    encrypt.add_argument("-d", "--decrypt", action="store_true")
+    encrypt.add_argument("--plugin", help="the plugin of the encrypt type, searched in all plugins by default")
+    encrypt.add_argument("-i", "--input", help="the input file, stdin by default")
+    encrypt.add_argument("-o", "--output", help="the output file, stdout by default")
+    encrypt.set_defaults(function=command_encrypt)
+
+    service = commands.add_parser("service", help="list services, or run a service until interrupted")
+    service.add_argument("plugin", nargs="?")
+    service.add_argument("service", nargs="?")
+    service.add_argument("--name", help="the process name, the service name by default")
+    service.set_defaults(function=command_service)
+
+    rotate = commands.add_parser("rotate", help="rotate keys, and print the devices whose configs changed")
+    rotate.add_argument("network", help="the network config, sections are devices")
+    rotate.add_argument("devices", nargs="*", metavar="DEVICE",
+                        help="device names or glob patterns like 'pc-*', all devices by default")
+    rotate.add_argument("-o", "--out-dir", help="write the changed {device}.conf files here")
+    rotate.add_argument("--psk", action="store_true", help="rotate the existing pre-shared keys of the devices")
+    rotate.add_argument("--no-keys", action="store_true", help="keep the private and public keys")
+    rotate.add_argument("--staged", action="store_true",
+                        help="add the new keys as next keys, peers know them but route by the current keys until --cutover")
+    rotate.add_argument("--cutover", action="store_true", help="replace the keys by the staged next keys")
+    rotate.add_argument("--discard", action="store_true", help="discard the staged next keys")
+    rotate.add_argument("--fsync", action="store_true", help="flush every file to disk")
+    rotate.add_argument("--timings", action="store_true", help="print the time of each step to stderr")
+    rotate.set_defaults(function=command_rotate)
+
+    daemon = commands.add_parser("daemon", help="serve requests on a unix socket, keeping configs and plugins loaded")
+    daemon.add_argument("--stats", action="store_true", help="print the counters of the running daemon")
+    daemon.add_argument("--stop", action="store_true", help="stop the running daemon")
+    daemon.set_defaults(function=command_daemon)
+
+    import_ = commands.add_parser("import", help="import wg-quick configs into the network config")
+    import_.add_argument("network", help="the network config, created if not exists")
+    import_.add_argument("files", nargs="+", metavar="FILE")
+    import_.add_argument("--name", help="the device name of a single file")
+    import_.set_defaults(function=command_import)
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    """
+    run the command line, return the exit code
+    """
+    parser = get_argument_parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 2
+    import logging
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    elif not logging.getLogger(PROG).handlers:
+        # errors are reported by the exit code and message, not logged twice
+        logging.getLogger(PROG).addHandler(logging.NullHandler())
+    run = None
+    if args.profile:
+        from ..profiling import ProfileRun, parse_modes
+        run = ProfileRun(parse_modes(args.profile), args.profile_output).start()
+    try:
+        return args.function(args)
+    except Exception as err:
+        from ..errors import WG_CONFIG_MANAGER_BASE_EXCEPION
+        if not isinstance(err, (WG_CONFIG_MANAGER_BASE_EXCEPION, OSError, KeyError, ValueError)):
+            raise
+        print(f"{PROG}: {type(err).__name__}: {err}", file=sys.stderr)
+        return 1
+    finally:
+        if run is not None:
+            run.stop()
@@ -0,0 +1,387 @@
+"""
+A long-lived control daemon serving requests over a Unix domain socket.
+
+The daemon keeps the parsed network configs (re-parsed when the file changes), the plugins and their services
+in memory, so a request doesn't pay for parsing, importing or starting the interpreter.
+Requests from concurrent clients are executed one at a time.
+
+A message is a 4-byte big-endian length followed by a UTF-8 JSON object:
+
+- request: `{"id": 1, "command": "render", "args": {"network": "/path/network.ini", "device": "pc-1"}}`
+- response: `{"id": 1, "ok": true, "result": ...}` or `{"id": 1, "ok": false, "error": {"type": ..., "message": ...}}`
+
+Bytes, like the data to encrypt, are base64 strings.
+"""
+import os
+import json
+import time
+import base64
+import socket
+import struct
+import typing
+import threading
+import collections
+import socketserver
+from configparser import ConfigParser
+
+from .logger import Logger
+from .storage import PathMap
+from .errors import DaemonError
+
+logger = Logger(__name__)
+
+HEADER = struct.Struct(">I")
+MAX_MESSAGE_SIZE = 64 * 2 ** 20
+SOCKET_NAME = "wg_config_manager.sock"
+
+
+def get_default_socket_path() -> str:
+    """
+    `$XDG_RUNTIME_DIR/wg_config_manager.sock`, or in the config directory
+    """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    return os.path.join(runtime_dir or PathMap.CONFIG_DIR, SOCKET_NAME)
+
+
+def send_message(sock: socket.socket, message: dict[str, typing.Any]):
+    """
+    send a length-prefixed json message
+    """
+    data = json.dumps(message, separators=(",", ":"), default=str).encode("utf-8")
+    if len(data) > MAX_MESSAGE_SIZE:
+        raise DaemonError(f"message of {len(data)} bytes exceeds {MAX_MESSAGE_SIZE} bytes")
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = sock.recv(size - len(buffer))
+        if not chunk:
+            raise EOFError("connection closed")
+        buffer += chunk
+    return bytes(buffer)
+
+
+def recv_message(sock: socket.socket) -> dict[str, typing.Any]:
+    """
+    receive a length-prefixed json message
+
+    :raise: EOFError if the connection is closed, DaemonError if the message is invalid
+    """
+    size, = HEADER.unpack(_recv_exactly(sock, HEADER.size))
+    if size > MAX_MESSAGE_SIZE:
+        raise DaemonError(f"message of {size} bytes exceeds {MAX_MESSAGE_SIZE} bytes")
+    try:
+        message = json.loads(_recv_exactly(sock, size))
+    except ValueError as err:
+        raise DaemonError(f"invalid message: {err}") from err
+    if not isinstance(message, dict):
+        raise DaemonError("a message should be a json object")
+    return message
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    # serve the requests of a connection until it's closed
+    def handle(self):
+        while True:
+            try:
+                request = recv_message(self.request)
+            except (EOFError, ConnectionError):
+                return
+            except DaemonError as err:
+                send_message(self.request, {"ok": False, "error": {"type": "DaemonError", "message": str(err)}})
+                return
+            send_message(self.request, self.server.control_daemon.handle(request))
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    control_daemon: "ControlDaemon"
+
+
+class ControlDaemon:
+    """
+    Serve render, keygen, encrypt, service and stats requests, see the module document.
+    The handlers are in `handlers`, called with the request args as keywords, one request at a time.
+    """
+
+    def __init__(self, parser: ConfigParser | None = None, socket_path: str | os.PathLike | None = None):
+        """
+        :param parser: the app config, `get_parser_from_config()` at the first use if None
+        :param socket_path: `get_default_socket_path()` if None
+        """
+        self._parser = parser
+        self.socket_path = os.fspath(socket_path or get_default_socket_path())
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.requests = collections.Counter()
+        self.errors = collections.Counter()
+        self.busy_time = 0.0
+        self._networks: dict[str, tuple[tuple[int, int, int], ConfigParser, dict]] = {}
+        self._plugins = None
+        self._server: _Server | None = None
+        self.handlers: dict[str, typing.Callable[..., typing.Any]] = {
+            "ping": lambda: "pong",
+            "render": self.render,
+            "keygen": self.keygen,
+            "encrypt": self.encrypt,
+            "service": self.service,
+            "stats": self.stats,
+            "shutdown": self.shutdown,
+        }
+
+    @property
+    def parser(self) -> ConfigParser:
+        """
+        the app config
+        """
+        if self._parser is None:
+            from .storage import get_parser_from_config
+            self._parser = get_parser_from_config()
+        return self._parser
+
+    @property
+    def plugins(self) -> dict[str, typing.Any]:
+        """
+        the plugins, loaded lazily at the first use
+        """
+        if self._plugins is None:
+            from .load_plugin import load_plugins
+            self._plugins = load_plugins(self.parser, lazy=True)
+        return self._plugins
+
+    def get_network(self, path: str) -> tuple[ConfigParser, dict]:
+        """
+        The parsed network config at `path` and its peer cache, parsed again if the file changed.
+        """
+        from .wireguard_core import read_config
+
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        cached = self._networks.get(path)
+        if cached is None or cached[0] != key:
+            with open(path, "r", encoding="utf-8") as fp:
+                cached = self._networks[path] = (key, read_config(fp.read()), {})
+            logger.info("loaded network %s", path)
+        return cached[1], cached[2]
+
+    def render(self, network: str, device: str, peers: list[str] | None = None) -> str:
+        """
+        the wireguard config of `device`
+        """
+        from .wireguard_core import get_config_for
+
+        config, peer_cache = self.get_network(network)
+        return get_config_for(device, config, peers, peer_cache=peer_cache)
+
+    def keygen(self, private_key: str | None = None) -> str:
+        """
+        a new private key, or the public key of `private_key`
+        """
+        from .wireguard_core import gen_private_key, gen_public_key
+
+        wg_path = self.parser.get("WireGuard", "path", fallback="wg")
+        if private_key is None:
+            return gen_private_key(wg_path).strip()
+        return gen_public_key(private_key, wg_path).strip()
+
+    def encrypt(self, name: str, data: str, decrypt: bool = False, plugin: str | None = None) -> str:
+        """
+        encrypt or decrypt base64 `data` by the encrypt type `name`, return base64
+        """
+        plugins = self.plugins if plugin is None else {plugin: self.plugins[plugin]}
+        for i in plugins.values():
+            if name in i.get_encrypt_type_names():
+                function = i.exec_decrypt if decrypt else i.exec_encrypt
+                return base64.b64encode(function(name, base64.b64decode(data))).decode("ascii")
+        raise KeyError(f"unknown encrypt type `{name}`")
+
+    def service(self, action: str = "list", plugin: str | None = None, service: str | None = None,
+                name: str | None = None) -> typing.Any:
+        """
+        `list` the services and running processes, `start` or `stop` a process, or get the `stats` of services
+        """
+        if action == "list":
+            return {"services": [f"{n}/{s}" for n, p in self.plugins.items() for s in p.get_service_names()],
+                    "running": {n: p.list_running_services() for n, p in self.plugins.items()
+                                if p.list_running_services()}}
+        if action == "stats":
+            return {k: v for p in self.plugins.values() for k, v in p.get_service_stats().items()}
+        if action not in ("start", "stop"):
+            raise ValueError(f"unknown service action `{action}`")
+        if plugin is None or service is None and (action == "start" or name is None):
+            raise ValueError(f"a plugin and a service are required to {action} a process")
+        process_name = name or service
+        if action == "start":
+            self.plugins[plugin].run_service(service, process_name)
+        else:
+            self.plugins[plugin].stop_service(process_name)
+        return process_name
+
+    def stats(self) -> dict[str, typing.Any]:
+        """
+        the counters of the daemon
+        """
+        return {"pid": os.getpid(), "uptime": time.time() - self.started_at, "requests": dict(self.requests),
+                "errors": dict(self.errors), "busy_time": self.busy_time, "networks": sorted(self._networks),
+                "plugins_loaded": self._plugins is not None}
+
+    def handle(self, request: dict[str, typing.Any]) -> dict[str, typing.Any]:
+        """
+        execute a request, return the response
+        """
+        command = request.get("command")
+        with self.lock:
+            start = time.perf_counter()
+            try:
+                if command not in self.handlers:
+                    raise ValueError(f"unknown command `{command}`")
+                args = request.get("args") or {}
+                if not isinstance(args, dict):
+                    raise ValueError("args should be a json object")
+                response = {"ok": True, "result": self.handlers[command](**args)}
+            except Exception as err:
+                logger.debug("request %s failed: %s", command, err)
+                self.errors[str(command)] += 1
+                response = {"ok": False, "error": {"type": type(err).__name__, "message": str(err)}}
+            self.requests[str(command)] += 1
+            self.busy_time += time.perf_counter() - start
+        if "id" in request:
+            response["id"] = request["id"]
+        return response
+
+    def bind(self):
+        """
+        Create the socket, readable by the owner only.
+
+        :raise: DaemonError if another daemon is serving the socket
+        """
+        if os.path.exists(self.socket_path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                try:
+                    sock.connect(self.socket_path)
+                except OSError:
+                    os.remove(self.socket_path)  # stale, its daemon exited
+                else:
+                    raise DaemonError(f"a daemon is serving {self.socket_path}")
+        os.makedirs(os.path.dirname(self.socket_path) or ".", exist_ok=True)
+        umask = os.umask(0o177)
+        try:
+            self._server = _Server(self.socket_path, _RequestHandler)
+        finally:
+            os.umask(umask)
+        self._server.control_daemon = self
+
+    def serve_forever(self):
+        """
+        Serve until `shutdown`, then stop the services and remove the socket.
+        """
+        if self._server is None:
+            self.bind()
+        logger.info("serving %s", self.socket_path)
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            try:
+                os.remove(self.socket_path)
+            except FileNotFoundError:
+                pass
+            if self._plugins is not None:
+                from .load_plugin import stop_all
+                stop_all(self._plugins)
+
+    def shutdown(self) -> bool:
+        """
+        Stop `serve_forever` from another thread, or from a request.
+        """
+        if self._server is not None:
+            # `shutdown` waits the serving loop, which may be waiting this request
+            threading.Thread(target=self._server.shutdown, daemon=True).start()
+        return True
+
+
+class DaemonClient:
+    """
+    A connection to `ControlDaemon`, requests are sent on one connection.
+    """
+
+    def __init__(self, socket_path: str | os.PathLike | None = None, timeout: float | None = 60.0):
+        self.socket_path = os.fspath(socket_path or get_default_socket_path())
+        self.timeout = timeout
+        self._sock: socket.socket | None = None
+        self._id = 0
+
+    def connect(self):
+        """
+        connect to the daemon if not connected
+
+        :raise: OSError
+        """
+        if self._sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.socket_path)
+            except OSError:
+                sock.close()
+                raise
+            self._sock = sock
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def request(self, command: str, **args) -> typing.Any:
+        """
+        send a request and return its result
+
+        :raise: DaemonError if the request failed, OSError or EOFError if the connection failed
+        """
+        self.connect()
+        self._id += 1
+        try:
+            send_message(self._sock, {"id": self._id, "command": command, "args": args})
+            response = recv_message(self._sock)
+        except BaseException:
+            # the stream may be in the middle of a message
+            self.close()
+            raise
+        if not response.get("ok"):
+            error = response.get("error") or {}
+            raise DaemonError(f"{error.get('type')}: {error.get('message')}")
+        if response.get("id") != self._id:
+            self.close()
+            raise DaemonError(f"response id {response.get('id')} mismatch request id {self._id}")
+        return response.get("result")
+
+    def render(self, network: str | os.PathLike, device: str, peers: list[str] | None = None) -> str:
+        return self.request("render", network=os.path.abspath(network), device=device, peers=peers)
+
+    def keygen(self, private_key: str | None = None) -> str:
+        return self.request("keygen", private_key=private_key)
+
+    def encrypt(self, name: str, data: bytes, decrypt: bool = False, plugin: str | None = None) -> bytes:
+        result = self.request("encrypt", name=name, data=base64.b64encode(data).decode("ascii"),
+                              decrypt=decrypt, plugin=plugin)
+        return base64.b64decode(result)
+
+    def service(self, action: str = "list", plugin: str | None = None, service: str | None = None,
+                name: str | None = None) -> typing.Any:
+        return self.request("service", action=action, plugin=plugin, service=service, name=name)
+
+    def stats(self) -> dict[str, typing.Any]:
+        return self.request("stats")
+
+    def shutdown(self) -> bool:
+        return self.request("shutdown")
@@ -0,0 +1,132 @@
+"""
+A search index of the devices in the wireguard_core config, for browsing large inventories.
+
+The searchable fields of all devices (name, public key and address) are lowercased and joined into one string,
+so a query is a few `str.find` calls over the joined string instead of a loop over the config sections.
+A query extending the previous one only rechecks the previous matches.
+"""
+import typing
+import bisect
+from dataclasses import dataclass
+from configparser import ConfigParser
+
+from .wireguard_core import RESERVED_KEYS
+
+SEARCH_FIELDS = ("name", "public_key", "address")
+REFINE_LIMIT = 4096  # recheck at most this many previous matches, or search again
+
+
+@dataclass(slots=True)
+class DeviceRow:
+    """
+    The browsed fields of a device.
+    """
+    name: str
+    public_key: str = ""
+    address: str = ""
+    allowed_ips: str = ""
+    endpoint: str = ""
+    peers: tuple[str, ...] = ()  # the `peers` of the device, empty for all other devices
+
+
+class DeviceIndex:
+    """
+    The devices of a config in the config order, searched by a substring of their name, public key or address.
+    """
+
+    def __init__(self, rows: typing.Iterable[DeviceRow]):
+        self.rows: list[DeviceRow] = list(rows)
+        self.by_name = {row.name: i for i, row in enumerate(self.rows)}
+        keys = ["\t".join(getattr(row, field) for field in SEARCH_FIELDS).lower() for row in self.rows]
+        self._keys = keys
+        self._starts = []  # the offset of each key in `_text`
+        offset = 0
+        for key in keys:
+            self._starts.append(offset)
+            offset += len(key) + 1
+        self._text = "\n".join(keys)
+        self._last: tuple[str, typing.Sequence[int]] = ("", range(len(self.rows)))
+
+    @classmethod
+    def from_config(cls, config: ConfigParser) -> "DeviceIndex":
+        """
+        index the devices of `config`, values are read raw without interpolation
+        """
+        rows = []
+        for name in config.sections():
+            if name in RESERVED_KEYS:
+                continue
+            section = config[name]
+            peers = section.get("peers", "", raw=True) or ""
+            rows.append(DeviceRow(name, section.get("public key", "", raw=True) or "",
+                                  section.get("address", "", raw=True) or "",
+                                  section.get("allowed ips", "", raw=True) or "",
+                                  section.get("endpoint", "", raw=True) or "",
+                                  tuple(i.strip() for i in peers.split(",") if i.strip())))
+        return cls(rows)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def get_peers(self, device: int) -> typing.Sequence[int]:
+        """
+        the row indexes of the peers of a device like `wireguard_core.get_peer_devices`: its `peers` if they are set,
+        without the unknown names, or a `PeerView` of all other devices
+        """
+        peers = self.rows[device].peers
+        if peers:
+            return [self.by_name[name] for name in peers if name in self.by_name]
+        return PeerView(len(self.rows), device)
+
+    def search(self, query: str) -> typing.Sequence[int]:
+        """
+        the sorted indexes of the rows matching `query` (case-insensitive), all rows if it's empty
+        """
+        query = query.strip().lower()
+        if not query or "\t" in query or "\n" in query:
+            # the separators of fields and rows are not searchable
+            result = range(len(self.rows)) if not query else []
+        else:
+            last_query, last_result = self._last
+            if last_query and query.startswith(last_query) and len(last_result) <= REFINE_LIMIT:
+                keys = self._keys
+                result = [i for i in last_result if query in keys[i]]
+            else:
+                result = self._scan(query)
+        self._last = (query, result)
+        return result
+
+    def _scan(self, query: str) -> list[int]:
+        text, starts = self._text, self._starts
+        result = []
+        position = text.find(query)
+        while position != -1:
+            i = bisect.bisect_right(starts, position) - 1
+            result.append(i)
+            # continue from the next row
+            if i + 1 >= len(starts):
+                break
+            position = text.find(query, starts[i + 1])
+        return result
+
+
+class PeerView(typing.Sequence[int]):
+    """
+    The row indexes of the other devices than `device`, without copying the index.
+    """
+
+    def __init__(self, total: int, device: int):
+        self.total = total
+        self.device = device
+
+    def __len__(self) -> int:
+        return self.total - 1 if 0 <= self.device < self.total else self.total
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError(item)
+        return item + 1 if 0 <= self.device <= item else item
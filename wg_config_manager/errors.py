@@ -51,5 +51,34 @@ class WireguardConfError(WG_CONFIG_MANAGER_BASE_EXCEPION):
     """
 
 
+# --- daemon
+
+class DaemonError(WG_CONFIG_MANAGER_BASE_EXCEPION):
+    """
+    A request to the control daemon failed, or the daemon cannot start.
+    """
+
+
+# --- storage
+
+class StorageError(WG_CONFIG_MANAGER_BASE_EXCEPION):
+    """
+    A shared file cannot be read or written safely.
+    """
+
+
+class StorageLockError(StorageError):
+    """
+    A file lock cannot be acquired in time.
+    """
+
+
+class StorageConflictError(StorageError):
+    """
+    A file changed since it was read, the read-modify-write is stale.
+    """
+
+
 # ---
-errors = (ConfigParseError, PluginLoadingError, PluginRuntimeError, EncryptionError, WireguardConfError)
+errors = (ConfigParseError, PluginLoadingError, PluginRuntimeError, EncryptionError, WireguardConfError, DaemonError,
+          StorageLockError, StorageConflictError)
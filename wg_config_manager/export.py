@@ -0,0 +1,444 @@
+"""
+Render the wireguard configs of many devices to files.
+
+`render_devices` renders the selected devices on a process pool, each worker parses the network config once
+and writes the files itself, so only the device names and the timings cross the processes.
+The peer sections are rendered once per process and reused by every config listing the peer.
+Files are written atomically with mode 0600, since they contain private keys.
+
+With `incremental=True` the output directory keeps a manifest of the sha256 of every file. A file whose bytes
+didn't change is not rewritten, the files of removed devices are deleted, and the report has the changed set,
+so rsync, config management or a reload hook only touch the affected hosts.
+
+`write_archive` streams the configs into a tar or zip archive instead, one member at a time, so the memory
+doesn't grow with the archive. Members are sorted by name and have fixed metadata (mtime 0, owner 0, mode 0600),
+the same network gives the same bytes.
+"""
+import io
+import os
+import gzip
+import json
+import time
+import hashlib
+import tarfile
+import zipfile
+import contextlib
+import fnmatch
+import typing
+import multiprocessing
+import concurrent.futures
+from pathlib import Path
+from dataclasses import dataclass, field, asdict
+from configparser import ConfigParser
+
+from .logger import Logger
+from .storage import write_file_atomic
+from .errors import WireguardConfError
+from .wireguard_core import RESERVED_KEYS, get_config_for, read_config
+
+logger = Logger(__name__)
+
+CONFIG_SUFFIX = ".conf"
+CHUNKS_PER_JOB = 8  # split the devices into more chunks than jobs, so a slow chunk doesn't idle the others
+# not fork, the caller may have threads (the daemon, the GUI), and a forked child copies their held locks
+WORKER_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+MANIFEST_NAME = ".manifest.json"
+MANIFEST_VERSION = 1
+
+ARCHIVE_FORMATS = {"tar": (".tar",), "tar.gz": (".tar.gz", ".tgz"), "zip": (".zip",)}
+ARCHIVE_MEMBER_MODE = 0o600
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)  # the earliest zip timestamp
+GZIP_LEVEL = 6
+ARCHIVE_PEER_CACHE_SIZE = 4096  # the peer cache is cleared at this size to keep the memory bounded
+
+# the status of a device file in an incremental render
+ADDED = "added"
+CHANGED = "changed"
+UNCHANGED = "unchanged"
+REMOVED = "removed"
+
+
+def get_default_jobs() -> int:
+    """
+    the number of usable CPUs
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def select_devices(config: ConfigParser, selectors: typing.Iterable[str] | None = None) -> list[str]:
+    """
+    The devices matching `selectors` in the config order, all devices if None or empty.
+    A selector is a device name or a glob pattern like `pc-*`.
+
+    :raise: WireguardConfError if a device name (not a pattern) is not found
+    """
+    devices = [i for i in config.sections() if i not in RESERVED_KEYS]
+    selectors = list(selectors or ())
+    if not selectors:
+        return devices
+    names = set(devices)
+    patterns = []
+    selected = set()
+    for selector in selectors:
+        if any(c in selector for c in "*?["):
+            patterns.append(selector)
+        elif selector in names:
+            selected.add(selector)
+        else:
+            raise WireguardConfError(f"cannot get device named `{selector}` from config")
+    return [i for i in devices if i in selected or any(fnmatch.fnmatchcase(i, p) for p in patterns)]
+
+
+def get_config_path(out_dir: str | os.PathLike, device: str) -> Path:
+    """
+    `{out_dir}/{device}.conf`
+
+    :raise: WireguardConfError if the device name is not a plain file name
+    """
+    return Path(out_dir, get_config_name(device))
+
+
+def get_config_name(device: str) -> str:
+    """
+    `{device}.conf`, without a `Path`, which interns the name
+
+    :raise: WireguardConfError if the device name is not a plain file name
+    """
+    if not device or device.startswith(".") or "/" in device or "\\" in device or "\0" in device:
+        raise WireguardConfError(f"device name `{device}` cannot be a file name")
+    return device + CONFIG_SUFFIX
+
+
+@dataclass
+class DeviceRenderTiming:
+    """
+    The time used to render and write a device config, in seconds.
+    `error` is the formatted exception if it failed.
+    `status` and `entry` (the manifest entry of the file) are set by an incremental render.
+    """
+    device: str
+    render_time: float = 0.0
+    write_time: float = 0.0
+    size: int = 0
+    error: str | None = None
+    status: str | None = None
+    entry: dict[str, typing.Any] | None = None
+
+
+@dataclass
+class RenderReport:
+    """
+    The report of `render_devices`.
+    """
+    timings: list[DeviceRenderTiming] = field(default_factory=list)
+    total_time: float = 0.0
+    jobs: int = 1
+    removed: list[str] = field(default_factory=list)
+
+    @property
+    def failures(self) -> list[DeviceRenderTiming]:
+        """
+        the timings of failed devices
+        """
+        return [i for i in self.timings if i.error is not None]
+
+    def get_changes(self) -> dict[str, list[str]]:
+        """
+        The changed set of an incremental render, the device names in the config order:
+        `{"added": [...], "changed": [...], "removed": [...], "failed": [...]}`
+        """
+        changes = {ADDED: [], CHANGED: [], REMOVED: list(self.removed), "failed": []}
+        for i in self.timings:
+            if i.error is not None:
+                changes["failed"].append(i.device)
+            elif i.status in changes:
+                changes[i.status].append(i.device)
+        return changes
+
+    def as_dict(self) -> dict[str, typing.Any]:
+        """
+        return the report as a json-serializable dict
+        """
+        return asdict(self)
+
+    def format_table(self, limit: int | None = 20) -> str:
+        """
+        return a text table, the slowest device first
+        """
+        lines = [f"{'device':<32} {'render ms':>10} {'write ms':>10} {'bytes':>10}  error"]
+        timings = sorted(self.timings, key=lambda t: t.render_time + t.write_time, reverse=True)
+        for i in timings[:limit]:
+            lines.append(f"{i.device:<32} {i.render_time * 1000:>10.2f} {i.write_time * 1000:>10.2f} {i.size:>10}  "
+                         f"{i.error or ''}")
+        summary = f"{len(self.timings)} devices, {len(self.failures)} failed"
+        if any(i.status is not None for i in self.timings):
+            changes = self.get_changes()
+            summary += f", {len(changes[ADDED])} added, {len(changes[CHANGED])} changed, {len(changes[REMOVED])} removed"
+        lines.append(f"{summary}, {self.jobs} jobs, total {self.total_time * 1000:.1f} ms")
+        return "\n".join(lines)
+
+
+def render_device(device: str, config: ConfigParser, peer_cache: dict | None = None) -> bytes:
+    """
+    the config file content of `device`
+
+    :param peer_cache: see `wireguard_core.get_peer_config`
+    """
+    return (get_config_for(device, config, peer_cache=peer_cache) + "\n").encode("utf-8")
+
+
+def read_manifest(out_dir: str | os.PathLike) -> dict[str, dict[str, typing.Any]]:
+    """
+    The manifest of an incremental render, `{device: {"sha256": ..., "size": ..., "mtime_ns": ...}}`.
+    Empty if missing or unreadable, then every file is compared by its bytes.
+    """
+    try:
+        with open(os.path.join(out_dir, MANIFEST_NAME), "r", encoding="utf-8") as fp:
+            manifest = json.load(fp)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as err:
+        logger.warning("ignore the manifest in %s: %s", out_dir, err)
+        return {}
+    if not isinstance(manifest, dict) or manifest.get("version") != MANIFEST_VERSION:
+        logger.warning("ignore the manifest in %s: unknown version", out_dir)
+        return {}
+    return manifest.get("files", {})
+
+
+def write_manifest(out_dir: str | os.PathLike, files: dict[str, dict[str, typing.Any]], fsync: bool = False):
+    """
+    write the manifest atomically, see `read_manifest`
+    """
+    data = json.dumps({"version": MANIFEST_VERSION, "files": files}, indent=1, sort_keys=True)
+    write_file_atomic(os.path.join(out_dir, MANIFEST_NAME), data.encode("utf-8"), fsync=fsync)
+
+
+def write_if_changed(path: str | os.PathLike, data: bytes, entry: dict[str, typing.Any] | None = None,
+                     fsync: bool = False) -> tuple[str, dict[str, typing.Any]]:
+    """
+    Write `data` atomically unless the file has the same bytes.
+    The file is trusted to match `entry` (its manifest entry) if its size and mtime match,
+    otherwise it is read and compared.
+
+    :return: the status (ADDED, CHANGED or UNCHANGED) and the new manifest entry
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        stat = None
+    if stat is not None and stat.st_size == len(data):
+        if entry is not None and entry.get("sha256") == digest and entry.get("size") == stat.st_size \
+                and entry.get("mtime_ns") == stat.st_mtime_ns:
+            unchanged = True
+        else:
+            with open(path, "rb") as fp:
+                unchanged = fp.read() == data
+        if unchanged:
+            return UNCHANGED, {"sha256": digest, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    write_file_atomic(path, data, fsync=fsync)
+    status = ADDED if stat is None and entry is None else CHANGED
+    stat = os.stat(path)
+    return status, {"sha256": digest, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _render_chunk(devices: list[str], config: ConfigParser, out_dir: str, fsync: bool, peer_cache: dict,
+                  manifest: dict[str, dict] | None = None) -> list[DeviceRenderTiming]:
+    # `manifest` is None for a full render, otherwise the entries of `devices` for an incremental one
+    timings = []
+    for device in devices:
+        timing = DeviceRenderTiming(device)
+        start = time.perf_counter()
+        try:
+            path = get_config_path(out_dir, device)
+            data = render_device(device, config, peer_cache)
+            timing.render_time = time.perf_counter() - start
+            timing.size = len(data)
+            start = time.perf_counter()
+            if manifest is None:
+                write_file_atomic(path, data, fsync=fsync)
+            else:
+                timing.status, timing.entry = write_if_changed(path, data, manifest.get(device), fsync)
+            timing.write_time = time.perf_counter() - start
+        except Exception as err:
+            timing.error = f"{type(err).__name__}: {err}"
+        timings.append(timing)
+    return timings
+
+
+_worker_config: ConfigParser | None = None
+_worker_peer_cache: dict = {}
+
+
+def _init_worker(text: str):
+    global _worker_config
+    _worker_config = read_config(text)
+    _worker_peer_cache.clear()
+
+
+def _render_chunk_in_worker(devices: list[str], out_dir: str, fsync: bool,
+                            manifest: dict[str, dict] | None) -> list[DeviceRenderTiming]:
+    return _render_chunk(devices, _worker_config, out_dir, fsync, _worker_peer_cache, manifest)
+
+
+def _remove_files(out_dir: str, devices: list[str]) -> list[str]:
+    removed = []
+    for device in devices:
+        try:
+            os.remove(get_config_path(out_dir, device))
+        except FileNotFoundError:
+            pass
+        except (OSError, WireguardConfError) as err:
+            logger.warning('failed to remove the config of "%s": %s', device, err)
+            continue
+        removed.append(device)
+    return removed
+
+
+@logger.important_function(print_parameters=["out_dir", "jobs", "incremental"])
+def render_devices(config: ConfigParser, out_dir: str | os.PathLike, selectors: typing.Iterable[str] | None = None,
+                   jobs: int | None = 1, fsync: bool = False, incremental: bool = False) -> RenderReport:
+    """
+    Render the configs of the selected devices to `{out_dir}/{device}.conf`.
+    A failed device is recorded in the report, it doesn't stop the others.
+
+    :param selectors: see `select_devices`
+    :param jobs: the number of processes, `get_default_jobs()` if None. 1 renders in this process.
+    :param fsync: flush every file to disk before the rename
+    :param incremental: write only the changed files and remove the files of devices no longer in `config`,
+    by the manifest in `out_dir`, see `RenderReport.get_changes`
+    :raise: WireguardConfError if a selected device name is not found
+    """
+    start = time.perf_counter()
+    jobs = get_default_jobs() if jobs is None else max(1, jobs)
+    devices = select_devices(config, selectors)
+    out_dir = os.fspath(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = read_manifest(out_dir) if incremental else None
+    report = RenderReport(jobs=jobs)
+    if jobs == 1 or len(devices) < 2:
+        report.timings = _render_chunk(devices, config, out_dir, fsync, {}, manifest)
+    else:
+        text = io.StringIO()
+        config.write(text)
+        size = max(1, -(-len(devices) // (jobs * CHUNKS_PER_JOB)))
+        chunks = [devices[i:i + size] for i in range(0, len(devices), size)]
+        # send each worker only the manifest entries of its chunk
+        manifests = [None if manifest is None else {i: manifest[i] for i in chunk if i in manifest}
+                     for chunk in chunks]
+        with concurrent.futures.ProcessPoolExecutor(
+                jobs, mp_context=multiprocessing.get_context(WORKER_START_METHOD),
+                initializer=_init_worker, initargs=(text.getvalue(),)) as executor:
+            for timings in executor.map(_render_chunk_in_worker, chunks, [out_dir] * len(chunks),
+                                        [fsync] * len(chunks), manifests):
+                report.timings += timings
+    for i in report.failures:
+        logger.warning('failed to render "%s": %s', i.device, i.error)
+    if manifest is not None:
+        for i in report.timings:
+            if i.entry is not None:
+                manifest[i.device] = i.entry
+        # a failed device keeps its old file and entry
+        existing = set(config.sections())
+        report.removed = _remove_files(out_dir, [i for i in manifest if i not in existing])
+        for device in report.removed:
+            del manifest[device]
+        write_manifest(out_dir, manifest, fsync)
+    report.total_time = time.perf_counter() - start
+    return report
+
+
+def get_archive_format(path: str | os.PathLike | None) -> str:
+    """
+    the archive format by the suffix of `path` (a `.gpg` suffix is skipped), "tar" if unknown
+    """
+    name = os.fspath(path or "").lower().removesuffix(".gpg")
+    for archive_format, suffixes in ARCHIVE_FORMATS.items():
+        if name.endswith(suffixes):
+            return archive_format
+    return "tar"
+
+
+@dataclass
+class ArchiveReport:
+    """
+    The report of `write_archive`, `size` is the total bytes of the configs before compression.
+    """
+    members: int = 0
+    size: int = 0
+    failures: list[DeviceRenderTiming] = field(default_factory=list)
+    total_time: float = 0.0
+
+
+@contextlib.contextmanager
+def _open_archive(fileobj: typing.BinaryIO, archive_format: str) -> typing.Iterator[typing.Callable[[str, bytes], None]]:
+    # yield a function adding a member with fixed metadata
+    if archive_format == "zip":
+        with zipfile.ZipFile(fileobj, "w") as archive:
+            def add(name: str, data: bytes):
+                info = zipfile.ZipInfo(name, date_time=ZIP_EPOCH)
+                info.create_system = 3  # unix, for the mode
+                info.external_attr = (0o100000 | ARCHIVE_MEMBER_MODE) << 16  # regular file
+                info.compress_type = zipfile.ZIP_DEFLATED
+                archive.writestr(info, data, compresslevel=GZIP_LEVEL)
+
+            yield add
+        return
+    compressed = None
+    if archive_format == "tar.gz":
+        # `tarfile` would write the current time in the gzip header
+        compressed = fileobj = gzip.GzipFile(filename="", mode="wb", compresslevel=GZIP_LEVEL, fileobj=fileobj, mtime=0)
+    try:
+        with tarfile.open(fileobj=fileobj, mode="w|", format=tarfile.PAX_FORMAT) as archive:
+            def add(name: str, data: bytes):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mode = ARCHIVE_MEMBER_MODE
+                info.mtime = info.uid = info.gid = 0
+                info.uname = info.gname = ""
+                archive.addfile(info, io.BytesIO(data))
+                archive.members.clear()  # `TarFile` keeps every `TarInfo` added, only needed for reading
+
+            yield add
+    finally:
+        if compressed is not None:
+            compressed.close()
+
+
+@logger.important_function(print_parameters=["archive_format"])
+def write_archive(config: ConfigParser, fileobj: typing.BinaryIO, archive_format: str = "tar",
+                  selectors: typing.Iterable[str] | None = None) -> ArchiveReport:
+    """
+    Stream the configs of the selected devices into a `{device}.conf` member each, sorted by name.
+    `fileobj` only needs `write` and `flush`, like a pipe or `sys.stdout.buffer`; it's not closed.
+    The memory is bounded by the largest config, except a zip keeps its small central directory entries.
+    A failed device is skipped and recorded in the report.
+
+    :param archive_format: one of `ARCHIVE_FORMATS`
+    :param selectors: see `select_devices`
+    :raise: WireguardConfError if the format is unknown or a selected device name is not found
+    """
+    if archive_format not in ARCHIVE_FORMATS:
+        raise WireguardConfError(f"unknown archive format `{archive_format}`, one of {', '.join(ARCHIVE_FORMATS)}")
+    start = time.perf_counter()
+    report = ArchiveReport()
+    peer_cache = {}
+    with _open_archive(fileobj, archive_format) as add:
+        for device in sorted(select_devices(config, selectors)):
+            if len(peer_cache) > ARCHIVE_PEER_CACHE_SIZE:
+                peer_cache.clear()
+            try:
+                name = get_config_name(device)
+                data = render_device(device, config, peer_cache)
+            except Exception as err:
+                report.failures.append(DeviceRenderTiming(device, error=f"{type(err).__name__}: {err}"))
+                logger.warning('failed to render "%s": %s', device, report.failures[-1].error)
+                continue
+            add(name, data)
+            report.members += 1
+            report.size += len(data)
+    report.total_time = time.perf_counter() - start
+    return report
@@ -2,8 +2,11 @@
 
 """
 from wg_config_manager.load_plugin import FunctionParameter, AcquireValue
+from wg_config_manager.profiling import run_subprocess
 
+import shutil
 import typing
+import threading
 import subprocess
 from pathlib import Path
 from tempfile import TemporaryDirectory, NamedTemporaryFile
@@ -13,7 +16,7 @@ def gpg_list_keys(gpg_path: str, timeout: typing.Optional[int | float] = None) -
     """
     list gpg keys.
     """
-    p = subprocess.run([gpg_path, "--list-keys"], check=True, text=True, capture_output=True, timeout=timeout)
+    p = run_subprocess([gpg_path, "--list-keys"], check=True, text=True, capture_output=True, timeout=timeout)
     return p.stdout
 
 
@@ -26,7 +29,7 @@ def gpg_encrypt_symmetric(file_path: str, output: str | None, gpg_path: str,
         cmds = [gpg_path, "--symmetric", file_path]
     else:
         cmds = [gpg_path, "--output", output, "--symmetric", file_path]
-    subprocess.run(cmds, check=True, text=True, capture_output=True, timeout=timeout)
+    run_subprocess(cmds, check=True, text=True, capture_output=True, timeout=timeout)
 
 
 def gpg_decrypt_symmetric(file_path: str, gpg_path: str | None = None,
@@ -34,7 +37,7 @@ def gpg_decrypt_symmetric(file_path: str, gpg_path: str | None = None,
     """
     Decrypt a symmetric encrypted file by gpg, return decrypted dytes.
     """
-    p = subprocess.run([gpg_path, "--decrypt", file_path], check=True, capture_output=True, timeout=timeout)
+    p = run_subprocess([gpg_path, "--decrypt", file_path], check=True, capture_output=True, timeout=timeout)
     return p.stdout
 
 
@@ -61,7 +64,7 @@ class EncryptIO:
             gpg_path = self.PATH_GPG
         if timeout is None:
             timeout = self.TIMEOUT
-        p = subprocess.run([gpg_path, "--list-keys"], check=True, text=True, capture_output=True, timeout=timeout)
+        p = run_subprocess([gpg_path, "--list-keys"], check=True, text=True, capture_output=True, timeout=timeout)
         return p.stdout
 
     def gpg_encrypt_symmetric(self, file_path: str, output=None, gpg_path: str | None = None,
@@ -84,7 +87,7 @@ class EncryptIO:
             gpg_path = self.PATH_GPG
         if timeout is None:
             timeout = self.TIMEOUT
-        p = subprocess.run([gpg_path, "--decrypt", file_path], check=True, capture_output=True, timeout=timeout)
+        p = run_subprocess([gpg_path, "--decrypt", file_path], check=True, capture_output=True, timeout=timeout)
         return p.stdout
 
 
@@ -110,6 +113,81 @@ def gpg_decrypt_symmetric_callback(target, gpg_path, timeout) -> bytes:
         return gpg_decrypt_symmetric(fp.name, gpg_path, timeout)
 
 
+class GpgEncryptStream:
+    """
+    A writable stream symmetric encrypted by gpg into `output`, without temporary files.
+    `close` waits for gpg and raises `subprocess.CalledProcessError` if it failed.
+    """
+
+    def __init__(self, output: typing.BinaryIO, gpg_path: str, timeout: typing.Optional[int | float] = None):
+        self.timeout = timeout
+        self._output = output
+        self._pump = None
+        try:
+            fd = output.fileno()
+        except (AttributeError, OSError):
+            fd = None
+        if fd is not None:
+            output.flush()
+        self.args = [gpg_path, "--output", "-", "--symmetric"]
+        self.process = subprocess.Popen(self.args, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE if fd is None else fd)
+        if fd is None:
+            # `output` is not a file, like `io.BytesIO`
+            self._pump = threading.Thread(target=shutil.copyfileobj, args=(self.process.stdout, output), daemon=True)
+            self._pump.start()
+
+    def write(self, data: bytes) -> int:
+        try:
+            self.process.stdin.write(data)
+        except BrokenPipeError:
+            # gpg exited, raise its return code
+            self.close()
+            raise
+        return len(data)
+
+    def flush(self):
+        self.process.stdin.flush()
+
+    def close(self):
+        if self.process.stdin.closed:
+            return
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        try:
+            self.process.wait(self.timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            raise
+        if self._pump is not None:
+            self._pump.join()
+        if self.process.returncode:
+            raise subprocess.CalledProcessError(self.process.returncode, self.args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.process.kill()
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+            self.process.wait()
+
+
+def gpg_encrypt_symmetric_stream_callback(output: typing.BinaryIO, gpg_path, timeout) -> GpgEncryptStream:
+    """
+    Open a stream symmetric encrypted by gpg into `output`.
+    """
+    return GpgEncryptStream(output, gpg_path, timeout)
+
+
 def read_timeout(s: str):
     r = float(s)
     if r > 0:
@@ -122,6 +200,11 @@ parameters_encrypt = [
     FunctionParameter(name="gpg_path", default="{gpg_path}"),
     FunctionParameter(name="timeout", default="-1", before_pass=read_timeout),
 ]
+parameters_encrypt_stream = [
+    FunctionParameter(name="output", default=AcquireValue("TARGET OUTPUT"), user_accessible=False),
+    FunctionParameter(name="gpg_path", default="{gpg_path}"),
+    FunctionParameter(name="timeout", default="-1", before_pass=read_timeout),
+]
 parameters_decrypt = [
     FunctionParameter(name="target", default=AcquireValue("TARGET DATA"), user_accessible=False),
     FunctionParameter(name="gpg_path", default="{gpg_path}"),
@@ -131,4 +214,5 @@ parameters_decrypt = [
 VERSION_REQ = ""
 
 ENCRYPT_TYPE_GnuPG = {"encrypt": [gpg_encrypt_symmetric_callback, parameters_encrypt],
-                      "decrypt": [gpg_decrypt_symmetric_callback, parameters_decrypt]}
+                      "decrypt": [gpg_decrypt_symmetric_callback, parameters_decrypt],
+                      "encrypt stream": [gpg_encrypt_symmetric_stream_callback, parameters_encrypt_stream]}
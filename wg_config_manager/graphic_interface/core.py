@@ -1,18 +1,368 @@
 """
 core class for development
 """
+import time
+import typing
+import logging
+import itertools
+import threading
 import tkinter as tk
 import tkinter.ttk as ttk
+import concurrent.futures
+from collections import deque
+from dataclasses import dataclass, field
 
+from ..logger import Logger
 
-class FunctionPart:
+logger = Logger(__name__)
+
+POLL_INTERVAL = 50  # ms between deliveries of task results and progress to the ui
+HISTORY_SIZE = 100  # finished tasks kept for the task queue view
+LOG_MAX_LINES = 5000  # lines kept by the log pane
+LOG_BATCH_SIZE = 5000  # records drained from the ui logging handle per flush
+
+# task states
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = frozenset((DONE, FAILED, CANCELLED))
+
+
+@dataclass(eq=False)
+class Task:
+    """
+    A function submitted to `TaskRunner`, run in a worker thread.
+
+    The worker reports progress by `report` and checks `cancelled` (or calls `check_cancelled`) to stop early.
+    The callbacks are called in the ui thread.
+    """
+    id: int
+    name: str
+    on_done: typing.Optional[typing.Callable[[typing.Any], typing.Any]] = None
+    on_error: typing.Optional[typing.Callable[[BaseException], typing.Any]] = None
+    on_progress: typing.Optional[typing.Callable[[float, str], typing.Any]] = None
+    state: str = PENDING
+    progress: float = 0.0  # 0 to 1
+    message: str = ""
+    result: typing.Any = None
+    error: typing.Optional[BaseException] = None
+    submitted_at: float = field(default_factory=time.monotonic)
+    finished_at: typing.Optional[float] = None
+    future: typing.Optional[concurrent.futures.Future] = field(default=None, repr=False)
+    _cancel_event: threading.Event = field(default_factory=threading.Event, repr=False)
+    _runner: typing.Optional["TaskRunner"] = field(default=None, repr=False)
+
+    @property
+    def cancelled(self) -> bool:
+        """
+        whether the cancellation is requested
+        """
+        return self._cancel_event.is_set()
+
+    @property
+    def finished(self) -> bool:
+        return self.state in FINISHED_STATES
+
+    def check_cancelled(self):
+        """
+        raise `concurrent.futures.CancelledError` if the cancellation is requested, call it in the worker
+        """
+        if self._cancel_event.is_set():
+            raise concurrent.futures.CancelledError(self.name)
+
+    def report(self, progress: float, message: str = ""):
+        """
+        Report the progress from the worker. Reports between two deliveries are coalesced to the last one.
+        """
+        self.progress = progress
+        self.message = message
+        if self._runner is not None:
+            self._runner._mark_changed(self)
+
+    def cancel(self) -> bool:
+        """
+        Request to cancel the task. A pending task is cancelled at once,
+        a running one is cancelled when the worker checks `cancelled`.
+        :return: False if the task is finished
+        """
+        if self.finished:
+            return False
+        self._cancel_event.set()
+        if self.future is not None:
+            self.future.cancel()
+        return True
+
+
+class TaskRunner:
     """
+    Run functions on a thread pool, and deliver their results and progress to the ui thread.
 
+    Workers never touch tkinter: they put the changed tasks into a queue, which is drained by one `after` callback
+    every `POLL_INTERVAL` ms while tasks are unfinished, so many reports cost one ui update.
     """
-    def __init__(self):
+
+    def __init__(self, master, max_workers: int | None = 4, poll_interval: int = POLL_INTERVAL,
+                 history_size: int = HISTORY_SIZE):
         """
+        :param master: a tkinter widget, or an object with `after` and `after_cancel` like it
+        :param max_workers: pass to `ThreadPoolExecutor`
+        """
+        self.master = master
+        self.poll_interval = poll_interval
+        self.history_size = history_size
+        self.tasks: dict[int, Task] = {}  # unfinished and recently finished tasks in the submitted order
+        self.listeners: list[typing.Callable[["TaskRunner"], typing.Any]] = []  # called after tasks change
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gui-task")
+        self._ids = itertools.count(1)
+        self._changed: deque[Task] = deque()
+        self._changed_ids: set[int] = set()
+        self._lock = threading.Lock()
+        self._poll_job = None
+        self._closed = False
+
+    def submit(self, function: typing.Callable, *args, name: str | None = None,
+               on_done: typing.Optional[typing.Callable[[typing.Any], typing.Any]] = None,
+               on_error: typing.Optional[typing.Callable[[BaseException], typing.Any]] = None,
+               on_progress: typing.Optional[typing.Callable[[float, str], typing.Any]] = None,
+               pass_task: bool = False, **kwargs) -> Task:
+        """
+        Run `function(*args, **kwargs)` in a worker thread, call it in the ui thread.
 
+        :param on_done: called with the returned value
+        :param on_error: called with the raised exception, the error is logged if it's None
+        :param on_progress: called with the progress and the message of `Task.report`
+        :param pass_task: call `function(task, *args, **kwargs)`, to report progress and check cancellation
         """
+        if self._closed:
+            raise RuntimeError("the task runner is shut down")
+        task = Task(next(self._ids), name or getattr(function, "__name__", repr(function)),
+                    on_done, on_error, on_progress, _runner=self)
+        self.tasks[task.id] = task
+        if pass_task:
+            args = (task, *args)
+        task.future = self._executor.submit(self._run, task, function, args, kwargs)
+        task.future.add_done_callback(lambda _: self._mark_changed(task))
+        self._schedule()
+        self._notify()
+        return task
+
+    def _run(self, task: Task, function, args, kwargs):
+        task.check_cancelled()
+        task.state = RUNNING
+        self._mark_changed(task)
+        return function(*args, **kwargs)
+
+    def _mark_changed(self, task: Task):
+        # called by workers, so only the queue is touched
+        with self._lock:
+            if task.id not in self._changed_ids:
+                self._changed_ids.add(task.id)
+                self._changed.append(task)
+
+    def _schedule(self):
+        if self._poll_job is None and not self._closed:
+            self._poll_job = self.master.after(self.poll_interval, self.poll)
+
+    def poll(self):
+        """
+        Deliver the changed tasks, it's called by `after` in the ui thread.
+        """
+        self._poll_job = None
+        with self._lock:
+            changed = list(self._changed)
+            self._changed.clear()
+            self._changed_ids.clear()
+        for task in changed:
+            if task.future is not None and task.future.done() and not task.finished:
+                self._finish(task)
+            elif task.on_progress is not None and not task.finished:
+                self._call(task, task.on_progress, task.progress, task.message)
+        if changed:
+            self._trim_history()
+            self._notify()
+        if any(not task.finished for task in self.tasks.values()):
+            self._schedule()
+
+    def _finish(self, task: Task):
+        future = task.future
+        task.finished_at = time.monotonic()
+        if future.cancelled():
+            task.state = CANCELLED
+            return
+        error = future.exception()
+        if isinstance(error, concurrent.futures.CancelledError) or (error is None and task.cancelled):
+            task.state = CANCELLED
+        elif error is not None:
+            task.state = FAILED
+            task.error = error
+            if task.on_error is None:
+                logger.error('task "%s" failed: %s', task.name, error)
+            else:
+                self._call(task, task.on_error, error)
+        else:
+            task.state = DONE
+            task.progress = 1.0
+            task.result = future.result()
+            if task.on_done is not None:
+                self._call(task, task.on_done, task.result)
+
+    @staticmethod
+    def _call(task: Task, callback, *args):
+        # a failed callback must not stop the delivery of other tasks
+        try:
+            callback(*args)
+        except Exception as err:
+            logger.error('callback of task "%s" failed: %s', task.name, err)
+
+    def _trim_history(self):
+        finished = [i for i, task in self.tasks.items() if task.finished]
+        for i in finished[:max(0, len(finished) - self.history_size)]:
+            del self.tasks[i]
+
+    def _notify(self):
+        for listener in self.listeners:
+            listener(self)
+
+    @property
+    def pending(self) -> list[Task]:
+        """
+        the unfinished tasks
+        """
+        return [task for task in self.tasks.values() if not task.finished]
+
+    def cancel_all(self):
+        for task in self.pending:
+            task.cancel()
+
+    def shutdown(self, cancel: bool = True, wait: bool = False):
+        """
+        stop accepting tasks, and cancel the unfinished ones if `cancel`
+        """
+        if cancel:
+            self.cancel_all()
+        self._closed = True
+        if self._poll_job is not None:
+            self.master.after_cancel(self._poll_job)
+            self._poll_job = None
+        self._executor.shutdown(wait=wait, cancel_futures=cancel)
+
+
+class FunctionPart:
+    """
+    A part of the ui for a function, its frame is shown in `Window.right_window`.
+    Slow work like key generation, encryption and services runs on the task runner by `submit`.
+    """
+    def __init__(self, runner: typing.Optional[TaskRunner] = None):
+        """
+        :param runner: the task runner of the window
+        """
+        self.runner = runner
+        self.tasks: list[Task] = []
 
     def get_frame(self) -> tk.Frame:
         ...
+
+    def submit(self, function: typing.Callable, *args, **kwargs) -> Task:
+        """
+        Submit `function` to the task runner, see `TaskRunner.submit` for the parameters.
+        """
+        if self.runner is None:
+            raise RuntimeError(f"{type(self).__name__} has no task runner")
+        self.tasks = [task for task in self.tasks if not task.finished]
+        task = self.runner.submit(function, *args, **kwargs)
+        self.tasks.append(task)
+        return task
+
+    def cancel_tasks(self):
+        """
+        cancel the unfinished tasks of this part, like when the part is closed
+        """
+        for task in self.tasks:
+            task.cancel()
+        self.tasks.clear()
+
+
+class LogBuffer:
+    """
+    Render the records of `logger.UILoggingHandle` into a `tk.Text`, in batches.
+
+    Records are formatted into pending lines by `feed`, and `flush` writes all pending lines by one `insert` call,
+    then deletes the oldest lines over `max_lines` by one `delete` call. A message with newlines takes several lines.
+    Every line has a tag of its level and a tag of its logger, so filtering only configures the `elide` option of
+    the tags, instead of rendering the lines again.
+    """
+
+    def __init__(self, max_lines: int = LOG_MAX_LINES):
+        self.max_lines = max_lines
+        self.lines = 0  # lines in the text
+        self.pending: deque[tuple[str, str, int]] = deque(maxlen=max_lines)  # (line, tags, lines)
+        self.min_level = logging.NOTSET
+        self.name_filter = ""
+        self._logger_tags: dict[str, str] = {}  # logger name - tag
+        self._levels: set[int] = set()
+        self._configured: dict[str, bool] = {}  # tag - hidden
+        self._second = None
+        self._time = ""  # "%H:%M:%S" of `_second`
+
+    def _get_logger_tag(self, name: str) -> str:
+        tag = self._logger_tags.get(name)
+        if tag is None:
+            tag = self._logger_tags[name] = f"logger-{len(self._logger_tags)}"
+        return tag
+
+    def feed(self, records: typing.Iterable[tuple[str, int, str, tuple, dict | None, float]]):
+        """
+        format records of `UILoggingHandle.drain` with their time, only the last `max_lines` are kept until `flush`
+        """
+        for name, level, msg, args, _, created in records:
+            if args:
+                try:
+                    msg = msg % args
+                except (TypeError, ValueError):
+                    msg = f"{msg} {args}"
+            second = int(created)
+            if second != self._second:
+                self._second, self._time = second, time.strftime("%H:%M:%S", time.localtime(second))
+            self._levels.add(level)
+            self.pending.append((f"{self._time} {logging.getLevelName(level):<8} {name}: {msg}\n",
+                                 f"level-{level} {self._get_logger_tag(name)}", msg.count("\n") + 1))
+
+    def _configure_tags(self, text):
+        # elide="" leaves the option unset, so a line is hidden if any of its tags hides it
+        tags = [(f"level-{level}", level < self.min_level) for level in self._levels]
+        tags += [(tag, self.name_filter not in name.lower()) for name, tag in self._logger_tags.items()]
+        for tag, hidden in tags:
+            if self._configured.get(tag) != hidden:
+                text.tag_configure(tag, elide=True if hidden else "")
+                self._configured[tag] = hidden
+
+    def flush(self, text) -> int:
+        """
+        write the pending lines to `text`, a `tk.Text` or an object with `insert`, `delete` and `tag_configure`
+
+        :return: the number of records written
+        """
+        count = len(self.pending)
+        if not count:
+            return 0
+        self._configure_tags(text)
+        chunks = []
+        for line, tags, lines in self.pending:
+            chunks += (line, tags)
+            self.lines += lines
+        self.pending.clear()
+        text.insert("end", *chunks)
+        if self.lines > self.max_lines:
+            text.delete("1.0", f"{self.lines - self.max_lines + 1}.0")
+            self.lines = self.max_lines
+        return count
+
+    def set_filter(self, text, min_level: int = logging.NOTSET, name: str = ""):
+        """
+        show the lines at least `min_level` from the loggers whose names contain `name`
+        """
+        self.min_level = min_level
+        self.name_filter = name.strip().lower()
+        self._configure_tags(text)
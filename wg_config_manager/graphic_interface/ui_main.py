@@ -4,6 +4,11 @@ The ui based on tkinter.
 import tkinter as tk
 from dataclasses import dataclass
 from typing import Optional, Callable
+from configparser import ConfigParser
+
+from .core import TaskRunner
+from .widgets import DeviceBrowser, LogPane
+from ..device_index import DeviceIndex
 
 
 @dataclass
@@ -39,6 +44,9 @@ class Window(tk.Frame):
         super().__init__(master, {} if cnf_window is None else cnf_window)
         self._menu_items: list[MenuListItem] = []
         self.window_frames: list[tk.Frame] = []
+        # run slow work of the function parts off the tk thread
+        self.task_runner = TaskRunner(self)
+        self.log_pane: Optional[LogPane] = None
 
         # -- setup frame on window
         # init
@@ -99,11 +107,40 @@ class Window(tk.Frame):
                 return self.menu_item_pop(index)
         raise KeyError(f"cannot found {remove} in menu list")
 
+    def destroy(self):
+        self.task_runner.shutdown()
+        super().destroy()
+
+    def show_device_browser(self, config: ConfigParser) -> DeviceBrowser:
+        """
+        Replace the frames in `right_window` by a browser of the devices in `config`.
+        :param config: config for wireguard
+        """
+        for frame in self.window_frames:
+            frame.destroy()
+        browser = DeviceBrowser(self.right_window, DeviceIndex.from_config(config))
+        browser.pack(fill="both", expand=True)
+        self.window_frames = [browser]
+        return browser
+
+    def show_log_pane(self) -> LogPane:
+        """
+        Show the live log of `logger.DEFAULT_UI_LOGGING_HANDLE` at the bottom of `right_window`.
+        """
+        if self.log_pane is None:
+            self.log_pane = LogPane(self.right_window)
+            self.log_pane.pack(side="bottom", fill="x")
+        return self.log_pane
+
 
-def mainloop():
+def mainloop(config: Optional[ConfigParser] = None):
     """
     Run tkinter GUI mainloop.
+    :param config: config for wireguard, browse its devices if it's set
     """
     root = tk.Tk()
     window = Window(root, cnf_right_window={"bg": "blue"})
+    if config is not None:
+        window.show_device_browser(config)
+    window.show_log_pane()
     tk.mainloop()
@@ -2,5 +2,333 @@
 tkinter widgets
 """
 
+import time
+import typing
+import logging
 import tkinter as tk
 import tkinter.ttk as ttk
+
+from .core import TaskRunner, LogBuffer, LOG_MAX_LINES, LOG_BATCH_SIZE
+from ..logger import UILoggingHandle, DEFAULT_UI_LOGGING_HANDLE
+from ..device_index import DeviceIndex
+
+ROW_HEIGHT = 20
+FILTER_DELAY = 80  # ms to wait for more keystrokes before filtering
+LOG_FLUSH_INTERVAL = 100  # ms between writes of the log pane
+LEVEL_COLORS = {logging.DEBUG: "gray50", logging.WARNING: "dark orange", logging.ERROR: "red",
+                logging.CRITICAL: "red"}
+
+
+class VirtualTreeview(tk.Frame):
+    """
+    A `ttk.Treeview` showing a window of a long sequence of rows.
+
+    The tree has only as many items as visible lines, and they are refilled from `rows` on scroll,
+    so the cost of a frame depends on the height of the widget, not on the number of rows.
+    """
+
+    def __init__(self, master, columns: typing.Sequence[tuple[str, str, int]],
+                 get_values: typing.Callable[[typing.Any], tuple], cnf: typing.Optional[dict] = None):
+        """
+        :param columns: (column id, heading, width)
+        :param get_values: get the column values of an item of `rows`
+        """
+        super().__init__(master, {} if cnf is None else cnf)
+        self.get_values = get_values
+        self.rows: typing.Sequence = ()
+        self.offset = 0
+        self.selected: typing.Optional[int] = None  # index in rows
+        self.on_select: typing.Optional[typing.Callable[[typing.Optional[int]], typing.Any]] = None
+        self.last_frame_time = 0.0  # seconds of the last refresh
+        self._page = 1
+        self._updating = False
+
+        self.tree = tree = ttk.Treeview(self, columns=[c[0] for c in columns], show="headings",
+                                        selectmode="browse", height=1)
+        for column, heading, width in columns:
+            tree.heading(column, text=heading)
+            tree.column(column, width=width, stretch=True)
+        self.scrollbar = ttk.Scrollbar(self, orient="vertical", command=self.yview)
+        self.scrollbar.pack(side="right", fill="y")
+        tree.pack(side="left", fill="both", expand=True)
+
+        tree.bind("<Configure>", self._on_configure)
+        tree.bind("<<TreeviewSelect>>", self._on_tree_select)
+        tree.bind("<MouseWheel>", lambda e: self.yview("scroll", -1 if e.delta > 0 else 1, "units"))
+        tree.bind("<Button-4>", lambda e: self.yview("scroll", -1, "units"))
+        tree.bind("<Button-5>", lambda e: self.yview("scroll", 1, "units"))
+        tree.bind("<Up>", lambda e: self._move_selection(-1))
+        tree.bind("<Down>", lambda e: self._move_selection(1))
+        tree.bind("<Prior>", lambda e: self._move_selection(-self._page))
+        tree.bind("<Next>", lambda e: self._move_selection(self._page))
+
+    def set_rows(self, rows: typing.Sequence):
+        """
+        show `rows` from the top, the sequence is read lazily
+        """
+        self.rows = rows
+        self.offset = 0
+        self.selected = None
+        self.refresh()
+
+    def _on_configure(self, event):
+        page = max(1, event.height // ROW_HEIGHT - 1)
+        if page != self._page:
+            self._page = page
+            self.refresh()
+
+    def _max_offset(self) -> int:
+        return max(0, len(self.rows) - self._page)
+
+    def yview(self, *args):
+        """
+        the scrollbar command: ("moveto", fraction) or ("scroll", n, "units" | "pages")
+        """
+        if not args:
+            return
+        if args[0] == "moveto":
+            offset = round(float(args[1]) * len(self.rows))
+        elif args[0] == "scroll":
+            step = int(args[1]) * (self._page if args[2] == "pages" else 1)
+            offset = self.offset + step
+        else:
+            return
+        offset = min(max(0, offset), self._max_offset())
+        if offset != self.offset:
+            self.offset = offset
+            self.refresh()
+
+    def see(self, index: int):
+        """
+        scroll to show the row `index`
+        """
+        if index < self.offset:
+            self.offset = index
+        elif index >= self.offset + self._page:
+            self.offset = index - self._page + 1
+        self.offset = min(max(0, self.offset), self._max_offset())
+        self.refresh()
+
+    def refresh(self):
+        """
+        fill the visible items from `rows[offset:]`, and create or delete items to fit the page
+        """
+        start = time.perf_counter()
+        tree = self.tree
+        visible = [self.rows[i] for i in range(self.offset, min(len(self.rows), self.offset + self._page))]
+        items = tree.get_children()
+        self._updating = True
+        try:
+            for n, row in enumerate(visible):
+                if n < len(items):
+                    tree.item(items[n], values=self.get_values(row))
+                else:
+                    tree.insert("", "end", iid=f"line{n}", values=self.get_values(row))
+            if len(items) > len(visible):
+                tree.delete(*items[len(visible):])
+            if self.selected is not None and self.offset <= self.selected < self.offset + len(visible):
+                tree.selection_set(f"line{self.selected - self.offset}")
+            else:
+                tree.selection_set(())
+        finally:
+            self._updating = False
+        if self.rows:
+            self.scrollbar.set(self.offset / len(self.rows), (self.offset + len(visible)) / len(self.rows))
+        else:
+            self.scrollbar.set(0, 1)
+        self.last_frame_time = time.perf_counter() - start
+
+    def _on_tree_select(self, event):
+        if self._updating:
+            return
+        selection = self.tree.selection()
+        if not selection:
+            # the selected row is scrolled out
+            return
+        selected = self.offset + self.tree.index(selection[0])
+        if selected != self.selected:
+            self.selected = selected
+            if self.on_select is not None:
+                self.on_select(selected)
+
+    def _move_selection(self, step: int):
+        if not self.rows:
+            return "break"
+        selected = min(max(0, (self.offset if self.selected is None else self.selected) + step), len(self.rows) - 1)
+        self.selected = selected
+        self.see(selected)
+        if self.on_select is not None:
+            self.on_select(selected)
+        return "break"
+
+
+class DeviceBrowser(tk.Frame):
+    """
+    Browse the devices of a `DeviceIndex` and the peers of the selected device, filtered by a search entry.
+    """
+    DEVICE_COLUMNS = (("name", "Name", 160), ("public_key", "Public key", 320), ("address", "Address", 160),
+                      ("endpoint", "Endpoint", 200))
+    PEER_COLUMNS = (("name", "Peer", 160), ("public_key", "Public key", 320), ("allowed_ips", "Allowed IPs", 160),
+                    ("endpoint", "Endpoint", 200))
+
+    def __init__(self, master, index: DeviceIndex, cnf: typing.Optional[dict] = None):
+        super().__init__(master, {} if cnf is None else cnf)
+        self.index = index
+        self.matches: typing.Sequence[int] = range(len(index))
+        self._filter_job = None
+
+        bar = tk.Frame(self)
+        bar.pack(side="top", fill="x")
+        self.query = tk.StringVar(self)
+        self.entry = ttk.Entry(bar, textvariable=self.query)
+        self.entry.pack(side="left", fill="x", expand=True)
+        self.status = ttk.Label(bar)
+        self.status.pack(side="right")
+        self.query.trace_add("write", self._schedule_filter)
+
+        rows = index.rows
+        self.devices = VirtualTreeview(self, self.DEVICE_COLUMNS,
+                                       lambda i: (rows[i].name, rows[i].public_key, rows[i].address,
+                                                  rows[i].endpoint))
+        self.devices.pack(side="top", fill="both", expand=True)
+        self.devices.on_select = self._on_device_select
+        self.peers = VirtualTreeview(self, self.PEER_COLUMNS, self._get_peer_values)
+        self.peers.pack(side="bottom", fill="both", expand=True)
+        self.apply_filter()
+
+    def _get_peer_values(self, i: int) -> tuple:
+        row = self.index.rows[i]
+        return row.name, row.public_key, row.allowed_ips or row.address, row.endpoint
+
+    def _schedule_filter(self, *_):
+        # coalesce keystrokes into one search
+        if self._filter_job is not None:
+            self.after_cancel(self._filter_job)
+        self._filter_job = self.after(FILTER_DELAY, self.apply_filter)
+
+    def apply_filter(self):
+        """
+        search the index with the entry text and show the matching devices
+        """
+        if self._filter_job is not None:
+            self.after_cancel(self._filter_job)
+            self._filter_job = None
+        self.matches = self.index.search(self.query.get())
+        self.devices.set_rows(self.matches)
+        self.peers.set_rows(())
+        self.status.configure(text=f"{len(self.matches)} of {len(self.index)} devices")
+
+    def _on_device_select(self, selected: typing.Optional[int]):
+        if selected is None:
+            self.peers.set_rows(())
+        else:
+            self.peers.set_rows(self.index.get_peers(self.matches[selected]))
+
+
+class TaskQueueView(tk.Frame):
+    """
+    The tasks of a `TaskRunner`, with their states and progress, and a button to cancel the selected task.
+    """
+    COLUMNS = (("name", "Task", 200), ("state", "State", 80), ("progress", "Progress", 80), ("message", "", 240))
+
+    def __init__(self, master, runner: TaskRunner, cnf: typing.Optional[dict] = None):
+        super().__init__(master, {} if cnf is None else cnf)
+        self.runner = runner
+        self.tree = tree = ttk.Treeview(self, columns=[c[0] for c in self.COLUMNS], show="headings",
+                                        selectmode="browse", height=5)
+        for column, heading, width in self.COLUMNS:
+            tree.heading(column, text=heading)
+            tree.column(column, width=width, stretch=True)
+        self.cancel_button = ttk.Button(self, text="Cancel", command=self.cancel_selected)
+        self.cancel_button.pack(side="right", anchor="n")
+        tree.pack(side="left", fill="both", expand=True)
+        runner.listeners.append(self.refresh)
+        self.refresh(runner)
+
+    def refresh(self, runner: TaskRunner):
+        """
+        sync the items with `runner.tasks`, it's a listener of the runner
+        """
+        tree = self.tree
+        tasks = runner.tasks
+        for iid in tree.get_children():
+            if int(iid) not in tasks:
+                tree.delete(iid)
+        for task in tasks.values():
+            values = (task.name, task.state, f"{task.progress:.0%}", task.message)
+            if tree.exists(str(task.id)):
+                tree.item(str(task.id), values=values)
+            else:
+                tree.insert("", "end", iid=str(task.id), values=values)
+
+    def cancel_selected(self):
+        for iid in self.tree.selection():
+            task = self.runner.tasks.get(int(iid))
+            if task is not None:
+                task.cancel()
+
+    def destroy(self):
+        if self.refresh in self.runner.listeners:
+            self.runner.listeners.remove(self.refresh)
+        super().destroy()
+
+
+class LogPane(tk.Frame):
+    """
+    A live view of the records of a `UILoggingHandle`, written in batches every `LOG_FLUSH_INTERVAL` ms,
+    filtered by the minimum level and a part of the logger name.
+    """
+    LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+
+    def __init__(self, master, handle: typing.Optional[UILoggingHandle] = None, max_lines: int = LOG_MAX_LINES,
+                 cnf: typing.Optional[dict] = None):
+        super().__init__(master, {} if cnf is None else cnf)
+        self.handle = DEFAULT_UI_LOGGING_HANDLE if handle is None else handle
+        self.buffer = LogBuffer(max_lines)
+        self.last_flush_time = 0.0  # seconds of the last write
+
+        bar = tk.Frame(self)
+        bar.pack(side="top", fill="x")
+        self.level = tk.StringVar(self, "DEBUG")
+        level = ttk.Combobox(bar, textvariable=self.level, values=self.LEVELS, state="readonly", width=10)
+        level.pack(side="left")
+        self.name = tk.StringVar(self)
+        ttk.Entry(bar, textvariable=self.name).pack(side="left", fill="x", expand=True)
+        self.status = ttk.Label(bar)
+        self.status.pack(side="right")
+        self.level.trace_add("write", self._on_filter)
+        self.name.trace_add("write", self._on_filter)
+
+        self.text = text = tk.Text(self, wrap="none", state="disabled", undo=False)
+        scrollbar = ttk.Scrollbar(self, orient="vertical", command=text.yview)
+        text.configure(yscrollcommand=scrollbar.set)
+        scrollbar.pack(side="right", fill="y")
+        text.pack(side="left", fill="both", expand=True)
+        for level_number, color in LEVEL_COLORS.items():
+            text.tag_configure(f"level-{level_number}", foreground=color)
+        self._job = self.after(LOG_FLUSH_INTERVAL, self.flush)
+
+    def flush(self):
+        """
+        write the records drained from the handle, and scroll to the end if the end was shown
+        """
+        start = time.perf_counter()
+        self.buffer.feed(self.handle.drain(LOG_BATCH_SIZE))
+        if self.buffer.pending:
+            text = self.text
+            follow = text.yview()[1] >= 1.0
+            text.configure(state="normal")
+            self.buffer.flush(text)
+            text.configure(state="disabled")
+            if follow:
+                text.see("end")
+            self.status.configure(text=f"{self.handle.dropped} dropped" if self.handle.dropped else "")
+        self.last_flush_time = time.perf_counter() - start
+        self._job = self.after(LOG_FLUSH_INTERVAL, self.flush)
+
+    def _on_filter(self, *_):
+        self.buffer.set_filter(self.text, logging.getLevelName(self.level.get()), self.name.get())
+
+    def destroy(self):
+        self.after_cancel(self._job)
+        super().destroy()
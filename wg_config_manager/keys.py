@@ -0,0 +1,49 @@
+"""
+Generate WireGuard keys in bulk, without a `wg` process per key.
+
+Private keys and pre-shared keys are random bytes from `os.urandom`, private keys clamped like `wg genkey`.
+Public keys are derived by X25519 of `cryptography`.
+"""
+import os
+import base64
+import typing
+
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+
+KEY_SIZE = 32
+
+
+def gen_private_keys(n: int) -> list[str]:
+    """
+    `n` base64 private keys, like `wg genkey`
+    """
+    data = bytearray(os.urandom(KEY_SIZE * n))
+    for i in range(0, len(data), KEY_SIZE):
+        data[i] &= 248
+        data[i + KEY_SIZE - 1] = data[i + KEY_SIZE - 1] & 127 | 64
+    return [base64.b64encode(data[i:i + KEY_SIZE]).decode("ascii") for i in range(0, len(data), KEY_SIZE)]
+
+
+def gen_pre_shared_keys(n: int) -> list[str]:
+    """
+    `n` base64 pre-shared keys, like `wg genpsk`
+    """
+    data = os.urandom(KEY_SIZE * n)
+    return [base64.b64encode(data[i:i + KEY_SIZE]).decode("ascii") for i in range(0, len(data), KEY_SIZE)]
+
+
+def derive_public_keys(private_keys: typing.Sequence[str]) -> list[str]:
+    """
+    The base64 public keys of base64 private keys, like `wg pubkey`.
+
+    :raise: ValueError if a private key is not 32 bytes of base64
+    """
+    ret = []
+    for key in private_keys:
+        data = base64.b64decode(key, validate=True)
+        if len(data) != KEY_SIZE:
+            raise ValueError(f"a private key should be {KEY_SIZE} bytes, get {len(data)}")
+        public = X25519PrivateKey.from_private_bytes(data).public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+        ret.append(base64.b64encode(public).decode("ascii"))
+    return ret
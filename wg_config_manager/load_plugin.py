@@ -6,20 +6,34 @@ from .storage import PathMap
 from .errors import (ConfigParseError, PluginLoadingError,  # EncryptionError,
                      PluginRuntimeError)
 from .storage import get_parser_from_config
+from .service_metrics import ServiceStats, write_textfile
 
 import os
 import re
+import ast
 import sys
+import json
+import time
 import types
+import random
 import typing
+import asyncio
+import hashlib
+import operator
+import functools
+import threading
+import subprocess
+import concurrent.futures
 import importlib
 import importlib.util
 from pathlib import Path
 from configparser import ConfigParser
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, asdict, field
 
 MINIMUM_PLUGIN_VARIABLES = {"VERSION_REQ"}
 logger = Logger(__name__)
+# guard `sys.modules` when plugins are loaded from several threads
+_SYS_MODULES_LOCK = threading.RLock()
 
 
 def get_plugins(parser: ConfigParser) -> list[str]:
@@ -39,53 +53,207 @@ def get_plugins(parser: ConfigParser) -> list[str]:
     # raise ConfigParseFailException("failed to get plugin-list, check your config file")
 
 
-def load_plugins(parser: ConfigParser) -> dict[str, typing.Any]:
+def get_plugin_dir(parser: ConfigParser, name: str) -> str:
+    """
+    get the value of `plugin_dir-{name}` in `[Extension]`, or the default path `{CONFIG_DIR}/{name}`
+    """
+    path = parser.get("Extension", f"plugin_dir-{name}", fallback=None)
+    if path is None:
+        path = "{CONFIG_DIR}/%s" % name
+    return path
+
+
+def load_plugins(parser: ConfigParser, lazy: bool = False,
+                 manifest_cache: typing.Optional["PluginManifestCache"] = None) -> dict[str, typing.Any]:
     """
     load plugins from config
+
+    :param lazy: If True, read the keywords from the manifest cache and import the modules at the first use.
+    :param manifest_cache: the cache used in lazy mode, use `PluginManifestCache()` if None.
     """
     plugins: dict[str, LoadPluginModule] = {}
+    if lazy and manifest_cache is None:
+        manifest_cache = PluginManifestCache()
 
     # load modules
     for name in get_plugins(parser):
         # read config to get `path`
-        path = parser.get("Extension", f"plugin_dir-{name}", fallback=None)
-        if path is None:
-            path = "{CONFIG_DIR}/%s" % name
+        path = get_plugin_dir(parser, name)
         # load module
-        plugins[name] = load_plugin(path, name)
+        if lazy:
+            plugins[name] = load_plugin_lazily(path, name, manifest_cache, parser=parser)
+        else:
+            plugins[name] = load_plugin(path, name, parser=parser)
+    if lazy:
+        manifest_cache.save()
     return plugins
 
 
-def load_plugin_module(path: str, name: str) -> types.ModuleType:
+@dataclass
+class PluginLoadTiming:
     """
-    load plugin, then return the module
+    The time used to load a plugin, in seconds.
+    `error` is the formatted exception if loading failed.
+    """
+    name: str
+    import_time: float = 0.0
+    scan_time: float = 0.0
+    error: str | None = None
+
+
+@dataclass
+class PluginLoadReport:
+    """
+    The report of `load_plugins_concurrently`.
+    """
+    timings: list[PluginLoadTiming] = field(default_factory=list)
+    total_time: float = 0.0
+
+    @property
+    def failures(self) -> list[PluginLoadTiming]:
+        """
+        the timings of failed plugins
+        """
+        return [i for i in self.timings if i.error is not None]
+
+    def as_dict(self) -> dict[str, typing.Any]:
+        """
+        return the report as a json-serializable dict
+        """
+        return asdict(self)
+
+    def format_table(self) -> str:
+        """
+        return a text table, the slowest plugin first
+        """
+        lines = [f"{'plugin':<24} {'import ms':>10} {'scan ms':>10}  error"]
+        for i in sorted(self.timings, key=lambda t: t.import_time + t.scan_time, reverse=True):
+            lines.append(f"{i.name:<24} {i.import_time * 1000:>10.1f} {i.scan_time * 1000:>10.1f}  {i.error or ''}")
+        lines.append(f"total {self.total_time * 1000:.1f} ms, {len(self.failures)} failed")
+        return "\n".join(lines)
+
+
+def _load_and_validate_plugin(path: str, name: str,
+                              parser: ConfigParser | None) -> tuple[typing.Optional["LoadPluginModule"],
+                                                                    PluginLoadTiming]:
+    """
+    import and validate a plugin, exceptions are recorded to the timing
+    """
+    timing = PluginLoadTiming(name)
+    start = time.perf_counter()
+    try:
+        module = load_plugin_module(path, name)
+    except Exception as err:
+        timing.import_time = time.perf_counter() - start
+        timing.error = f"{type(err).__name__}: {err}"
+        return None, timing
+    timing.import_time = time.perf_counter() - start
+    start = time.perf_counter()
+    try:
+        plugin = LoadPluginModule(module, parser)  # check_minimum_plugin_varbs
+        plugin.check_plugin_version_req()
+        plugin.get_encrypt_types()
+        plugin.get_services()
+    except Exception as err:
+        plugin = None
+        timing.error = f"{type(err).__name__}: {err}"
+    timing.scan_time = time.perf_counter() - start
+    return plugin, timing
+
+
+def load_plugins_concurrently(parser: ConfigParser,
+                              max_workers: int | None = None) -> tuple[dict[str, "LoadPluginModule"],
+                                                                       PluginLoadReport]:
+    """
+    Import and validate plugins on a thread pool.
+    A failed plugin is skipped and recorded in the report, it doesn't block the others.
+
+    :param max_workers: pass to `ThreadPoolExecutor`.
+    :return: the plugins loaded successfully, and the report.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    report = PluginLoadReport()
+    plugins: dict[str, LoadPluginModule] = {}
+    start = time.perf_counter()
+    names = get_plugins(parser)
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="load-plugin") as executor:
+        futures = [executor.submit(_load_and_validate_plugin, get_plugin_dir(parser, name), name, parser)
+                   for name in names]
+        for name, future in zip(names, futures):
+            plugin, timing = future.result()
+            report.timings.append(timing)
+            if plugin is None:
+                logger.warning('failed to load plugin "%s": %s', name, timing.error)
+            else:
+                plugins[name] = plugin
+    report.total_time = time.perf_counter() - start
+    return plugins, report
+
+
+def get_plugin_file_path(path: str, name: str) -> tuple[Path, str]:
+    """
+    Return the plugin file path and the module name.
 
     :param name: name of plugin
     :param path: the value of [Extension.path] in config.
     """
     path = path.format_map(PathMap)
     path = Path(os.path.expanduser(path))
+    return path / f"{name}.py", f"{path.name}.{name}"
+
+
+def load_plugin_module(path: str, name: str) -> types.ModuleType:
+    """
+    load plugin, then return the module
 
+    :param name: name of plugin
+    :param path: the value of [Extension.path] in config.
+    """
     # https://docs.python.org/zh-cn/3/library/importlib.html#importing-a-source-file-directly
-    file_path = path / f"{name}.py"
-    module_name = f"{path.name}.{name}"
+    file_path, module_name = get_plugin_file_path(path, name)
 
     spec = importlib.util.spec_from_file_location(module_name, file_path)
     module = importlib.util.module_from_spec(spec)
-    sys.modules[module_name] = module
-    spec.loader.exec_module(module)
+    with _SYS_MODULES_LOCK:
+        sys.modules[module_name] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        # do not leave a half-initialized module
+        with _SYS_MODULES_LOCK:
+            if sys.modules.get(module_name) is module:
+                del sys.modules[module_name]
+        raise
 
     return module
 
 
 @logger.important_function(print_parameters=["name"])
-def load_plugin(path: str, name: str):
+def load_plugin(path: str, name: str, parser: ConfigParser | None = None):
     """
     lead plugin and return LoadPluginModule object
 
+    :param parser: the config parser pass to `LoadPluginModule`.
     :return: LoadPluginModule
     """
-    return LoadPluginModule(load_plugin_module(path, name))
+    return LoadPluginModule(load_plugin_module(path, name), parser)
+
+
+@logger.important_function(print_parameters=["name"])
+def load_plugin_lazily(path: str, name: str, manifest_cache: typing.Optional["PluginManifestCache"] = None,
+                       parser: ConfigParser | None = None):
+    """
+    lead plugin manifest and return LazyLoadPluginModule object, the module is imported at the first use.
+
+    :param manifest_cache: use `PluginManifestCache()` if None, note that it will not be saved.
+    :param parser: the config parser pass to `LazyLoadPluginModule`.
+    :return: LazyLoadPluginModule
+    """
+    if manifest_cache is None:
+        manifest_cache = PluginManifestCache()
+    file_path, _ = get_plugin_file_path(path, name)
+    return LazyLoadPluginModule(path, name, manifest_cache.get(file_path, name), parser)
 
 
 @dataclass
@@ -100,6 +268,24 @@ class FunctionParameter:
     user_accessible: bool = False
 
 
+def str2bool(value: str | bool) -> bool:
+    """
+    A `FunctionParameter.before_pass` for boolean options, parsed like `ConfigParser.getboolean`:
+    "1", "yes", "true" and "on" are True, "0", "no", "false", "off" and empty are False.
+
+    :raise: ValueError
+    """
+    if isinstance(value, bool):
+        return value
+    value = str(value).strip().lower()
+    if not value:
+        return False
+    try:
+        return ConfigParser.BOOLEAN_STATES[value]
+    except KeyError:
+        raise ValueError(f"not a boolean: {value!r}") from None
+
+
 class AcquireValue:
     """
     The keyword for `FunctionParameter.default`.
@@ -149,49 +335,184 @@ def check_version_req_format(version_req: str) -> list[tuple[str | None]]:
     return ret
 
 
+def _prerelease_key(prerelease: str | None) -> tuple:
+    """
+    The sort key of pre-release part, following SemVer 2.0.0 precedence:
+    a normal version > its pre-release versions, numeric identifiers < non-numeric identifiers,
+    and a larger set of pre-release fields > a smaller set if all the preceding identifiers are equal.
+    """
+    if prerelease is None:
+        return (1,)  # 0.1.0 > 0.1.0-alpha
+    return (0, tuple((0, int(i), "") if i.isdigit() else (1, 0, i) for i in prerelease.split(".")))
+
+
+@dataclass(frozen=True, eq=False)
+class SemVer:
+    """
+    An immutable semantic version, compared by the precomputed `sort_key`.
+    Build metadata is ignored when comparing, like `1.0.0+hello == 1.0.0`.
+    """
+    major: int
+    minor: int
+    patch: int
+    prerelease: str | None = None
+    build: str | None = None
+    sort_key: tuple = field(init=False, repr=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "sort_key",
+                           (self.major, self.minor, self.patch, _prerelease_key(self.prerelease)))
+
+    @classmethod
+    def parse(cls, version: str) -> "SemVer":
+        """
+        same as `parse_semver`
+        """
+        return parse_semver(version)
+
+    @classmethod
+    def from_groups(cls, groups: typing.Sequence[str | None]) -> "SemVer":
+        """
+        build from the groups of `_RE_GET_VERSION`, like `("1", "0", "0", "beta", None)`
+        """
+        major, minor, patch, prerelease, *build = groups
+        return cls(int(major), int(minor), int(patch), prerelease, build[0] if build else None)
+
+    def __str__(self):
+        s = f"{self.major}.{self.minor}.{self.patch}"
+        if self.prerelease is not None:
+            s += f"-{self.prerelease}"
+        if self.build is not None:
+            s += f"+{self.build}"
+        return s
+
+    def __hash__(self):
+        return hash(self.sort_key)
+
+    def __eq__(self, other):
+        if not isinstance(other, SemVer):
+            return NotImplemented
+        return self.sort_key == other.sort_key
+
+    def __lt__(self, other):
+        if not isinstance(other, SemVer):
+            return NotImplemented
+        return self.sort_key < other.sort_key
+
+    def __le__(self, other):
+        if not isinstance(other, SemVer):
+            return NotImplemented
+        return self.sort_key <= other.sort_key
+
+    def __gt__(self, other):
+        if not isinstance(other, SemVer):
+            return NotImplemented
+        return self.sort_key > other.sort_key
+
+    def __ge__(self, other):
+        if not isinstance(other, SemVer):
+            return NotImplemented
+        return self.sort_key >= other.sort_key
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_semver(version: str) -> SemVer:
+    """
+    Parse a semantic versioning string.
+
+    :raise: ConfigParseError
+    """
+    m = _RE_GET_VERSION.match(version)
+    if m is None:
+        raise ConfigParseError(f"failed to parse semantic version `{version}`")
+    return SemVer.from_groups(m.groups())
+
+
+_VERSION_OPERATORS = {">": operator.gt, ">=": operator.ge, "<": operator.lt, "<=": operator.le,
+                      "==": operator.eq, "!=": operator.ne}
+
+
+@dataclass(frozen=True)
+class VersionConstraint:
+    """
+    A parsed version requirement, like `>=0.0.1, !=0.1.0-alpha`.
+    An empty constraint is satisfied by any version.
+    """
+    requirements: tuple[tuple[str, SemVer], ...] = ()
+
+    @classmethod
+    def parse(cls, version_req: str) -> "VersionConstraint":
+        """
+        same as `parse_version_constraint`
+        """
+        return parse_version_constraint(version_req)
+
+    def __str__(self):
+        return ", ".join(f"{log}{ver}" for log, ver in self.requirements)
+
+    def unsatisfied(self, version: SemVer) -> list[tuple[str, SemVer]]:
+        """
+        return the requirements `version` doesn't satisfy
+        """
+        return [(log, ver) for log, ver in self.requirements if not _VERSION_OPERATORS[log](version, ver)]
+
+
+@functools.lru_cache(maxsize=256)
+def parse_version_constraint(version_req: str) -> VersionConstraint:
+    """
+    Parse a version requirement, the format is checked by `check_version_req_format`.
+
+    :raise: ConfigParseError
+    """
+    if not version_req.strip():
+        return VersionConstraint()
+    return VersionConstraint(tuple((log, SemVer.from_groups(groups))
+                                   for log, *groups in check_version_req_format(version_req)))
+
+
+@functools.lru_cache(maxsize=4096)
+def satisfies(version: SemVer | str, constraint: VersionConstraint | str) -> bool:
+    """
+    Check `version` satisfies all requirements in `constraint` or not, results are memoized.
+
+    :raise: ConfigParseError
+    """
+    if isinstance(version, str):
+        version = parse_semver(version)
+    if isinstance(constraint, str):
+        constraint = parse_version_constraint(constraint)
+    return all(_VERSION_OPERATORS[log](version, ver) for log, ver in constraint.requirements)
+
+
+def sort_versions(versions: typing.Iterable[SemVer | str], reverse=False) -> list[SemVer]:
+    """
+    Sort versions by SemVer 2.0.0 precedence.
+    """
+    return sorted((parse_semver(v) if isinstance(v, str) else v for v in versions), reverse=reverse)
+
+
+def best_match(versions: typing.Iterable[SemVer | str],
+               constraint: VersionConstraint | str) -> SemVer | None:
+    """
+    Return the highest version satisfies `constraint`, or None if no one matches.
+    """
+    best = None
+    for v in versions:
+        if isinstance(v, str):
+            v = parse_semver(v)
+        if (best is None or v > best) and satisfies(v, constraint):
+            best = v
+    return best
+
+
 def semver_lg(version: typing.Iterable[str], other: typing.Iterable[str]) -> bool:
     """
     return `version` is larger than `other` or not
     """
-    a, b, c, p, *_ = version
-    x, y, z, q, *_ = other
-
-    if a != x:
-        return int(a) > int(x)
-    if b != y:
-        return int(b) > int(y)
-    if c != z:
-        return int(c) > int(z)
-
-    if p is None:
-        return q is not None  # 0.1.0 > 0.1.0-alpha
-    elif q is None:  # here, p is not None
-        return False  # 0.1.0-alpha < 0.1.0
-
-    m = p.split(".")
-    n = q.split(".")
-    for i, j in zip(m, n):
-        if i.isnumeric() and j.isnumeric():
-            if i != j:
-                return int(i) > int(j)
-            continue
-        elif i.isnumeric() and not j.isnumeric():
-            # numeric identifiers < non-numeric identifiers
-            return False
-        elif (not i.isnumeric()) and j.isnumeric():
-            # non-numeric identifiers > non-numeric identifiers
-            return True
-        if i != j:
-            for u, v in zip(i, j):
-                if u != v:
-                    return ord(u) > ord(v)  # 0.1.0-b > 0.1.0-a
-            return len(i) > len(j)  # 0.1.0-alpha > 0.1.0-a
-    # if all the preceding identifiers are equal
-    # a larger set of pre-release fields has a higher precedence than a smaller set
-    return len(m) > len(n)
-
-
-def check_version_is_req(version_exp: typing.Iterable[str], version: str | tuple) -> bool:
+    return SemVer.from_groups(tuple(version)[:4]) > SemVer.from_groups(tuple(other)[:4])
+
+
+def check_version_is_req(version_exp: typing.Iterable[str], version: str | tuple | SemVer) -> bool:
     """
     Check `version` requires `version_exp` or not.
 
@@ -199,28 +520,18 @@ def check_version_is_req(version_exp: typing.Iterable[str], version: str | tuple
     the item of `check_version_req_format` returned.
     :param version: semantic versioning, like `version.VERSION`
     """
-    log, *ver_exp, _ = version_exp  # e.p. (">=", "0", "0", "1", "alpha", "25Jan2024")
+    log, *ver_exp = version_exp  # e.p. (">=", "0", "0", "1", "alpha", "25Jan2024")
+    if log not in _VERSION_OPERATORS:
+        raise ConfigParseError(
+            f"unknown logic symbol `{log}` in `{version_exp}`, "
+            "use `load_plugin.check_version_req_format` to check it")
     if isinstance(version, str):
-        *ver, _ = _RE_GET_VERSION.match(version).groups()
-    else:
+        ver = parse_semver(version)
+    elif isinstance(version, SemVer):
         ver = version
-    if log == "!=":
-        return ver_exp != ver
-    elif log == "==":
-        return ver_exp == ver
-
-    if log.endswith("=") and ver_exp == ver:
-        return True
-    if log.startswith(">"):
-        # > or >=
-        return semver_lg(ver, ver_exp)
-    if log.startswith("<"):
-        # < or <=
-        return not semver_lg(ver, ver_exp)
-
-    raise ConfigParseError(
-        f"unknown logic symbol `{log}` in `{version_exp}`, "
-        "use `load_plugin.check_version_req_format` to check it")
+    else:
+        ver = SemVer.from_groups(tuple(version)[:4])
+    return _VERSION_OPERATORS[log](ver, SemVer.from_groups(ver_exp))
 
 
 def check_version_is_req_list(version_exp_list: typing.Iterable, version: str) -> bool:
@@ -231,7 +542,7 @@ def check_version_is_req_list(version_exp_list: typing.Iterable, version: str) -
     such as `check_version_req_format` returned.
     :param version: semantic versioning, like `version.VERSION`
     """
-    *v, _ = _RE_GET_VERSION.match(version).groups()
+    v = parse_semver(version)
     return all(check_version_is_req(i, v) for i in version_exp_list)
 
 
@@ -287,6 +598,140 @@ def check_minimum_plugin_varbs(plugin: types.ModuleType):
     return not MINIMUM_PLUGIN_VARIABLES - set(dir(plugin))
 
 
+@dataclass
+class PluginManifest:
+    """
+    The keywords of a plugin, read from its source without importing it.
+    """
+    name: str
+    file_path: str
+    mtime_ns: int
+    size: int
+    sha256: str
+    variables: list[str] = field(default_factory=list)
+    version_req: str | None = None
+    encrypt_types: list[str] = field(default_factory=list)
+    background_services: list[str] = field(default_factory=list)
+
+
+def _literal_disabled(node: ast.expr) -> bool:
+    """
+    return the keyword dict has a literal `"disable": True` or not
+    """
+    if not isinstance(node, ast.Dict):
+        return False
+    for key, value in zip(node.keys, node.values):
+        if isinstance(key, ast.Constant) and key.value == "disable":
+            return isinstance(value, ast.Constant) and bool(value.value)
+    return False
+
+
+def scan_plugin_source(source: bytes, name: str, file_path: str = "<plugin>") -> PluginManifest:
+    """
+    Read the top-level keywords from plugin source by `ast`, the plugin is not executed.
+    Keywords defined dynamically can only be found after the module imported.
+
+    :raise: PluginLoadingError
+    """
+    try:
+        tree = ast.parse(source, filename=file_path)
+    except SyntaxError as err:
+        raise PluginLoadingError(f"failed to parse plugin `{name}`") from err
+    manifest = PluginManifest(name=name, file_path=file_path, mtime_ns=0, size=len(source),
+                              sha256=hashlib.sha256(source).hexdigest())
+    for node in tree.body:
+        if isinstance(node, ast.Assign):
+            targets, value = node.targets, node.value
+        elif isinstance(node, ast.AnnAssign) and node.value is not None:
+            targets, value = [node.target], node.value
+        else:
+            continue
+        for target in targets:
+            if not isinstance(target, ast.Name):
+                continue
+            var = target.id
+            manifest.variables.append(var)
+            if var == "VERSION_REQ":
+                manifest.version_req = value.value if isinstance(value, ast.Constant) else None
+            elif (m := _RE_GET_ENCRYPT_NAME.match(var)) and not _literal_disabled(value):
+                manifest.encrypt_types.append(m.group(1))
+            elif (m := _RE_GET_SERVICE_NAME.match(var)) and not _literal_disabled(value):
+                manifest.background_services.append(m.group(1))
+    return manifest
+
+
+class PluginManifestCache:
+    """
+    On-disk cache of `PluginManifest`, keyed by plugin file path.
+    An entry is reused when the file mtime and size are unchanged, or when the content hash is unchanged.
+    """
+    FORMAT_VERSION = 1
+
+    def __init__(self, cache_path: str | Path | None = None):
+        """
+        :param cache_path: the cache file, `{CONFIG_DIR}/plugin manifest.json` if None.
+        """
+        if cache_path is None:
+            cache_path = PathMap.CONFIG_DIR / "plugin manifest.json"
+        self.cache_path = Path(cache_path)
+        self._entries: dict[str, PluginManifest] = {}
+        self._dirty = False
+        self.load()
+
+    def load(self):
+        """
+        read the cache file, a broken or outdated cache is ignored
+        """
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as fp:
+                data = json.load(fp)
+            if data.get("version") != self.FORMAT_VERSION:
+                return
+            self._entries = {k: PluginManifest(**v) for k, v in data["plugins"].items()}
+        except (OSError, ValueError, TypeError, KeyError, AttributeError):
+            self._entries = {}
+
+    def save(self):
+        """
+        write the cache file if changed
+        """
+        if not self._dirty:
+            return
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.cache_path.with_name(self.cache_path.name + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as fp:
+            json.dump({"version": self.FORMAT_VERSION,
+                       "plugins": {k: asdict(v) for k, v in self._entries.items()}}, fp)
+        os.replace(tmp, self.cache_path)
+        self._dirty = False
+
+    def get(self, file_path: str | Path, name: str) -> PluginManifest:
+        """
+        return the manifest of plugin file, scan it if the cache is missed.
+
+        :raise: PluginLoadingError
+        """
+        key = str(file_path)
+        try:
+            st = os.stat(file_path)
+        except OSError as err:
+            raise PluginLoadingError(f"cannot find plugin `{name}` at `{file_path}`") from err
+        entry = self._entries.get(key)
+        if entry is not None and entry.name == name and (entry.mtime_ns, entry.size) == (st.st_mtime_ns, st.st_size):
+            return entry
+        with open(file_path, "rb") as fp:
+            source = fp.read()
+        if entry is not None and entry.name == name and entry.sha256 == hashlib.sha256(source).hexdigest():
+            # touched, but not modified
+            entry.mtime_ns, entry.size = st.st_mtime_ns, st.st_size
+        else:
+            entry = scan_plugin_source(source, name, key)
+            entry.mtime_ns = st.st_mtime_ns
+        self._entries[key] = entry
+        self._dirty = True
+        return entry
+
+
 def auto_execute_function(execute: typing.Callable, descriptions: list,
                           keyword_arguments: dict[str, typing.Any],
                           format_mapping=None) -> typing.Any:
@@ -340,11 +785,349 @@ def auto_execute_function(execute: typing.Callable, descriptions: list,
         raise PluginRuntimeError(f"error occurred when executing {execute}") from err
 
 
+@dataclass
+class SupervisedProcess:
+    """
+    A service watched by `ServiceSupervisor`.
+    """
+    key: str
+    service: typing.Any
+    process: typing.Any = None
+    failures: int = 0  # the continuous failures, to compute the backoff
+    restarts: int = 0
+    last_exit_code: int | None = None
+    started_at: float = 0.0  # time.monotonic()
+    pidfd: int | None = field(default=None, repr=False)
+    restart_handle: typing.Any = field(default=None, repr=False)
+    poll_task: typing.Any = field(default=None, repr=False)
+    monitor_task: typing.Any = field(default=None, repr=False)
+    stats: ServiceStats = None
+    supervisor: typing.Any = field(default=None, repr=False)  # the `ServiceSupervisor` watching it
+
+    def __post_init__(self):
+        if self.stats is None:
+            self.stats = ServiceStats(self.key)
+
+
+class ServiceSupervisor:
+    """
+    Watch the processes of background services on one shared event loop.
+
+    A watched service object should have attribute `process` (a `subprocess.Popen`),
+    and can have a method `respawn()` which starts a new process and returns it.
+    The exit of a process is known at once by `pidfd` on Linux (polling on other platforms),
+    then the service is restarted by `respawn()` with exponential backoff and jitter.
+
+    If the service object has a coroutine method `health_monitor(record)`, it runs on the loop
+    while the service is watched, `record` is the `SupervisedProcess`.
+    A monitor restarts a wedged service by killing `record.process`.
+
+    A service running a group of processes can have methods `supervise(supervisor, key)` and `unsupervise()`
+    instead of `process`, and watch its members with keys like `{key}#{member}`.
+    """
+
+    def __init__(self, backoff_base: float = 0.5, backoff_max: float = 60.0, jitter: float = 0.2,
+                 stable_time: float = 30.0, poll_interval: float = 0.5, sample_interval: float = 10.0):
+        """
+        :param backoff_base: the delay before the first restart, in seconds.
+        :param backoff_max: the maximum delay before a restart.
+        :param jitter: the delay is multiplied by a random value in `[1 - jitter, 1 + jitter]`.
+        :param stable_time: reset the backoff if the process has run longer than it.
+        :param poll_interval: the interval to poll processes if pidfd is not available.
+        :param sample_interval: the interval to sample CPU and RSS of processes, see `ServiceStats`.
+        """
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.stable_time = stable_time
+        self.poll_interval = poll_interval
+        self.sample_interval = sample_interval
+        self._sample_task = None
+        self._watched: dict[str, SupervisedProcess] = {}
+        self._lock = threading.Lock()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """
+        the event loop, start it if not running
+        """
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever,
+                                                name="service-supervisor", daemon=True)
+                self._thread.start()
+            return self._loop
+
+    def call(self, func: typing.Callable, *args):
+        """
+        call `func` in the loop thread, and return the result
+        """
+        if threading.current_thread() is self._thread:
+            return func(*args)
+        future = concurrent.futures.Future()
+
+        def wrapper():
+            try:
+                future.set_result(func(*args))
+            except BaseException as err:
+                future.set_exception(err)
+
+        self.loop.call_soon_threadsafe(wrapper)
+        return future.result()
+
+    def submit(self, coroutine) -> concurrent.futures.Future:
+        """
+        run a coroutine on the loop, return `concurrent.futures.Future`
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def watch(self, key: str, service: typing.Any) -> SupervisedProcess:
+        """
+        start watching `service.process`
+
+        :raise: KeyError when key already exists.
+        """
+        return self.call(self._watch, key, service)
+
+    def unwatch(self, key: str) -> SupervisedProcess | None:
+        """
+        stop watching, a process exit after this will not be restarted
+        """
+        return self.call(self._unwatch, key)
+
+    def replace(self, key: str, process) -> SupervisedProcess:
+        """
+        watch the new `process` of service `key` instead of the old one,
+        the exit of the old process is not a failure after this. Used to reload a service.
+        `process` can be None to stop watching the old process before stopping it.
+
+        :raise: KeyError
+        """
+        return self.call(self._replace, key, process)
+
+    def get(self, key: str) -> SupervisedProcess | None:
+        """
+        return the watched record
+        """
+        return self._watched.get(key)
+
+    def keys(self) -> list[str]:
+        """
+        return the keys of watched services
+        """
+        return list(self._watched)
+
+    def shutdown(self):
+        """
+        unwatch all services and stop the loop
+        """
+        if self._loop is None:
+            return
+        for key in self.keys():
+            self.unwatch(key)
+        if self._sample_task is not None:
+            self._loop.call_soon_threadsafe(self._sample_task.cancel)
+            self._sample_task = None
+        loop, thread = self._loop, self._thread
+        loop.call_soon_threadsafe(loop.stop)
+        if threading.current_thread() is not thread:
+            thread.join()
+            # let the cancelled tasks finish their cleanup
+            pending = asyncio.all_tasks(loop)
+            for task in pending:
+                task.cancel()
+            if pending:
+                loop.run_until_complete(asyncio.wait(pending))
+            loop.close()
+        self._loop = self._thread = None
+
+    # --- called in the loop thread
+
+    def _watch(self, key: str, service) -> SupervisedProcess:
+        if key in self._watched:
+            raise KeyError(f"service `{key}` is already watched")
+        record = SupervisedProcess(key, service, supervisor=self)
+        self._watched[key] = record
+        self._attach(record, service.process)
+        if self._sample_task is None:
+            self._sample_task = self._loop.create_task(self._sample_loop())
+        if callable(getattr(service, "health_monitor", None)):
+            record.monitor_task = self._loop.create_task(service.health_monitor(record))
+        return record
+
+    def _unwatch(self, key: str) -> SupervisedProcess | None:
+        record = self._watched.pop(key, None)
+        if record is not None:
+            self._detach(record)
+            if record.monitor_task is not None:
+                record.monitor_task.cancel()
+                record.monitor_task = None
+            if record.restart_handle is not None:
+                record.restart_handle.cancel()
+                record.restart_handle = None
+        return record
+
+    def _replace(self, key: str, process) -> SupervisedProcess:
+        record = self._watched[key]
+        self._detach(record)
+        if record.restart_handle is not None:
+            record.restart_handle.cancel()
+            record.restart_handle = None
+        record.failures = 0
+        self._attach(record, process)
+        return record
+
+    def _attach(self, record: SupervisedProcess, process):
+        record.process = process
+        record.started_at = time.monotonic()
+        if process is None:
+            record.stats.pid = None
+            return
+        record.stats.pid = process.pid
+        record.stats.process_started_at = time.time()
+        record.stats.sample()
+        pidfd_open = getattr(os, "pidfd_open", None)
+        if pidfd_open is not None:
+            try:
+                record.pidfd = pidfd_open(process.pid)
+            except ProcessLookupError:
+                # already exited and reaped
+                self._loop.call_soon(self._on_exit, record, process)
+                return
+            except OSError:
+                pass  # pidfd is not supported by kernel
+            else:
+                self._loop.add_reader(record.pidfd, self._on_exit, record, process)
+                return
+        record.poll_task = self._loop.create_task(self._poll(record, process))
+
+    def _detach(self, record: SupervisedProcess):
+        if record.pidfd is not None:
+            self._loop.remove_reader(record.pidfd)
+            os.close(record.pidfd)
+            record.pidfd = None
+        if record.poll_task is not None:
+            record.poll_task.cancel()
+            record.poll_task = None
+
+    async def _poll(self, record: SupervisedProcess, process):
+        while process.poll() is None:
+            await asyncio.sleep(self.poll_interval)
+        record.poll_task = None
+        self._on_exit(record, process)
+
+    def _on_exit(self, record: SupervisedProcess, process):
+        self._detach(record)
+        if self._watched.get(record.key) is not record or record.process is not process:
+            return  # unwatched or replaced
+        try:
+            record.last_exit_code = process.wait(timeout=1)
+        except Exception:
+            record.last_exit_code = process.returncode
+        record.stats.last_exit_code = record.last_exit_code
+        record.stats.pid = None
+        if time.monotonic() - record.started_at >= self.stable_time:
+            record.failures = 0
+        record.failures += 1
+        logger.warning('service "%s" exited with code %s', record.key, record.last_exit_code)
+        if not callable(getattr(record.service, "respawn", None)):
+            return
+        delay = self.get_backoff(record.failures)
+        record.restart_handle = self._loop.call_later(delay, self._restart, record)
+
+    def get_backoff(self, failures: int) -> float:
+        """
+        return the delay before restarting, after `failures` continuous failures
+        """
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (failures - 1))
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def _restart(self, record: SupervisedProcess):
+        record.restart_handle = None
+        if self._watched.get(record.key) is not record:
+            return
+        try:
+            process = record.service.respawn()
+        except Exception as err:
+            logger.error('failed to restart service "%s": %s', record.key, err)
+            record.failures += 1
+            record.restart_handle = self._loop.call_later(self.get_backoff(record.failures), self._restart, record)
+            return
+        record.restarts += 1
+        record.stats.restarts = record.restarts
+        self._attach(record, process)
+
+    def sample(self):
+        """
+        sample CPU and RSS of all watched processes
+        """
+        for record in list(self._watched.values()):
+            record.stats.sample()
+
+    async def _sample_loop(self):
+        while True:
+            await asyncio.sleep(self.sample_interval)
+            self.sample()
+
+
+_DEFAULT_SUPERVISOR: ServiceSupervisor | None = None
+
+
+def get_service_supervisor() -> ServiceSupervisor:
+    """
+    return the default supervisor shared by all plugins
+    """
+    global _DEFAULT_SUPERVISOR
+    if _DEFAULT_SUPERVISOR is None:
+        _DEFAULT_SUPERVISOR = ServiceSupervisor()
+    return _DEFAULT_SUPERVISOR
+
+
+def _is_supervisable(obj) -> bool:
+    """
+    the service object has a process to watch or not
+    """
+    return isinstance(getattr(obj, "process", None), subprocess.Popen)
+
+
+def terminate_process(process: subprocess.Popen, timeout: float | None = 10.0) -> bool:
+    """
+    Send SIGTERM to `process`, then SIGKILL if it's still alive after `timeout` seconds.
+
+    :return: killed or not
+    """
+    if process.poll() is not None:
+        return False
+    process.terminate()
+    try:
+        process.wait(timeout=None if timeout is None else max(timeout, 0))
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+        return True
+    return False
+
+
+@dataclass
+class ServiceBatchReport:
+    """
+    The report of `start_all` and `stop_all`, services are named like `{plugin}/{service}`.
+    """
+    done: list[str] = field(default_factory=list)
+    failed: dict[str, str] = field(default_factory=dict)
+    killed: list[str] = field(default_factory=list)  # killed by SIGKILL after the deadline
+    elapsed: float = 0.0
+
+
 @dataclass
 class Service:
     has_constructor: bool
     returned: typing.Any
     server_name: str
+    started_at: float = field(default_factory=time.time)
 
 
 class LoadPluginModule:
@@ -353,47 +1136,66 @@ class LoadPluginModule:
     """
 
     def __init__(self, plugin_module: types.ModuleType,
-                 parser: ConfigParser | None = None, version=None):
+                 parser: ConfigParser | None = None, version=None,
+                 supervisor: ServiceSupervisor | None = None):
         """
         set up values
 
         :param parser: the config parser. If None, call `get_parser_from_config` when use config.
+        :param supervisor: the supervisor to watch services. If None, use `get_service_supervisor()`.
         """
         # check plugin
         if not check_minimum_plugin_varbs(plugin_module):
             raise PluginLoadingError("minimum plugin variables are not satisfied in", plugin_module)
-        self.plugin_module = plugin_module
+        self._plugin_module = plugin_module
         self.plugin_name = plugin_module.__name__.rsplit(".", 1)[-1]
+        self._setup(parser, version, supervisor)
+
+    def _setup(self, parser, version, supervisor):
         # global config
         self.parser = parser
+        self._supervisor = supervisor
         # package version
         if version is None:
             from .version import VERSION
-            self.VERSION = VERSION
+            version = VERSION
+        self.VERSION = version
         # cache
         self._encrypt_functions = None
         self._services_index_cache = None
         self._service_dict: dict[str, Service] = {}
 
+    @property
+    def plugin_module(self) -> types.ModuleType:
+        """
+        the plugin module
+        """
+        return self._plugin_module
+
+    @property
+    def version_req(self) -> str:
+        """
+        the value of `VERSION_REQ` in plugin
+        """
+        return self.plugin_module.VERSION_REQ
+
     def check_plugin_version_req(self):
         """
         Check whether the plugin version requirements are satisfied.
         
         To check requirements are satisfied with functions:
         ```python
-        assert (check_version_is_req_list(check_version_req_format(plugin_version_req),
-                                          version.VERSION),
-                PluginLoadingException)
+        assert (satisfies(version.VERSION, plugin_version_req), PluginLoadingException)
         ```
         
         """
-        vrf = check_version_req_format(self.plugin_module.VERSION_REQ)
-        *version, _ = _RE_GET_VERSION.match(self.VERSION).groups()
-        for req in vrf:
-            if not check_version_is_req(req, version):
-                raise PluginLoadingError(
-                    f"current version `f{self.VERSION}`"
-                    f"doesn't satisfied the requirements `{req}`")
+        if satisfies(self.VERSION, self.version_req):
+            return
+        constraint = parse_version_constraint(self.version_req)
+        unsatisfied = ", ".join(f"{log}{ver}" for log, ver in constraint.unsatisfied(parse_semver(self.VERSION)))
+        raise PluginLoadingError(
+            f"current version `{self.VERSION}` "
+            f"doesn't satisfied the requirements `{unsatisfied}`")
 
     def get_encrypt_types(self) -> dict[str, dict]:
         """
@@ -405,6 +1207,12 @@ class LoadPluginModule:
         self._encrypt_functions = function_check_encrypt_type(self.plugin_module)
         return self._encrypt_functions
 
+    def get_encrypt_type_names(self) -> list[str]:
+        """
+        Return the names of encrypt types.
+        """
+        return list(self.get_encrypt_types())
+
     def get_decrypt_types(self) -> dict[str, dict]:
         """
         same as `get_encrypt_types`
@@ -421,6 +1229,7 @@ class LoadPluginModule:
             parser = self.parser
         return parser[key] if key in parser.sections() else fallback
 
+    @logger.important_method(print_parameters=["name"])
     def exec_encrypt(self, name, data: bytes, **kwargs) -> bytes:
         """
         auto execute encrypt function
@@ -437,6 +1246,27 @@ class LoadPluginModule:
         mapping.update(self.get_from_config(self.plugin_name, {}))
         return auto_execute_function(exe, dec, kwargs, mapping)
 
+    @logger.important_method(print_parameters=["name"])
+    def open_encrypt_stream(self, name, output: typing.BinaryIO, **kwargs) -> typing.BinaryIO:
+        """
+        Open a writable stream encrypting into `output`, by the key "encrypt stream" of the encrypt type.
+        Closing the stream finishes the encryption.
+
+        :param name: name of encrypt
+        :param output: the value of keyword `TARGET OUTPUT` pass to format mapping.
+        :raise: ValueError if the encrypt type cannot stream
+        :raise: PluginRuntimeError
+        """
+        ls = self.get_encrypt_types()[name]
+        if "encrypt stream" not in ls:
+            raise ValueError("encrypt type cannot stream", name)
+        exe, dec = ls["encrypt stream"]
+        mapping = {"TARGET OUTPUT": output}
+        mapping.update(asdict(PathMap))
+        mapping.update(self.get_from_config(self.plugin_name, {}))
+        return auto_execute_function(exe, dec, kwargs, mapping)
+
+    @logger.important_method(print_parameters=["name"])
     def exec_decrypt(self, name, data: bytes, **kwargs) -> bytes:
         """
         auto execute decrypt function
@@ -464,6 +1294,24 @@ class LoadPluginModule:
         self._services_index_cache = function_check_background_service_type(self.plugin_module)
         return self._services_index_cache
 
+    def get_service_names(self) -> list[str]:
+        """
+        Return the names of services.
+        """
+        return list(self.get_services())
+
+    @property
+    def supervisor(self) -> ServiceSupervisor:
+        """
+        the supervisor to watch services
+        """
+        if self._supervisor is None:
+            self._supervisor = get_service_supervisor()
+        return self._supervisor
+
+    def _supervisor_key(self, process_name: str) -> str:
+        return f"{self.plugin_name}/{process_name}"
+
     def get_service(self, process_name) -> Service:
         """
         get a current service object
@@ -472,6 +1320,68 @@ class LoadPluginModule:
         """
         return self._service_dict[process_name]
 
+    def list_running_services(self) -> list[str]:
+        """
+        Return the process names of running services.
+        """
+        return list(self._service_dict)
+
+    def detach_service_process(self, process_name: str) -> subprocess.Popen | None:
+        """
+        Stop supervising the service `process_name`, and return its process if it has.
+        The process will not be restarted after this, used to stop it.
+
+        :raise: KeyError
+        """
+        service = self._service_dict[process_name]
+        key = self._supervisor_key(process_name)
+        if self.supervisor.get(key) is not None:
+            self.supervisor.unwatch(key)
+        if callable(getattr(service.returned, "unsupervise", None)):
+            service.returned.unsupervise()
+        return service.returned.process if _is_supervisable(service.returned) else None
+
+    def get_service_stats(self, history: bool = False) -> dict[str, dict[str, typing.Any]]:
+        """
+        Return the metrics of running services, like start time, restart count, last exit code, CPU and RSS.
+        The key is `{plugin}/{process}`, and the value is a snapshot from `ServiceStats.snapshot`.
+        Members of a group service are listed as `{plugin}/{process}#{member}`.
+
+        :param history: include the bounded history of samples or not.
+        """
+        ret = {}
+        for process_name, service in list(self._service_dict.items()):
+            key = self._supervisor_key(process_name)
+            record = self.supervisor.get(key)
+            stats = record.stats if record is not None else ServiceStats(key, started_at=service.started_at)
+            snapshot = stats.snapshot(history)
+            snapshot["service"] = service.server_name
+            ret[key] = snapshot
+            for member in self.supervisor.keys():
+                if member.startswith(f"{key}#") and (record := self.supervisor.get(member)) is not None:
+                    ret[member] = record.stats.snapshot(history)
+                    ret[member]["service"] = service.server_name
+        return ret
+
+    def export_service_stats(self, path: str | os.PathLike):
+        """
+        Write the metrics of running services to a Prometheus textfile.
+        """
+        write_textfile(path, self.get_service_stats())
+
+    def start_all(self, max_workers: int | None = None) -> ServiceBatchReport:
+        """
+        Start all services of this plugin concurrently, see `load_plugin.start_all`.
+        """
+        return start_all({self.plugin_name: self}, max_workers=max_workers)
+
+    def stop_all(self, timeout: float = 10.0, max_workers: int | None = None,
+                 min_grace: float | None = None) -> ServiceBatchReport:
+        """
+        Stop all running services of this plugin concurrently, see `load_plugin.stop_all`.
+        """
+        return stop_all({self.plugin_name: self}, timeout=timeout, max_workers=max_workers, min_grace=min_grace)
+
     @logger.important_method(print_parameters=["service_name", "process_name"])
     def run_service(self, service_name: str, process_name: str, **kwargs) -> Service:
         """
@@ -496,8 +1406,36 @@ class LoadPluginModule:
         else:
             service = Service(False, None, service_name)
         self._service_dict[process_name] = service
+        if not service_info.get("supervise", True):
+            return service
+        try:
+            if callable(getattr(service.returned, "supervise", None)):
+                # a group of processes, members are watched by the service itself
+                service.returned.supervise(self.supervisor, self._supervisor_key(process_name))
+            elif _is_supervisable(service.returned):
+                # restart the process by supervisor
+                self.supervisor.watch(self._supervisor_key(process_name), service.returned)
+        except BaseException:
+            # don't keep a half-started service, the name can be used again
+            self._abort_service(process_name)
+            raise
         return service
 
+    def _abort_service(self, process_name: str):
+        """
+        stop and forget the service `process_name` whose start failed
+        """
+        try:
+            process = self.detach_service_process(process_name)
+            if process is not None:
+                terminate_process(process)
+            if "teardown" in self.get_services()[self._service_dict[process_name].server_name]:
+                self.call_service("teardown", process_name)
+        except Exception as err:
+            logger.warning('failed to stop service "%s" after its start failed: %s', process_name, err)
+        finally:
+            self._service_dict.pop(process_name, None)
+
     @logger.important_method(print_parameters=["name", "process_name"])
     def call_service(self, name, process_name, **kwargs):
         """
@@ -525,11 +1463,237 @@ class LoadPluginModule:
         service = self._service_dict[process_name]
         service_name = service.server_name
         info = self.get_services()[service_name]
+        self.detach_service_process(process_name)
         if "teardown" in info:
             self.call_service("teardown", process_name, **kwargs)
         self._service_dict.pop(process_name)
 
 
+class LazyLoadPluginModule(LoadPluginModule):
+    """
+    `LoadPluginModule` created from a `PluginManifest`.
+    The plugin module is imported the first time one of its keywords is used,
+    names of keywords can be listed without importing.
+    """
+
+    def __init__(self, path: str, name: str, manifest: PluginManifest,
+                 parser: ConfigParser | None = None, version=None,
+                 supervisor: ServiceSupervisor | None = None):
+        """
+        :param path: the value of [Extension.path] in config.
+        :param name: name of plugin
+        :param manifest: the manifest of plugin, see `PluginManifestCache.get`.
+        """
+        if MINIMUM_PLUGIN_VARIABLES - set(manifest.variables):
+            raise PluginLoadingError("minimum plugin variables are not satisfied in", manifest.file_path)
+        self.path = path
+        self.manifest = manifest
+        self._plugin_module = None
+        self.plugin_name = name
+        self._setup(parser, version, supervisor)
+
+    @property
+    def is_imported(self) -> bool:
+        """
+        the plugin module is imported or not
+        """
+        return self._plugin_module is not None
+
+    @property
+    def plugin_module(self) -> types.ModuleType:
+        """
+        the plugin module, import it if not imported
+        """
+        if self._plugin_module is None:
+            module = load_plugin_module(self.path, self.plugin_name)
+            if not check_minimum_plugin_varbs(module):
+                raise PluginLoadingError("minimum plugin variables are not satisfied in", module)
+            self._plugin_module = module
+        return self._plugin_module
+
+    @property
+    def version_req(self) -> str:
+        """
+        the value of `VERSION_REQ`, read from manifest if it's a literal
+        """
+        if self.manifest.version_req is not None and not self.is_imported:
+            return self.manifest.version_req
+        return self.plugin_module.VERSION_REQ
+
+    def get_encrypt_type_names(self) -> list[str]:
+        """
+        Return the names of encrypt types, read from manifest if not imported.
+        """
+        if self.is_imported:
+            return super().get_encrypt_type_names()
+        return list(self.manifest.encrypt_types)
+
+    def get_service_names(self) -> list[str]:
+        """
+        Return the names of services, read from manifest if not imported.
+        """
+        if self.is_imported:
+            return super().get_service_names()
+        return list(self.manifest.background_services)
+
+
+def _service_key(plugin_name: str, name: str) -> str:
+    return f"{plugin_name}/{name}"
+
+
+def get_service_dependency_levels(plugins: dict[str, LoadPluginModule],
+                                  services: typing.Iterable[str] | None = None) -> list[list[str]]:
+    """
+    Sort services by the key `depends` declared in `BACKGROUND_SERVICE_*` dicts.
+    A dependency is named `{service}` in the same plugin, or `{plugin}/{service}`.
+    Dependencies of the selected services are included.
+
+    :param services: the selected services like `{plugin}/{service}`,
+    all services without `"autostart": False` if None.
+    :return: levels of services, a service only depends on the services in the previous levels.
+    :raise: PluginRuntimeError
+    """
+    declared: dict[str, dict] = {}
+    for plugin_name, plugin in plugins.items():
+        for name, info in plugin.get_services().items():
+            declared[_service_key(plugin_name, name)] = info
+    if services is None:
+        services = [k for k, v in declared.items() if v.get("autostart", True)]
+
+    depends: dict[str, set[str]] = {}
+    pending = list(services)
+    while pending:
+        key = pending.pop()
+        if key in depends:
+            continue
+        if key not in declared:
+            raise PluginRuntimeError(f"unknown service `{key}`")
+        plugin_name = key.split("/", 1)[0]
+        deps = {d if "/" in d else _service_key(plugin_name, d) for d in declared[key].get("depends", ())}
+        depends[key] = deps
+        pending.extend(deps)
+
+    levels = []
+    done: set[str] = set()
+    while len(done) < len(depends):
+        level = sorted(k for k, v in depends.items() if k not in done and v <= done)
+        if not level:
+            raise PluginRuntimeError("circular dependency in services",
+                                     sorted(k for k in depends if k not in done))
+        levels.append(level)
+        done.update(level)
+    return levels
+
+
+def start_all(plugins: dict[str, LoadPluginModule], services: typing.Iterable[str] | None = None,
+              max_workers: int | None = None) -> ServiceBatchReport:
+    """
+    Start services concurrently, in the order of dependencies. The process name is same as the service name.
+    A service is skipped if it's running, or one of its dependencies failed.
+
+    :param services: the selected services like `{plugin}/{service}`, see `get_service_dependency_levels`.
+    :param max_workers: pass to `ThreadPoolExecutor`.
+    """
+    report = ServiceBatchReport()
+    start = time.perf_counter()
+    levels = get_service_dependency_levels(plugins, services)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="start-all") as executor:
+        for level in levels:
+            futures = {}
+            for key in level:
+                plugin_name, name = key.split("/", 1)
+                plugin = plugins[plugin_name]
+                deps = plugin.get_services()[name].get("depends", ())
+                if any((d if "/" in d else _service_key(plugin_name, d)) in report.failed for d in deps):
+                    report.failed[key] = "dependency failed"
+                elif name in plugin.list_running_services():
+                    report.done.append(key)
+                else:
+                    futures[key] = executor.submit(plugin.run_service, name, name)
+            for key, future in futures.items():
+                try:
+                    future.result()
+                except Exception as err:
+                    report.failed[key] = f"{type(err).__name__}: {err}"
+                else:
+                    report.done.append(key)
+    report.elapsed = time.perf_counter() - start
+    return report
+
+
+def _teardown_has_timeout(plugin: LoadPluginModule, process_name: str) -> bool:
+    teardown = plugin.get_services()[plugin.get_service(process_name).server_name].get("teardown")
+    return teardown is not None and any(i.name == "timeout" for i in teardown[1])
+
+
+def stop_all(plugins: dict[str, LoadPluginModule], timeout: float = 10.0,
+             max_workers: int | None = None, min_grace: float | None = None) -> ServiceBatchReport:
+    """
+    Stop all running services concurrently, dependents first.
+    The processes are terminated by SIGTERM, and killed by SIGKILL if they are still alive at the deadline.
+    Then `teardown` is called, with the seconds left to the deadline as `timeout` if it has the parameter.
+
+    :param timeout: seconds from now to the deadline.
+    :param max_workers: pass to `ThreadPoolExecutor`.
+    :param min_grace: every stage of dependencies waits at least these seconds before SIGKILL, even if
+    the earlier stages used up the deadline. `timeout` divided by the number of stages if None.
+    """
+    report = ServiceBatchReport()
+    start = time.perf_counter()
+    deadline = time.monotonic() + timeout
+    running: dict[str, tuple[LoadPluginModule, str]] = {}
+    for plugin_name, plugin in plugins.items():
+        for process_name in plugin.list_running_services():
+            running[_service_key(plugin_name, process_name)] = (plugin, process_name)
+    # processes are grouped by their services, and stopped in the reversed order of dependencies
+    by_service: dict[str, list[str]] = {}
+    for key, (plugin, process_name) in running.items():
+        service_key = _service_key(key.split("/", 1)[0], plugin.get_service(process_name).server_name)
+        by_service.setdefault(service_key, []).append(key)
+    levels = get_service_dependency_levels(plugins, list(by_service))
+    stages = [[p for s in level for p in by_service.get(s, ())] for level in reversed(levels)]
+    stages = [i for i in stages if i]
+    if min_grace is None:
+        min_grace = timeout / max(len(stages), 1)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stop-all") as executor:
+        for stage in stages:
+            stage_deadline = max(deadline, time.monotonic() + min_grace)
+            # SIGTERM all processes in this stage at once
+            processes = {}
+            for key in stage:
+                plugin, process_name = running[key]
+                process = plugin.detach_service_process(process_name)
+                if process is not None and process.poll() is None:
+                    process.terminate()
+                    processes[key] = process
+            # wait until the deadline, then SIGKILL
+            for key, process in processes.items():
+                try:
+                    process.wait(timeout=max(stage_deadline - time.monotonic(), 0))
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
+                    report.killed.append(key)
+            # teardown, with the rest of the stage deadline if it accepts `timeout`, like a group service
+            futures = {}
+            for key in stage:
+                plugin, process_name = running[key]
+                kwargs = {}
+                if _teardown_has_timeout(plugin, process_name):
+                    kwargs["timeout"] = max(stage_deadline - time.monotonic(), 0)
+                futures[key] = executor.submit(plugin.stop_service, process_name, **kwargs)
+            for key, future in futures.items():
+                try:
+                    future.result()
+                except Exception as err:
+                    report.failed[key] = f"{type(err).__name__}: {err}"
+                else:
+                    report.done.append(key)
+    report.elapsed = time.perf_counter() - start
+    return report
+
+
 def exec_plugin_module(plugin: types.ModuleType):
     """
     
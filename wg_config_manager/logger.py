@@ -4,23 +4,117 @@ setup global logging
 note: It's my first time to use log function.
 Reference: https://docs.python.org/zh-cn/3/howto/logging-cookbook.html#logging-cookbook
 """
+import sys
+import json
+import math
+import queue
+import time
 import types
+import atexit
 import typing
+import inspect
 import logging
+import threading
 import functools
+from collections import deque, Counter
+from configparser import ConfigParser
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from .storage import PathMap
+from .profiling import PROFILER
+
+MAX_LOG_VALUE_LENGTH = 200  # longer strings are truncated in the logs of important functions
+MAX_LOG_ITEMS = 16  # larger containers are summarized
+UI_BUFFER_SIZE = 10000  # records kept for the UI to drain
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+def summarize(value):
+    """
+    Return a short stand-in of `value` for logs.
+    Bytes are never logged since they may be a decrypted payload, long strings and large containers are summarized.
+    The others are returned as is, and formatted by `logging` only if the record is emitted.
+    """
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return f"<{type(value).__name__}: {len(value)} bytes>"
+    if isinstance(value, str):
+        if len(value) > MAX_LOG_VALUE_LENGTH:
+            return f"{value[:MAX_LOG_VALUE_LENGTH]!r}... ({len(value)} chars)"
+        return value
+    if isinstance(value, (list, tuple, set, frozenset, dict)) and len(value) > MAX_LOG_ITEMS:
+        return f"<{type(value).__name__}: {len(value)} items>"
+    return value
+
+
+@functools.lru_cache(maxsize=None)
+def _positional_names(func, skip: int = 0) -> tuple[str, ...]:
+    """
+    names of the positional parameters of `func`, skip the first `skip` ones (like `self`)
+    """
+    try:
+        parameters = inspect.signature(func).parameters.values()
+    except (TypeError, ValueError):
+        return ()
+    names = tuple(p.name for p in parameters
+                  if p.kind in (inspect.Parameter.POSITIONAL_ONLY, inspect.Parameter.POSITIONAL_OR_KEYWORD))
+    return names[skip:]
+
+
+@functools.lru_cache(maxsize=None)
+def _qualified_name(func) -> str:
+    """
+    the timing name of an important function or method
+    """
+    return f"{getattr(func, '__module__', None) or '?'}.{getattr(func, '__qualname__', None) or _get_name(func)}"
+
+
+def get_call_fields(func, args: tuple, kwargs: dict[str, typing.Any], self_or_cls=None) -> dict[str, typing.Any]:
+    """
+    The structured fields of the records of an important function or method:
+    `function`, `plugin` (`plugin_name` of the bound object) and `service` (the `process_name` parameter).
+    The records also have `event` ("call", "return" or "error"), `outcome` and `duration` in seconds.
+    """
+    fields = {"function": _qualified_name(func)}
+    plugin = getattr(self_or_cls, "plugin_name", None)
+    if isinstance(plugin, str):
+        fields["plugin"] = plugin
+    if "process_name" in kwargs:
+        fields["service"] = kwargs["process_name"]
+    else:
+        names = _positional_names(func, 0 if self_or_cls is None else 1)
+        if "process_name" in names and names.index("process_name") < len(args):
+            fields["service"] = args[names.index("process_name")]
+    return fields
+
+
+def _get_name(func) -> str:
+    return func.__name__ if hasattr(func, "__name__") else getattr(type(func), "__name__", "UNKNOWN")
+
+
+def _format_parameters(print_parameters: typing.Iterable[str]) -> str:
+    return ", ".join(f"{name}=%s" for name in print_parameters)
 
 
 class UILoggingHandle:
     """
     UI handle, provides hooks
+
+    The records are kept in a bounded ring buffer, and the UI drains them in batches in its own thread,
+    so a slow UI never blocks the logging thread. The oldest records are dropped and counted when it's full.
     """
 
-    def __init__(self, log_hook: typing.Optional[typing.Callable[[str, int, str, ..., ...], typing.Any]] = None):
+    def __init__(self, log_hook: typing.Optional[typing.Callable[[str, int, str, ..., ...], typing.Any]] = None,
+                 capacity: int = UI_BUFFER_SIZE):
         """
 
-        :param log_hook: UI log hook
+        :param log_hook: UI log hook, called by `flush`
+        :param capacity: size of the ring buffer
         """
         self.log_hook = log_hook
+        # (name, level, msg, args, kws, created)
+        self.records: deque[tuple[str, int, str, tuple, dict | None, float]] = deque(maxlen=capacity)
+        self.dropped = 0
+        self._lock = threading.Lock()
 
     def log(self, name: str, level: int, msg: str, args=(), kws=None):
         """
@@ -32,13 +126,352 @@ class UILoggingHandle:
         :param kws:
         :return:
         """
+        with self._lock:
+            if len(self.records) == self.records.maxlen:
+                self.dropped += 1
+            self.records.append((name, level, msg, args, kws, time.time()))
+
+    def drain(self, max_items: int | None = None) -> list[tuple[str, int, str, tuple, dict | None, float]]:
+        """
+        pop at most `max_items` records (all if None), the oldest first
+        """
+        with self._lock:
+            if max_items is None or max_items >= len(self.records):
+                ret = list(self.records)
+                self.records.clear()
+            else:
+                ret = [self.records.popleft() for _ in range(max_items)]
+        return ret
+
+    def flush(self, max_items: int | None = None) -> int:
+        """
+        drain the records to `log_hook` without their time, called in the UI thread, like by `tk.Misc.after`
+
+        :return: the number of records passed
+        """
+        records = self.drain(max_items)
         if self.log_hook is not None:
-            self.log_hook(name, level, msg, args, kws)
+            for record in records:
+                self.log_hook(*record[:5])
+        return len(records)
 
 
 DEFAULT_UI_LOGGING_HANDLE = UILoggingHandle()
 
 
+class _QueueHandler(QueueHandler):
+    """
+    Merge the message with its args and render the exception in the logging thread, like `QueueHandler.prepare`,
+    so the record doesn't keep references to mutable args or tracebacks. The line is formatted by the listener.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if not record.args and not record.exc_info:
+            return record
+        # a shallow copy for the other handlers, cheaper than `copy.copy`
+        prepared = object.__new__(type(record))
+        prepared.__dict__.update(record.__dict__)
+        record = prepared
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = (self.formatter or logging.Formatter()).formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class _QueueListener(QueueListener):
+    """
+    Flush the handlers once the queue is drained, instead of after every record.
+    """
+
+    def handle(self, record: logging.LogRecord):
+        super().handle(record)
+        if self.queue.empty():
+            for handler in self.handlers:
+                handler.flush()
+
+
+class BufferedRotatingFileHandler(RotatingFileHandler):
+    """
+    The rotating file handler for `setup_logging`. The stream is flushed by the listener after a batch of records,
+    and the file size is counted instead of formatting every record twice to check the rollover.
+    """
+
+    def __init__(self, filename, max_bytes: int = 0, backup_count: int = 0, encoding: str | None = "utf-8"):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding=encoding)
+        self.stream.seek(0, 2)
+        self._size = self.stream.tell()
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        return 0 < self.maxBytes <= self._size
+
+    def doRollover(self):
+        super().doRollover()
+        self._size = 0
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            msg = self.format(record) + self.terminator
+            self.stream.write(msg)
+            self._size += len(msg) if msg.isascii() else len(msg.encode(self.encoding or "utf-8"))
+        except Exception:
+            self.handleError(record)
+
+
+_encode_string = json.encoder.encode_basestring  # the C implementation if available
+
+
+def _encode_value(value) -> str:
+    if isinstance(value, str):
+        return _encode_string(value)
+    if value is True:
+        return "true"
+    if value is False:
+        return "false"
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, float):
+        return repr(value) if math.isfinite(value) else "null"
+    return _encode_string(str(value))
+
+
+class JsonLineFormatter(logging.Formatter):
+    """
+    Format a record as a json line, like
+    `{"ts":1700000000.0,"level":"INFO","logger":"wg_config_manager.load_plugin","msg":"...","event":"return",
+    "function":"wg_config_manager.load_plugin.LoadPluginModule.run_service","duration":0.01,"outcome":"ok",...}`.
+
+    The line is joined from the encoded fields directly, without building a dict of the record.
+    A field in `FIELDS` is written only if the record has it, like the ones set by the important functions.
+    """
+    FIELDS = ("event", "function", "duration", "outcome", "plugin", "service")
+
+    def __init__(self, fields: typing.Iterable[str] | None = None):
+        super().__init__()
+        if fields is not None:
+            self.FIELDS = tuple(fields)
+
+    def format(self, record: logging.LogRecord) -> str:
+        parts = ['{"ts":', repr(record.created), ',"level":"', record.levelname, '","logger":',
+                 _encode_string(record.name), ',"msg":', _encode_string(record.getMessage())]
+        attributes = record.__dict__
+        for key in self.FIELDS:
+            value = attributes.get(key)
+            if value is not None:
+                parts += [',"', key, '":', _encode_value(value)]
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            parts += [',"exc":', _encode_string(record.exc_text)]
+        parts.append("}")
+        return "".join(parts)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep a fraction of the records of each event type, and limit the records per second of each event type.
+    Warnings and errors always pass.
+
+    The event type is `"{function}:{event}"` if it has a rate, or `event` (like "call" and "return"),
+    or the logger name for the other records. Sampling is deterministic: each record adds `rate` credits
+    to its type, and passes when the credits reach 1, so the first record passes and the ratio is exact.
+    """
+
+    def __init__(self, rates: dict[str, float] | None = None, default_rate: float = 1.0,
+                 rate_limit: float = 0.0, clock: typing.Callable[[], float] = time.monotonic):
+        """
+        :param rates: event type - rate (0 to 1)
+        :param rate_limit: max records per second of each event type, 0 for no limit. The burst is one second.
+        """
+        super().__init__()
+        self.rates = dict(rates or {})
+        self.default_rate = default_rate
+        self.rate_limit = rate_limit
+        self.clock = clock
+        self.dropped: Counter = Counter()  # event type - dropped records
+        self._credits: dict[str, float] = {}
+        self._buckets: dict[str, tuple[float, float]] = {}  # event type - (tokens, time)
+        self._lock = threading.Lock()
+
+    def get_event_type(self, record: logging.LogRecord) -> tuple[str, float]:
+        """
+        return the event type and its rate
+        """
+        event = getattr(record, "event", None)
+        if event is None:
+            return record.name, self.rates.get(record.name, self.default_rate)
+        function = getattr(record, "function", None)
+        if function is not None:
+            # the qualified name, then the short name, like `run_service:return`
+            for key in (f"{function}:{event}", f"{function.rpartition('.')[2]}:{event}"):
+                if key in self.rates:
+                    return key, self.rates[key]
+        return event, self.rates.get(event, self.default_rate)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        key, rate = self.get_event_type(record)
+        with self._lock:
+            if rate < 1.0:
+                credit = self._credits.get(key, 1.0 - rate) + rate
+                if credit < 1.0 - 1e-9:  # float rounding
+                    self._credits[key] = credit
+                    self.dropped[key] += 1
+                    return False
+                self._credits[key] = credit - 1.0
+            if self.rate_limit > 0:
+                now = self.clock()
+                tokens, last = self._buckets.get(key, (self.rate_limit, now))
+                tokens = min(self.rate_limit, tokens + (now - last) * self.rate_limit)
+                if tokens < 1.0:
+                    self._buckets[key] = (tokens, now)
+                    self.dropped[key] += 1
+                    return False
+                self._buckets[key] = (tokens - 1.0, now)
+        return True
+
+
+def parse_sample_rates(value: str) -> dict[str, float]:
+    """
+    "call: 0.01, run_service:return: 0.5" -> {"call": 0.01, "run_service:return": 0.5}
+
+    a `{function}:{event}` key matches the qualified or the short name of the function
+
+    :raise: ValueError
+    """
+    ret = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        key, _, rate = item.rpartition(":")
+        rate = float(rate)
+        if not key.strip() or not 0 <= rate <= 1:
+            raise ValueError(f"invalid sample rate: {item.strip()!r}")
+        ret[key.strip()] = rate
+    return ret
+
+
+_listener: QueueListener | None = None
+_queue_handler: QueueHandler | None = None
+
+
+def get_log_handlers(parser: ConfigParser | None = None) -> list[logging.Handler]:
+    """
+    A stderr handler for warnings, and a rotating file handler if `[Common] log` is set.
+
+    ```ini
+    [Common]
+    log = {CONFIG_DIR}/wg_config_manager.log
+    log max bytes = 10485760
+    log backup count = 3
+    ; "text" or "json" (`JsonLineFormatter`)
+    log format = text
+    ; `SamplingFilter` of the file, rates of event types and max records per second of each type
+    log sample rates = call: 0.1, return: 0.1
+    log rate limit = 0
+    ```
+
+    :raise: ValueError if the sample rates are invalid
+    """
+    formatter = logging.Formatter(LOG_FORMAT)
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setLevel(logging.WARNING)
+    stream.setFormatter(formatter)
+    handlers: list[logging.Handler] = [stream]
+    path = parser.get("Common", "log", fallback="") if parser is not None else ""
+    if path:
+        file = BufferedRotatingFileHandler(path.format_map(PathMap),
+                                           parser.getint("Common", "log max bytes", fallback=10 * 1024 * 1024),
+                                           parser.getint("Common", "log backup count", fallback=3))
+        if parser.get("Common", "log format", fallback="text").strip().lower() == "json":
+            file.setFormatter(JsonLineFormatter())
+        else:
+            file.setFormatter(formatter)
+        rates = parse_sample_rates(parser.get("Common", "log sample rates", fallback=""))
+        rate_limit = parser.getfloat("Common", "log rate limit", fallback=0.0)
+        if rates or rate_limit > 0:
+            file.addFilter(SamplingFilter(rates, rate_limit=rate_limit))
+        handlers.append(file)
+    return handlers
+
+
+def setup_logging(parser: ConfigParser | None = None, level: int = logging.INFO,
+                  handlers: list[logging.Handler] | None = None) -> QueueListener:
+    """
+    Route the records of the root logger through a queue to `handlers` in a listener thread,
+    so the disk I/O and formatting are kept off the logging threads.
+    Call it again to reconfigure.
+
+    :param handlers: use `get_log_handlers(parser)` if None.
+    """
+    global _listener, _queue_handler
+    stop_logging()
+    if handlers is None:
+        handlers = get_log_handlers(parser)
+    records = queue.SimpleQueue()
+    _queue_handler = _QueueHandler(records)
+    root = logging.getLogger()
+    root.addHandler(_queue_handler)
+    root.setLevel(level)
+    _listener = _QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def stop_logging():
+    """
+    write the queued records, then stop the listener set by `setup_logging`
+    """
+    global _listener, _queue_handler
+    if _listener is None:
+        return
+    logging.getLogger().removeHandler(_queue_handler)
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = _queue_handler = None
+
+
+atexit.register(stop_logging)
+
+
+class ImportantMethod:
+    """
+    The descriptor returned by `Logger.important_method`.
+
+    The wrapper of the method is made once per descriptor, an access binds it by `types.MethodType`,
+    like a plain function, so nothing is stored in the instance and a copy of it binds to the copy.
+    """
+
+    def __init__(self, logger: "Logger", function: typing.Callable, log_level: int,
+                 print_parameters: typing.Optional[typing.Iterable[str]]):
+        self.logger = logger
+        self.function = function
+        self.log_level = log_level
+        self.print_parameters = print_parameters
+        self.name = function.__name__
+        functools.update_wrapper(self, function)
+        self._call = functools.update_wrapper(
+            functools.partial(logger.method_called, function, log_level, print_parameters), function)
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def bind(self, self_or_cls):
+        """
+        return the wrapper bound to `self_or_cls`
+        """
+        return types.MethodType(self._call, self_or_cls)
+
+    def __get__(self, instance, owner=None):
+        return types.MethodType(self._call, owner if instance is None else instance)
+
+
 class Logger:
     """
     the base logger, provides log decorators
@@ -56,40 +489,35 @@ class Logger:
         """
         return self.logger.debug
         """
-        if self.ui_handle is None:
-            DEFAULT_UI_LOGGING_HANDLE.log(self.logger.name, logging.DEBUG, msg, args, kwargs)
+        (self.ui_handle or DEFAULT_UI_LOGGING_HANDLE).log(self.logger.name, logging.DEBUG, msg, args, kwargs)
         return self.logger.debug(msg, *args, **kwargs)
 
     def info(self, msg, *args, **kwargs):
         """
         return self.logger.info
         """
-        if self.ui_handle is None:
-            DEFAULT_UI_LOGGING_HANDLE.log(self.logger.name, logging.INFO, msg, args, kwargs)
+        (self.ui_handle or DEFAULT_UI_LOGGING_HANDLE).log(self.logger.name, logging.INFO, msg, args, kwargs)
         return self.logger.info(msg, *args, **kwargs)
 
     def warning(self, msg, *args, **kwargs):
         """
         return self.logger.warning
         """
-        if self.ui_handle is None:
-            DEFAULT_UI_LOGGING_HANDLE.log(self.logger.name, logging.WARNING, msg, args, kwargs)
-        return self.logger.debug(msg, *args, **kwargs)
+        (self.ui_handle or DEFAULT_UI_LOGGING_HANDLE).log(self.logger.name, logging.WARNING, msg, args, kwargs)
+        return self.logger.warning(msg, *args, **kwargs)
 
     def error(self, msg, *args, **kwargs):
         """
         return self.logger.error
         """
-        if self.ui_handle is None:
-            DEFAULT_UI_LOGGING_HANDLE.log(self.logger.name, logging.ERROR, msg, args, kwargs)
+        (self.ui_handle or DEFAULT_UI_LOGGING_HANDLE).log(self.logger.name, logging.ERROR, msg, args, kwargs)
         return self.logger.error(msg, *args, **kwargs)
 
     def critical(self, msg, *args, **kwargs):
         """
         return self.logger.critical
         """
-        if self.ui_handle is None:
-            DEFAULT_UI_LOGGING_HANDLE.log(self.logger.name, logging.CRITICAL, msg, args, kwargs)
+        (self.ui_handle or DEFAULT_UI_LOGGING_HANDLE).log(self.logger.name, logging.CRITICAL, msg, args, kwargs)
         return self.logger.critical(msg, *args, **kwargs)
 
     def important_function(self, log_level: int = logging.INFO,
@@ -112,21 +540,42 @@ class Logger:
     def function_called(self, __function, __log_level, __print_parameters, *args, **kwargs):
         """
         Called when the important function be called.
-        """
-        self.before_function_called(__function, args, kwargs, log_level=__log_level,
-                                    print_parameters=__print_parameters)
+        The logs are skipped without any formatting if `__log_level` is disabled,
+        and the call is timed by `profiling.PROFILER` if it's enabled.
+        """
+        enabled = self.logger.isEnabledFor(__log_level)
+        if enabled:
+            extra = get_call_fields(__function, args, kwargs)
+            self.before_function_called(__function, args, kwargs, log_level=__log_level,
+                                        print_parameters=__print_parameters, extra=extra)
+            start = time.perf_counter()
+        span = PROFILER.start(_qualified_name(__function)) if PROFILER.enabled else None
+        failed = False
         try:
             ret = __function(*args, **kwargs)
         except Exception as err:
-            self.logger.error(format(err))
+            failed = True
+            if enabled:
+                self.logger.error("%s", err, extra=dict(extra, event="error", outcome="error",
+                                                        duration=time.perf_counter() - start))
+            else:
+                self.logger.error("%s", err, extra={"event": "error", "outcome": "error",
+                                                    "function": _qualified_name(__function)})
             raise err
         else:
-            self.after_function_called(__function, ret, __log_level)
+            if enabled:
+                self.after_function_called(__function, ret, __log_level,
+                                           extra=dict(extra, event="return", outcome="ok",
+                                                      duration=time.perf_counter() - start))
             return ret
+        finally:
+            if span is not None:
+                span.stop(failed)
 
     def before_function_called(self, func: types.FunctionType, func_args: tuple, func_kwargs: dict[str, typing.Any],
                                log_level: int = logging.INFO,
-                               print_parameters: typing.Optional[typing.Iterable[str]] = None):
+                               print_parameters: typing.Optional[typing.Iterable[str]] = None,
+                               extra: dict[str, typing.Any] | None = None):
         """
         The function called before an important function `func` called.
         :param func: The wrapped important function.
@@ -134,29 +583,26 @@ class Logger:
         :param func_kwargs: function keyword arguments
         :param log_level: log level
         :param print_parameters: the parameters to print, if not found, set `"NOT FOUND!"`
+        :param extra: the structured fields of the record, see `get_call_fields`
         :return: None
         """
-        func_name = func.__name__ if hasattr(func, "__name__") else getattr(type(func), "__name__", "UNKNOWN")
+        extra = dict(extra or (), event="call")
+        func_name = _get_name(func)
         if not print_parameters:
-            self.logger.log(log_level, 'call function "%s"', func_name)
+            self.logger.log(log_level, 'call function "%s"', func_name, extra=extra)
             return
-        f = 'call function "%s", with ' + "=%s, ".join(print_parameters)
-        ls = []
-        key_args = dict(zip(func.__annotations__.keys(), func_args))
+        key_args = dict(zip(_positional_names(func), func_args))
         key_args.update(func_kwargs)
-        for name in print_parameters:
-            if name in key_args:
-                ls.append(key_args[name])
-            else:
-                ls.append('"NOT FOUND!"')
-        self.logger.log(log_level, f, func_name, *ls)
+        ls = [summarize(key_args[name]) if name in key_args else '"NOT FOUND!"' for name in print_parameters]
+        self.logger.log(log_level, 'call function "%s", with ' + _format_parameters(print_parameters),
+                        func_name, *ls, extra=extra)
 
-    def after_function_called(self, func, returned, log_level: int):
+    def after_function_called(self, func, returned, log_level: int, extra: dict[str, typing.Any] | None = None):
         """
-        The function called after an important function `func` called.
+        The function called after an important function `func` called, the returned value is summarized.
         """
-        func_name = func.__name__ if hasattr(func, "__name__") else getattr(type(func), "__name__", "UNKNOWN")
-        self.logger.log(log_level, 'function "%s" exited, returned %s', func_name, returned)
+        self.logger.log(log_level, 'function "%s" exited, returned %s', _get_name(func), summarize(returned),
+                        extra=extra)
 
     def important_method(self, log_level: int = logging.INFO,
                          print_parameters: typing.Optional[typing.Iterable[str]] = None):
@@ -169,36 +615,45 @@ class Logger:
                                  log_level=log_level, print_parameters=print_parameters)
 
     def _important_method(self, func, *, log_level, print_parameters):
-        return type("important_method", (object,),
-                    {"__get__": self._important_method_get,
-                     "function": staticmethod(func), "log_level": log_level, "print_parameters": print_parameters})()
-
-    def _important_method_get(self, important_method_self, owner, owner_cls):
-        wrap = functools.partial(self.method_called,
-                                 important_method_self.function,
-                                 important_method_self.log_level,
-                                 important_method_self.print_parameters,
-                                 owner if owner is not None else owner_cls)
-        return functools.update_wrapper(wrap, important_method_self.function)
+        return ImportantMethod(self, func, log_level, print_parameters)
 
     def method_called(self, __method, __log_level, __print_parameters, __self_or_cls, *args, **kwargs):
         """
         Called when the important function be called.
         """
-        self.before_method_called(__method, args, kwargs, self_or_cls=__self_or_cls, log_level=__log_level,
-                                  print_parameters=__print_parameters)
+        enabled = self.logger.isEnabledFor(__log_level)
+        if enabled:
+            extra = get_call_fields(__method, args, kwargs, __self_or_cls)
+            self.before_method_called(__method, args, kwargs, self_or_cls=__self_or_cls, log_level=__log_level,
+                                      print_parameters=__print_parameters, extra=extra)
+            start = time.perf_counter()
+        span = PROFILER.start(_qualified_name(__method)) if PROFILER.enabled else None
+        failed = False
         try:
             ret = __method(__self_or_cls, *args, **kwargs)
         except Exception as err:
-            self.logger.error(format(err))
+            failed = True
+            if enabled:
+                self.logger.error("%s", err, extra=dict(extra, event="error", outcome="error",
+                                                        duration=time.perf_counter() - start))
+            else:
+                self.logger.error("%s", err, extra={"event": "error", "outcome": "error",
+                                                    "function": _qualified_name(__method)})
             raise err
         else:
-            self.after_method_called(__method, ret, __log_level)
+            if enabled:
+                self.after_method_called(__method, ret, __log_level,
+                                         extra=dict(extra, event="return", outcome="ok",
+                                                    duration=time.perf_counter() - start))
             return ret
+        finally:
+            if span is not None:
+                span.stop(failed)
 
     def before_method_called(self, func, func_args: tuple, func_kwargs: dict[str, typing.Any],
                              self_or_cls, log_level: int = logging.INFO,
-                             print_parameters: typing.Optional[typing.Iterable[str]] = None):
+                             print_parameters: typing.Optional[typing.Iterable[str]] = None,
+                             extra: dict[str, typing.Any] | None = None):
         """
         The function called before an important method called.
         :param func: The wrapped important method.
@@ -207,33 +662,29 @@ class Logger:
         :param self_or_cls: self or cls
         :param log_level: log level
         :param print_parameters: the parameters to print, if not found, set `"NOT FOUND!"`
+        :param extra: the structured fields of the record, see `get_call_fields`
         :return: None
         """
-        method_name = func.__name__ if hasattr(func, "__name__") else getattr(type(func), "__name__", "UNKNOWN")
+        extra = dict(extra or (), event="call")
+        method_name = _get_name(func)
         if not print_parameters:
-            self.logger.log(log_level, 'call method "%s"', method_name)
+            self.logger.log(log_level, 'call method "%s"', method_name, extra=extra)
             return
         # update log message with parameters
-        f = 'call method "%s", with ' + "=%s, ".join(print_parameters)
-        ls = []
-        key_args = dict(zip(func.__annotations__.keys(), func_args))
+        key_args = dict(zip(_positional_names(func, 1), func_args))
         key_args.update(func_kwargs)
-        if type(self_or_cls) is type:
+        if isinstance(self_or_cls, type):
             key_args["cls"] = self_or_cls
         else:
             key_args["self"] = self_or_cls
         # full message
-        for name in print_parameters:
-            if name in key_args:
-                ls.append(key_args[name])
-            else:
-                ls.append('"NOT FOUND!"')
-        self.logger.log(log_level, f, method_name, *ls)
+        ls = [summarize(key_args[name]) if name in key_args else '"NOT FOUND!"' for name in print_parameters]
+        self.logger.log(log_level, 'call method "%s", with ' + _format_parameters(print_parameters),
+                        method_name, *ls, extra=extra)
 
-    def after_method_called(self, func, returned, log_level: int):
+    def after_method_called(self, func, returned, log_level: int, extra: dict[str, typing.Any] | None = None):
         """
-        The function called after an important method called.
+        The function called after an important method called, the returned value is summarized.
         """
-        func = func.__get__
-        func_name = func.__name__ if hasattr(func, "__name__") else getattr(type(func), "__name__", "UNKNOWN")
-        self.logger.log(log_level, 'method "%s" exited, returned %s', func_name, returned)
+        self.logger.log(log_level, 'method "%s" exited, returned %s', _get_name(func), summarize(returned),
+                        extra=extra)
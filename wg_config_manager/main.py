@@ -0,0 +1,17 @@
+"""
+The entry point: the GUI without arguments, the command line otherwise.
+"""
+import sys
+
+
+def main(argv: list[str] | None = None) -> int:
+    """
+    start the GUI if there is no argument, or run the command line, return the exit code
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv:
+        from .graphic_interface.ui_main import mainloop
+        mainloop()
+        return 0
+    from .command_line_interface import main as cli_main
+    return cli_main(argv)
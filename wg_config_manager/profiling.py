@@ -0,0 +1,380 @@
+"""
+Timing instrumentation and profiling.
+
+`PROFILER` records the wall and CPU time of important functions and methods (see `logger.Logger`),
+spans and subprocesses into per-name histograms. When it's disabled, an instrumented call costs one attribute check.
+
+Set the environment variable `WGCM_PROFILE` to profile a run, with comma separated modes:
+
+- `time`: the histograms, and the spans as collapsed stacks for flamegraph tools.
+- `cprofile`: `cProfile` around the run.
+- `tracemalloc`: the top allocations at the end of the run.
+
+The report is written to stderr, or to `{WGCM_PROFILE_OUTPUT}.txt` (with `.folded` and `.pstats`) if it's set.
+"""
+import io
+import os
+import sys
+import math
+import time
+import atexit
+import typing
+import threading
+import contextlib
+import subprocess
+from pathlib import Path
+from collections import Counter
+
+PROFILE_ENV = "WGCM_PROFILE"
+PROFILE_OUTPUT_ENV = "WGCM_PROFILE_OUTPUT"
+PROFILE_MODES = ("time", "cprofile", "tracemalloc")
+HISTOGRAM_BUCKETS = 40  # 2 ** 39 us is about a week
+
+
+class Histogram:
+    """
+    A histogram of durations in seconds, the bucket `i` counts the values in `[2 ** (i - 1), 2 ** i)` microseconds.
+    """
+    __slots__ = ("buckets", "count", "total", "min", "max")
+
+    def __init__(self):
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def add(self, value: float):
+        exponent = math.frexp(value * 1e6)[1] if value > 0 else 0
+        self.buckets[min(max(exponent, 0), HISTOGRAM_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float | None:
+        """
+        the upper bound of the bucket containing the `q` (0 to 1) quantile, None if empty
+        """
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(q * self.count))
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(2 ** i / 1e6, self.max)
+        return self.max
+
+    @property
+    def mean(self) -> float | None:
+        return self.total / self.count if self.count else None
+
+
+class Timing:
+    """
+    The histograms of a function, span or subprocess.
+    The CPU time of a subprocess span is the CPU time of that child, reaped by `os.wait4`.
+    """
+    __slots__ = ("name", "wall", "cpu", "errors")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.wall = Histogram()
+        self.cpu = Histogram()
+        self.errors = 0
+
+    def snapshot(self) -> dict[str, typing.Any]:
+        """
+        return the summary as a json-serializable dict
+        """
+        return {"name": self.name, "count": self.wall.count, "errors": self.errors,
+                "wall_total": self.wall.total, "wall_mean": self.wall.mean,
+                "wall_p50": self.wall.quantile(0.5), "wall_p99": self.wall.quantile(0.99),
+                "wall_max": self.wall.max if self.wall.count else None,
+                "cpu_total": self.cpu.total}
+
+
+class Span:
+    """
+    A timed region, nested spans of a thread make a stack.
+    Use `Profiler.span` as a context manager, or `Profiler.start` then `stop`.
+    """
+    __slots__ = ("profiler", "name", "wall", "cpu", "child_wall", "stack")
+
+    def __init__(self, profiler: "Profiler", name: str):
+        self.profiler = profiler
+        self.name = name
+        self.child_wall = 0.0
+        self.stack = None
+
+    def start(self) -> "Span":
+        self.stack = self.profiler._get_stack()
+        self.stack.append(self)
+        self.cpu = time.thread_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def stop(self, error: bool = False, cpu: float | None = None):
+        """
+        :param cpu: the CPU time to record instead of the one of the current thread
+        """
+        wall = time.perf_counter() - self.wall
+        if cpu is None:
+            cpu = time.thread_time() - self.cpu
+        stack = self.stack
+        path = ";".join(s.name for s in stack[:stack.index(self) + 1]) if self in stack else self.name
+        while stack:
+            if stack.pop() is self:
+                break
+        if stack:
+            stack[-1].child_wall += wall
+        self.profiler.record(self.name, wall, cpu, error, path, wall - self.child_wall)
+
+    def __enter__(self) -> "Span":
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop(exc_type is not None)
+
+
+class Profiler:
+    """
+    Collect `Timing` by name, and the self wall time of collapsed span stacks.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.timings: dict[str, Timing] = {}
+        self.stacks: Counter[str] = Counter()  # "outer;inner" - self wall time in microseconds
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _get_stack(self) -> list[Span]:
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def reset(self):
+        with self._lock:
+            self.timings.clear()
+            self.stacks.clear()
+
+    def span(self, name: str) -> Span | contextlib.nullcontext:
+        """
+        a context manager to time a region, a no-op if disabled
+        """
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return Span(self, name)
+
+    def start(self, name: str) -> Span:
+        """
+        start a span even if disabled, stop it by `Span.stop`
+        """
+        return Span(self, name).start()
+
+    def record(self, name: str, wall: float, cpu: float | None = None, error: bool = False,
+               path: str | None = None, self_wall: float | None = None):
+        """
+        record a duration of `name`
+        """
+        with self._lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = self.timings[name] = Timing(name)
+            timing.wall.add(wall)
+            if cpu is not None:
+                timing.cpu.add(cpu)
+            if error:
+                timing.errors += 1
+            self.stacks[path or name] += round((wall if self_wall is None else self_wall) * 1e6)
+
+    def snapshot(self) -> list[dict[str, typing.Any]]:
+        """
+        the summaries of all timings, the largest total wall time first
+        """
+        with self._lock:
+            timings = list(self.timings.values())
+        return [t.snapshot() for t in sorted(timings, key=lambda t: t.wall.total, reverse=True)]
+
+    def format_table(self) -> str:
+        """
+        return a text table of `snapshot`
+        """
+        def ms(value):
+            return "-" if value is None else f"{value * 1000:.2f}"
+
+        lines = [f"{'name':<48} {'count':>8} {'errors':>6} {'total ms':>10} {'mean ms':>9} {'p50 ms':>9} "
+                 f"{'p99 ms':>9} {'max ms':>9} {'cpu ms':>9}"]
+        for i in self.snapshot():
+            lines.append(f"{i['name']:<48} {i['count']:>8} {i['errors']:>6} {ms(i['wall_total']):>10} "
+                         f"{ms(i['wall_mean']):>9} {ms(i['wall_p50']):>9} {ms(i['wall_p99']):>9} "
+                         f"{ms(i['wall_max']):>9} {ms(i['cpu_total']):>9}")
+        return "\n".join(lines)
+
+    def format_folded(self) -> str:
+        """
+        the collapsed stacks like `outer;inner 123` (microseconds), for flamegraph.pl or speedscope
+        """
+        with self._lock:
+            stacks = sorted(self.stacks.items())
+        return "".join(f"{path.replace(' ', '_')} {us}\n" for path, us in stacks if us > 0)
+
+
+_NULL_CONTEXT = contextlib.nullcontext()
+PROFILER = Profiler()
+
+
+class _RusagePopen(subprocess.Popen):
+    """
+    `subprocess.Popen` reaped by `os.wait4`, keeps the resource usage of the child in `rusage`.
+    `RUSAGE_CHILDREN` can't be used, it sums all children of the process, including ones of other threads.
+    """
+    rusage = None
+
+    def _try_wait(self, wait_flags):
+        try:
+            pid, status, rusage = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            # SIGCHLD is ignored, like in `subprocess.Popen._try_wait`
+            return self.pid, 0
+        if pid == self.pid:
+            self.rusage = rusage
+        return pid, status
+
+
+def run_subprocess(args, input=None, capture_output: bool = False, timeout: float | None = None,
+                   check: bool = False, **kwargs) -> subprocess.CompletedProcess:
+    """
+    `subprocess.run`, timed as span `subprocess {name}` if profiling, like `subprocess wg`,
+    with the CPU time of the child
+    """
+    if not PROFILER.enabled:
+        return subprocess.run(args, input=input, capture_output=capture_output, timeout=timeout, check=check,
+                              **kwargs)
+    if capture_output:
+        kwargs["stdout"] = kwargs["stderr"] = subprocess.PIPE
+    if input is not None:
+        kwargs["stdin"] = subprocess.PIPE
+    span = PROFILER.start(f"subprocess {Path(os.fspath(args[0])).stem}")
+    process = None
+    error = True
+    try:
+        with _RusagePopen(args, **kwargs) as process:
+            try:
+                stdout, stderr = process.communicate(input, timeout=timeout)
+            except BaseException:
+                process.kill()
+                raise
+        result = subprocess.CompletedProcess(process.args, process.returncode, stdout, stderr)
+        if check:
+            result.check_returncode()
+        error = False
+        return result
+    finally:
+        rusage = getattr(process, "rusage", None)
+        span.stop(error, rusage.ru_utime + rusage.ru_stime if rusage is not None else 0.0)
+
+
+def parse_modes(value: str) -> set[str]:
+    """
+    parse `WGCM_PROFILE` like "time,cprofile", "1" means "time"
+
+    :raise: ValueError
+    """
+    modes = {i.strip().lower() for i in value.split(",") if i.strip()}
+    if modes & {"1", "true", "on"}:
+        modes = (modes - {"1", "true", "on"}) | {"time"}
+    unknown = modes - set(PROFILE_MODES)
+    if unknown:
+        raise ValueError(f"unknown profile modes: {', '.join(sorted(unknown))}")
+    return modes
+
+
+class ProfileRun:
+    """
+    Profile between `start` and `stop`, then `report`.
+    """
+
+    def __init__(self, modes: typing.Iterable[str] = ("time",), output: str | os.PathLike | None = None):
+        """
+        :param modes: items of `PROFILE_MODES`, the histograms are always recorded.
+        :param output: the path prefix of report files, write the report to stderr if None.
+        """
+        self.modes = set(modes)
+        self.output = output
+        self.cprofile = None
+        self.stopped = False
+
+    def start(self) -> "ProfileRun":
+        PROFILER.enabled = True
+        if "tracemalloc" in self.modes:
+            import tracemalloc
+            tracemalloc.start(10)
+        if "cprofile" in self.modes:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        return self
+
+    def stop(self) -> str:
+        """
+        stop profiling, write and return the report
+        """
+        if self.stopped:
+            return ""
+        self.stopped = True
+        if self.cprofile is not None:
+            self.cprofile.disable()
+        PROFILER.enabled = False
+        sections = ["== timings ==", PROFILER.format_table()]
+        if self.cprofile is not None:
+            import pstats
+            stream = io.StringIO()
+            pstats.Stats(self.cprofile, stream=stream).sort_stats("cumulative").print_stats(30)
+            sections += ["== cProfile ==", stream.getvalue()]
+        if "tracemalloc" in self.modes:
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            sections += ["== tracemalloc =="] + [str(i) for i in snapshot.statistics("lineno")[:20]]
+        report = "\n".join(sections) + "\n"
+        if self.output is None:
+            sys.stderr.write(report)
+        else:
+            prefix = os.fspath(self.output)
+            with open(f"{prefix}.txt", "w", encoding="utf-8") as fp:
+                fp.write(report)
+            with open(f"{prefix}.folded", "w", encoding="utf-8") as fp:
+                fp.write(PROFILER.format_folded())
+            if self.cprofile is not None:
+                self.cprofile.dump_stats(f"{prefix}.pstats")
+        return report
+
+    def __enter__(self) -> "ProfileRun":
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+def start_from_env() -> ProfileRun | None:
+    """
+    start profiling if `WGCM_PROFILE` is set, and report at exit
+    """
+    value = os.environ.get(PROFILE_ENV, "")
+    if not value:
+        return None
+    try:
+        modes = parse_modes(value)
+    except ValueError as err:
+        sys.stderr.write(f"{PROFILE_ENV}: {err}\n")
+        return None
+    run = ProfileRun(modes, os.environ.get(PROFILE_OUTPUT_ENV) or None).start()
+    atexit.register(run.stop)
+    return run
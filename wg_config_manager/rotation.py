@@ -0,0 +1,222 @@
+"""
+Rotate the keys or the pre-shared keys of many devices in one transaction.
+
+`rotate` returns a new network config with fresh keys, generated in bulk by `keys`, and the minimal set of devices
+whose configs change: the rotated devices and the devices having them as peers.
+`commit` renders these configs and writes them with the network config as one transaction.
+
+A staged rotation stores the new keys as `next private key` and `next public key` and keeps the current ones.
+The configs of the peers list the next public key as an extra peer without `AllowedIPs`: WireGuard gives an
+address range to one peer only, so the staged peer only pre-provisions the key and carries no traffic.
+The traffic moves to the new keys at `cutover`, which replaces the keys by the next ones in one commit,
+or discards them.
+"""
+import io
+import os
+import time
+import typing
+from dataclasses import dataclass, field
+from configparser import ConfigParser
+
+from .logger import Logger
+from .errors import WireguardConfError
+from .keys import gen_private_keys, gen_pre_shared_keys, derive_public_keys
+from .storage import write_files_atomic
+from .wireguard_core import RESERVED_KEYS, get_config_for, read_config
+
+logger = Logger(__name__)
+
+NEXT_PRIVATE_KEY = "next private key"
+NEXT_PUBLIC_KEY = "next public key"
+PSK_PREFIX = "pre-shared key["
+
+
+@dataclass
+class RotationResult:
+    """
+    The result of `rotate` or `cutover`, `config` is the new network config.
+    `timings` are the seconds used by each step, like `keygen` and `derive`.
+    """
+    config: ConfigParser
+    rotated: list[str] = field(default_factory=list)
+    psk_pairs: list[tuple[str, str]] = field(default_factory=list)
+    affected: list[str] = field(default_factory=list)
+    staged: bool = False
+    timings: dict[str, float] = field(default_factory=dict)
+
+
+def copy_config(config: ConfigParser) -> ConfigParser:
+    """
+    a copy of a network config, values are copied raw
+    """
+    text = io.StringIO()
+    config.write(text)
+    return read_config(text.getvalue())
+
+
+def _get_devices(config: ConfigParser) -> list[str]:
+    return [i for i in config.sections() if i not in RESERVED_KEYS]
+
+
+def get_affected_devices(config: ConfigParser, devices: typing.Iterable[str],
+                         include_devices: bool = True) -> list[str]:
+    """
+    `devices` and the devices having one of them as a peer, in the config order.
+    A device without `peers` has all other devices as peers.
+
+    :param include_devices: include `devices` themselves, else only if they are peers of each other
+    """
+    devices = set(devices)
+    affected = []
+    for device in _get_devices(config):
+        if include_devices and device in devices:
+            affected.append(device)
+            continue
+        peers = config.get(device, "peers", fallback=None)
+        if peers:
+            if any((i := j.strip()) in devices and i != device for j in peers.split(",")):
+                affected.append(device)
+        elif len(devices) > (device in devices):
+            affected.append(device)
+    return affected
+
+
+def get_psk_pairs(config: ConfigParser, devices: typing.Iterable[str]) -> list[tuple[str, str]]:
+    """
+    The pairs of devices having a pre-shared key, with one of `devices`.
+    The key of a pair (a, b) is `pre-shared key[b]` of a, used in the config of b, and `pre-shared key[a]` of b.
+    """
+    devices = set(devices)
+    names = {i.lower(): i for i in _get_devices(config)}  # option names are lower case
+    pairs = {}
+    for device in names.values():
+        for option in config.options(device):
+            if option.startswith(PSK_PREFIX) and option.endswith("]"):
+                peer = names.get(option[len(PSK_PREFIX):-1])
+                if peer is not None and (device in devices or peer in devices):
+                    pairs.setdefault(tuple(sorted((device, peer))), None)
+    return list(pairs)
+
+
+@logger.important_function(print_parameters=["keys", "psks", "staged"])
+def rotate(config: ConfigParser, selectors: typing.Iterable[str] | None = None, keys: bool = True,
+           psks: bool = False, staged: bool = False) -> RotationResult:
+    """
+    Rotate the keys of the selected devices, `config` is not changed.
+
+    :param selectors: see `export.select_devices`
+    :param keys: rotate the private and public keys
+    :param psks: rotate the existing pre-shared keys between the selected devices and their peers.
+    Both sides of a pre-shared key must change at once, so it cannot be staged.
+    :param staged: store the new keys as the next keys, see `cutover`
+    :raise: WireguardConfError if a device is not found, or pre-shared keys are staged
+    """
+    from .export import select_devices
+
+    if staged and psks:
+        raise WireguardConfError("pre-shared keys cannot be staged, both sides must change at once")
+    timings = {}
+    start = time.perf_counter()
+    devices = select_devices(config, selectors)
+    config = copy_config(config)
+    result = RotationResult(config, staged=staged, timings=timings)
+    timings["copy"] = time.perf_counter() - start
+    if keys:
+        start = time.perf_counter()
+        private_keys = gen_private_keys(len(devices))
+        timings["keygen"] = time.perf_counter() - start
+        start = time.perf_counter()
+        public_keys = derive_public_keys(private_keys)
+        timings["derive"] = time.perf_counter() - start
+        for device, private_key, public_key in zip(devices, private_keys, public_keys):
+            if staged:
+                config.set(device, NEXT_PRIVATE_KEY, private_key)
+                config.set(device, NEXT_PUBLIC_KEY, public_key)
+            else:
+                config.set(device, "private key", private_key)
+                config.set(device, "public key", public_key)
+                config.set(device, "public key is auto generated", "True")
+        result.rotated = devices
+    if psks:
+        start = time.perf_counter()
+        result.psk_pairs = get_psk_pairs(config, devices)
+        for (a, b), psk in zip(result.psk_pairs, gen_pre_shared_keys(len(result.psk_pairs))):
+            config.set(a, f"{PSK_PREFIX}{b}]", psk)
+            config.set(b, f"{PSK_PREFIX}{a}]", psk)
+        timings["psk"] = time.perf_counter() - start
+    start = time.perf_counter()
+    # the config of a staged device keeps its current key
+    affected = set(get_affected_devices(config, result.rotated, include_devices=not staged))
+    # a pre-shared key changes only the configs of its pair
+    affected.update(i for pair in result.psk_pairs for i in pair)
+    result.affected = [i for i in _get_devices(config) if i in affected]
+    timings["affected"] = time.perf_counter() - start
+    return result
+
+
+@logger.important_function(print_parameters=["discard"])
+def cutover(config: ConfigParser, selectors: typing.Iterable[str] | None = None,
+            discard: bool = False) -> RotationResult:
+    """
+    Replace the keys of the selected devices by their staged next keys, or `discard` the next keys.
+    `config` is not changed, devices without next keys are skipped.
+
+    :raise: WireguardConfError if a device is not found
+    """
+    from .export import select_devices
+
+    start = time.perf_counter()
+    devices = [i for i in select_devices(config, selectors) if config.has_option(i, NEXT_PUBLIC_KEY)]
+    config = copy_config(config)
+    for device in devices:
+        private_key = config.get(device, NEXT_PRIVATE_KEY, fallback=None)
+        public_key = config.get(device, NEXT_PUBLIC_KEY)
+        config.remove_option(device, NEXT_PRIVATE_KEY)
+        config.remove_option(device, NEXT_PUBLIC_KEY)
+        if not discard:
+            if private_key:
+                config.set(device, "private key", private_key)
+            config.set(device, "public key", public_key)
+    affected = get_affected_devices(config, devices, include_devices=not discard)
+    return RotationResult(config, rotated=devices, affected=affected,
+                          timings={"cutover": time.perf_counter() - start})
+
+
+@logger.important_function(print_parameters=["network_path", "out_dir"])
+def commit(result: RotationResult, network_path: str | os.PathLike, out_dir: str | os.PathLike | None = None,
+           fsync: bool = False, version: str | None = None):
+    """
+    Write the network config, and the configs of the affected devices to `{out_dir}/{device}.conf`,
+    as one transaction: all configs are rendered and written to temporary files before any file is replaced.
+    The network config is replaced first, so a crash in between leaves configs that can be rendered again,
+    never configs with keys lost from the network config.
+
+    :param version: the version of the network config read by `storage.read_versioned`, if given the network
+    config must not have changed since
+    :raise: WireguardConfError if a config cannot be rendered, StorageConflictError if the network config changed,
+    nothing is written then
+    """
+    from .export import get_config_path
+
+    files = {}
+    text = io.StringIO()
+    result.config.write(text)
+    files[os.fspath(network_path)] = text.getvalue().encode("utf-8")
+    if out_dir is not None:
+        start = time.perf_counter()
+        os.makedirs(out_dir, exist_ok=True)
+        peer_cache = {}
+        failures = []
+        for device in result.affected:
+            try:
+                path = get_config_path(out_dir, device)
+                files[path] = (get_config_for(device, result.config, peer_cache=peer_cache) + "\n").encode("utf-8")
+            except Exception as err:
+                failures.append(f"{device}: {type(err).__name__}: {err}")
+        result.timings["render"] = time.perf_counter() - start
+        if failures:
+            raise WireguardConfError(f"cannot render {len(failures)} configs, nothing is written: "
+                                     + "; ".join(failures[:10]))
+    start = time.perf_counter()
+    write_files_atomic(files, fsync=fsync, versions=None if version is None else {network_path: version})
+    result.timings["write"] = time.perf_counter() - start
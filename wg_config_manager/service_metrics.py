@@ -0,0 +1,195 @@
+"""
+Runtime metrics of background services, like restarts, uptime, CPU and RSS.
+"""
+import os
+import math
+import time
+import typing
+from collections import deque
+from dataclasses import dataclass, field
+
+HISTORY_SIZE = 360  # samples kept for each service, one hour with the default interval
+PROBE_HISTORY_SIZE = 1000
+
+try:
+    _CLK_TCK = os.sysconf("SC_CLK_TCK")
+    _PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError, OSError):
+    # not a POSIX system
+    _CLK_TCK = _PAGE_SIZE = None
+
+
+def read_process_usage(pid: int) -> tuple[float, int] | None:
+    """
+    Read the CPU seconds (user + system) and RSS bytes of `pid` from `/proc/<pid>`.
+
+    :return: None if the process not found or `/proc` is not available.
+    """
+    if _CLK_TCK is None:
+        return None
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as fp:
+            stat = fp.read()
+        with open(f"/proc/{pid}/statm", "rb") as fp:
+            statm = fp.read()
+    except OSError:
+        return None
+    # the command name may contain spaces, fields are counted after its ')'
+    fields = stat[stat.rindex(b")") + 2:].split()
+    cpu = (int(fields[11]) + int(fields[12])) / _CLK_TCK  # utime, stime
+    rss = int(statm.split()[1]) * _PAGE_SIZE
+    return cpu, rss
+
+
+@dataclass
+class ProcessSample:
+    """
+    A sample of process usage.
+    """
+    time: float  # time.monotonic()
+    cpu_seconds: float
+    rss_bytes: int
+    pid: int | None = None
+
+
+def percentile(values: typing.Sequence[float], q: float) -> float | None:
+    """
+    return the `q` (0 to 100) percentile of `values` by nearest rank, None if empty
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+@dataclass
+class ServiceStats:
+    """
+    The metrics of a running service, with a bounded history of samples.
+    The history is kept across restarts, every sample records the pid it was read from.
+    """
+    key: str
+    started_at: float = field(default_factory=time.time)
+    pid: int | None = None
+    process_started_at: float | None = None
+    restarts: int = 0
+    last_exit_code: int | None = None
+    history: deque = field(default_factory=lambda: deque(maxlen=HISTORY_SIZE), repr=False)
+    probes: deque = field(default_factory=lambda: deque(maxlen=PROBE_HISTORY_SIZE), repr=False)
+    probe_failures: int = 0
+
+    def sample(self) -> ProcessSample | None:
+        """
+        read the usage of current process, and append it to history
+        """
+        if self.pid is None:
+            return None
+        usage = read_process_usage(self.pid)
+        if usage is None:
+            return None
+        s = ProcessSample(time.monotonic(), *usage, pid=self.pid)
+        self.history.append(s)
+        return s
+
+    def reset(self):
+        """
+        clear the history of samples and probes
+        """
+        self.history.clear()
+        self.probes.clear()
+        self.probe_failures = 0
+
+    def record_probe(self, latency: float | None):
+        """
+        record the latency of a health probe in seconds, None for a failed probe
+        """
+        if latency is None:
+            self.probe_failures += 1
+        else:
+            self.probes.append(latency)
+
+    @property
+    def cpu_percent(self) -> float | None:
+        """
+        CPU usage between the last two samples, None if they are of different processes
+        """
+        if len(self.history) < 2:
+            return None
+        a, b = self.history[-2], self.history[-1]
+        if a.pid != b.pid or b.time <= a.time or b.cpu_seconds < a.cpu_seconds:
+            return None
+        return (b.cpu_seconds - a.cpu_seconds) / (b.time - a.time) * 100
+
+    def snapshot(self, history: bool = False) -> dict[str, typing.Any]:
+        """
+        return the metrics as a json-serializable dict
+
+        :param history: include the samples or not
+        """
+        last = self.history[-1] if self.history else None
+        probes = list(self.probes)
+        ret = {"key": self.key,
+               "pid": self.pid,
+               "started_at": self.started_at,
+               "uptime": time.time() - self.started_at,
+               "process_uptime": None if self.pid is None else time.time() - self.process_started_at,
+               "restarts": self.restarts,
+               "last_exit_code": self.last_exit_code,
+               "cpu_seconds": last.cpu_seconds if last else None,
+               "cpu_percent": self.cpu_percent,
+               "rss_bytes": last.rss_bytes if last else None,
+               "probe_failures": self.probe_failures,
+               "probe_latency_p50": percentile(probes, 50),
+               "probe_latency_p95": percentile(probes, 95),
+               "probe_latency_p99": percentile(probes, 99)}
+        if history:
+            ret["history"] = [(i.time, i.cpu_seconds, i.rss_bytes, i.pid) for i in self.history]
+        return ret
+
+
+_TEXTFILE_METRICS = [
+    ("uptime", "wg_config_manager_service_uptime_seconds", "gauge", "Seconds since the service started."),
+    ("process_uptime", "wg_config_manager_service_process_uptime_seconds", "gauge",
+     "Seconds since the current process started."),
+    ("restarts", "wg_config_manager_service_restarts_total", "counter", "Restarts by the supervisor."),
+    ("last_exit_code", "wg_config_manager_service_last_exit_code", "gauge", "Exit code of the last process."),
+    ("cpu_seconds", "wg_config_manager_service_cpu_seconds_total", "counter", "CPU time of current process."),
+    ("rss_bytes", "wg_config_manager_service_rss_bytes", "gauge", "Resident memory of current process."),
+    ("probe_failures", "wg_config_manager_service_probe_failures_total", "counter", "Failed health probes."),
+    ("probe_latency_p95", "wg_config_manager_service_probe_latency_p95_seconds", "gauge",
+     "95th percentile of health probe latency."),
+]
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_textfile(stats: typing.Mapping[str, dict]) -> str:
+    """
+    Format snapshots to the Prometheus text exposition format, for node_exporter textfile collector.
+
+    :param stats: `{plugin}/{process}` - snapshot mapping, like `get_service_stats` returned.
+    """
+    lines = []
+    for key, metric, kind, helper in _TEXTFILE_METRICS:
+        lines.append(f"# HELP {metric} {helper}")
+        lines.append(f"# TYPE {metric} {kind}")
+        for name, snapshot in stats.items():
+            value = snapshot.get(key)
+            if value is None:
+                continue
+            plugin, _, process = name.partition("/")
+            lines.append(f'{metric}{{plugin="{_escape_label(plugin)}",process="{_escape_label(process)}"}} '
+                         f'{value}')
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(path: str | os.PathLike, stats: typing.Mapping[str, dict]):
+    """
+    Write `format_textfile` to `path` atomically, so the collector never reads a partial file.
+    """
+    tmp = f"{os.fspath(path)}.tmp"
+    with open(tmp, "w", encoding="utf-8") as fp:
+        fp.write(format_textfile(stats))
+    os.replace(tmp, path)
@@ -1,10 +1,35 @@
 """
 Storage management, like config loader.
+
+Files shared by the GUI, the command line and service hooks are guarded by advisory locks on a sidecar
+`.{name}.lock` file (a rename replaces the file itself): `fcntl.flock` shared locks for readers and exclusive
+locks for writers, `msvcrt` exclusive locks on Windows. Writers write a temporary file first and hold the
+exclusive lock only to check the version, a sha256 of the content, and rename, so readers are rarely blocked.
 """
+import io
+import os
+import time
+import random
+import typing
+import hashlib
+import threading
+import contextlib
 from pathlib import Path
 from dataclasses import dataclass
 from configparser import ConfigParser
 
+from .errors import StorageLockError, StorageConflictError
+
+try:
+    import fcntl
+except ImportError:
+    # windows, shared locks are exclusive
+    fcntl = None
+    try:
+        import msvcrt
+    except ImportError:
+        msvcrt = None
+
 __APP_DIR = Path(__file__).parent
 DEFAULT_CONFIG_PATH = __APP_DIR / "default config.ini"
 __CONFIG_DIR = Path.home() / ".config" / "wg_config_manager"
@@ -32,33 +57,278 @@ PathMap = PathMap(
 )
 
 
+DEFAULT_LOCK_TIMEOUT = 10.0
+UPDATE_RETRIES = 20
+UPDATE_BACKOFF = 0.005
+UPDATE_MAX_BACKOFF = 0.5
+
+
 def get_parser_from_config() -> ConfigParser:
     """
-    Load config.
+    Load config, under a shared lock. The config file is created from the default config at the first use.
     """
-    if not PathMap.CONFIG_DIR.is_dir():
-        PathMap.CONFIG_DIR.mkdir()
+    PathMap.CONFIG_DIR.mkdir(parents=True, exist_ok=True)
 
     parser = ConfigParser(allow_no_value=True)
 
-    if not PathMap.CONFIG_FILE.is_file():
+    data, version = read_versioned(PathMap.CONFIG_FILE)
+    if version is None:
         with open(DEFAULT_CONFIG_PATH, "r", encoding="utf-8") as fp:
             parser.read_file(fp)
-        with open(PathMap.CONFIG_FILE, "w", encoding="utf-8") as fp:
-            parser.write(fp)
+        try:
+            write_versioned(PathMap.CONFIG_FILE, _dump_parser(parser), None, mode=0o644)
+        except StorageConflictError:
+            # created by another process meanwhile
+            return get_parser_from_config()
     else:
-        with open(PathMap.CONFIG_FILE, "r", encoding="utf-8") as fp:
-            parser.read_file(fp)
+        parser.read_string(data.decode("utf-8"))
 
     return parser
 
 
 def dump_parser_to_config(parser: ConfigParser, path=str(DEFAULT_CONFIG_PATH)):
     """
-    Write config to file by parser.
+    Write config to file by parser, atomically under an exclusive lock. The file keeps its mode.
+    Use `update_config` to change a config without losing concurrent changes.
+    """
+    try:
+        mode = os.stat(path).st_mode & 0o777
+    except FileNotFoundError:
+        mode = 0o644
+    data = _dump_parser(parser)
+    with file_lock(path):
+        write_file_atomic(path, data, mode)
+
+
+def _dump_parser(parser: ConfigParser) -> bytes:
+    text = io.StringIO()
+    parser.write(text)
+    return text.getvalue().encode("utf-8")
+
+
+def get_lock_path(path: str | os.PathLike) -> str:
+    """
+    the sidecar lock file of `path`
+    """
+    directory, name = os.path.split(os.fspath(path))
+    return os.path.join(directory, f".{name}.lock")
+
+
+def _try_lock(fd: int, exclusive: bool) -> bool:
+    if fcntl is not None:
+        try:
+            fcntl.flock(fd, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+    elif msvcrt is not None:
+        try:
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+    return True
+
+
+def _unlock(fd: int):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    elif msvcrt is not None:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+@contextlib.contextmanager
+def file_lock(path: str | os.PathLike, exclusive: bool = True,
+              timeout: float | None = DEFAULT_LOCK_TIMEOUT) -> typing.Iterator[None]:
+    """
+    Hold a shared or an exclusive advisory lock of `path` in the block, across processes and threads.
+    Locks are not reentrant: don't lock a path again in the block.
+
+    :param timeout: seconds to wait, None waits forever
+    :raise: StorageLockError if the lock cannot be acquired in time
+    """
+    fd = os.open(get_lock_path(path), os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o600)
+    try:
+        if fcntl is not None and timeout is None:
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        elif not _try_lock(fd, exclusive):
+            deadline = None if timeout is None else time.monotonic() + timeout
+            delay = 0.001
+            while not _try_lock(fd, exclusive):
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise StorageLockError(f"cannot lock {os.fspath(path)} in {timeout} s")
+                time.sleep(delay)
+                delay = min(delay * 2, 0.005)
+        try:
+            yield
+        finally:
+            _unlock(fd)
+    finally:
+        os.close(fd)
+
+
+def get_version(data: bytes) -> str:
+    """
+    the version of a file content, its sha256
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def _read_file(path: str | os.PathLike) -> tuple[bytes, str | None]:
+    try:
+        with open(path, "rb") as fp:
+            data = fp.read()
+    except FileNotFoundError:
+        return b"", None
+    return data, get_version(data)
+
+
+def read_versioned(path: str | os.PathLike, timeout: float | None = DEFAULT_LOCK_TIMEOUT) -> tuple[bytes, str | None]:
+    """
+    Read a file under a shared lock, with its version to pass to `write_versioned`.
+    A missing file is empty with the version None.
+    """
+    with file_lock(path, exclusive=False, timeout=timeout):
+        return _read_file(path)
+
+
+def _get_tmp_path(path: str) -> str:
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f".{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+def _open_tmp(tmp: str, mode: int) -> typing.BinaryIO:
+    fp = os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), mode), "wb")
+    if hasattr(os, "fchmod"):
+        # a stale temporary file keeps its mode
+        os.fchmod(fp.fileno(), mode)
+    return fp
+
+
+@contextlib.contextmanager
+def open_atomic(path: str | os.PathLike, mode: int = 0o600, fsync: bool = False) -> typing.Iterator[typing.BinaryIO]:
+    """
+    Open a temporary file in the same directory to write, and rename it to `path` when the block exits,
+    so readers see the old or the new content, never a partial file. The file is created with `mode`.
+    The temporary file is removed if the block raises.
+
+    :param fsync: flush the file to disk before the rename, to survive a power loss
+    """
+    path = os.fspath(path)
+    tmp = _get_tmp_path(path)
+    fp = _open_tmp(tmp, mode)
+    try:
+        with fp:
+            yield fp
+            if fsync:
+                fp.flush()
+                os.fsync(fp.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def write_file_atomic(path: str | os.PathLike, data: bytes, mode: int = 0o600, fsync: bool = False):
+    """
+    Write `data` to `path` atomically, see `open_atomic`.
+    """
+    with open_atomic(path, mode, fsync) as fp:
+        fp.write(data)
+
+
+def write_files_atomic(files: typing.Mapping[str | os.PathLike, bytes], mode: int = 0o600, fsync: bool = False,
+                       versions: typing.Mapping[str | os.PathLike, str | None] | None = None,
+                       timeout: float | None = DEFAULT_LOCK_TIMEOUT):
+    """
+    Write many files as one transaction: every file is written to a temporary file first, and only if all
+    succeeded they are renamed into place in the order of `files`. If writing fails, no file is changed.
+    A crash during the renames, which don't allocate, leaves a prefix of `files` renamed.
+
+    :param versions: the versions the files must still have, see `read_versioned`.
+    Their exclusive locks are held from the check until the renames are done.
+    :raise: StorageConflictError if a file changed, StorageLockError, nothing is written then
+    """
+    renames = []
+    try:
+        for path, data in files.items():
+            path = os.fspath(path)
+            tmp = _get_tmp_path(path)
+            renames.append((tmp, path))
+            with _open_tmp(tmp, mode) as fp:
+                fp.write(data)
+                if fsync:
+                    fp.flush()
+                    os.fsync(fp.fileno())
+    except BaseException:
+        for tmp, _ in renames:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+        raise
+    done = 0
+    try:
+        with contextlib.ExitStack() as stack:
+            # a fixed order, so writers of overlapping files don't deadlock
+            for path in sorted({os.fspath(i) for i in versions or ()}):
+                stack.enter_context(file_lock(path, timeout=timeout))
+            for path, version in (versions or {}).items():
+                if _read_file(path)[1] != version:
+                    raise StorageConflictError(f"{os.fspath(path)} changed since it was read")
+            for tmp, path in renames:
+                os.replace(tmp, path)
+                done += 1
+    finally:
+        for tmp, _ in renames[done:]:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+
+def write_versioned(path: str | os.PathLike, data: bytes, version: str | None, mode: int = 0o600,
+                    fsync: bool = False, timeout: float | None = DEFAULT_LOCK_TIMEOUT) -> str:
+    """
+    Write `data` to `path` atomically if the file still has `version`, None if it must not exist.
+
+    :return: the new version
+    :raise: StorageConflictError if the file changed, StorageLockError
+    """
+    write_files_atomic({path: data}, mode, fsync, versions={path: version}, timeout=timeout)
+    return get_version(data)
+
+
+def update_config(path: str | os.PathLike, update: typing.Callable[[ConfigParser], ConfigParser | None],
+                  read: typing.Callable[[str], ConfigParser] | None = None, mode: int = 0o600, fsync: bool = False,
+                  retries: int = UPDATE_RETRIES, timeout: float | None = DEFAULT_LOCK_TIMEOUT) -> ConfigParser:
+    """
+    Read, change and write a config without losing the changes of other processes: if the file changed
+    since it was read, it's read and changed again after a random exponential backoff.
+    `update` changes the parser in place or returns a new one, it may be called several times.
+    A missing file is an empty config.
+
+    :param read: parse the text, `ConfigParser(allow_no_value=True)` by default
+    :return: the written config
+    :raise: StorageConflictError if the file still changes after `retries` retries, StorageLockError
     """
-    with open(path, "w", encoding="utf-8") as fp:
-        parser.write(fp)
+    for attempt in range(retries + 1):
+        data, version = read_versioned(path, timeout)
+        if read is None:
+            parser = ConfigParser(allow_no_value=True)
+            parser.read_string(data.decode("utf-8"))
+        else:
+            parser = read(data.decode("utf-8"))
+        parser = update(parser) or parser
+        try:
+            write_versioned(path, _dump_parser(parser), version, mode, fsync, timeout)
+            return parser
+        except StorageConflictError:
+            if attempt == retries:
+                raise
+        time.sleep(min(UPDATE_BACKOFF * 2 ** attempt, UPDATE_MAX_BACKOFF) * random.uniform(0.5, 1))
 
 
 if __name__ == "__main__":
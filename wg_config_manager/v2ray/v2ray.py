@@ -2,50 +2,606 @@
 v2ray plugin
 """
 
-from wg_config_manager.load_plugin import FunctionParameter, AcquireValue, ServiceSelfObject
+from wg_config_manager.load_plugin import (FunctionParameter, AcquireValue, ServiceSelfObject, terminate_process,
+                                           str2bool)
+from wg_config_manager.logger import Logger
+from wg_config_manager.service_metrics import percentile
+from wg_config_manager.profiling import PROFILER
 
+import os
+import sys
+import copy
+import json
+import time
+import struct
+import socket
 import typing
 import asyncio
+import hashlib
+import ctypes
+import ctypes.util
 from pathlib import Path
 from subprocess import Popen
-from threading import Thread
-from functools import partial
+from collections import deque
 from tempfile import TemporaryDirectory, NamedTemporaryFile
 
+logger = Logger(__name__)
+
+# set the CPU affinity in a fresh single-threaded process, then exec the command with the same pid,
+# instead of `preexec_fn`, which is unsafe in a parent with threads
+PIN_AND_EXEC = "import os, sys\nos.sched_setaffinity(0, map(int, sys.argv[1].split(',')))\nos.execvp(sys.argv[2], sys.argv[2:])\n"
+
 
 def hello():
     print("hello world from", __file__)
 
 
+def read_inbounds(config_path: str) -> list[tuple[str, int, str]]:
+    """
+    Read `(host, port, protocol)` of inbounds from a v2ray json config, listening on all address means localhost.
+    """
+    with open(config_path, "r", encoding="utf-8") as fp:
+        config = json.load(fp)
+    ret = []
+    for inbound in config.get("inbounds", []):
+        port = inbound.get("port")
+        if not isinstance(port, int):
+            continue  # port range or environment variable
+        host = inbound.get("listen") or "127.0.0.1"
+        if host in ("0.0.0.0", "::"):
+            host = "127.0.0.1"
+        ret.append((host, port, inbound.get("protocol", "")))
+    return ret
+
+
+def parse_address(address: str) -> tuple[str, int]:
+    """
+    "host:port" -> ("host", port)
+    """
+    host, _, port = address.rpartition(":")
+    return host.strip("[]") or "127.0.0.1", int(port)
+
+
+def canonical_config_hash(config_path: str) -> str | None:
+    """
+    sha256 of the parsed json config, key order and white spaces are ignored.
+
+    :return: None if the config cannot be read or parsed.
+    """
+    try:
+        with open(config_path, "r", encoding="utf-8") as fp:
+            config = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    canonical = json.dumps(config, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class InotifyWatcher:
+    """
+    Watch file changes in a directory by Linux inotify.
+    Editors often replace a file by renaming, so the directory is watched instead of the file.
+    """
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self, directory: str):
+        """
+        :raise: OSError when inotify is not available
+        """
+        name = ctypes.util.find_library("c")
+        if name is None:
+            raise OSError("libc not found")
+        libc = ctypes.CDLL(name, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not supported")
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, f"inotify_add_watch failed on {directory}")
+
+    def read_names(self) -> set[str]:
+        """
+        read the names of changed files
+        """
+        names = set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return names
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = self._EVENT.unpack_from(data, offset)
+            offset += self._EVENT.size
+            names.add(os.fsdecode(data[offset:offset + length].rstrip(b"\0")))
+            offset += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class TcpProbe:
+    """
+    Health probe: connect to the inbound port.
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.name = f"tcp {host}:{port}"
+
+    async def __call__(self):
+        _, writer = await asyncio.open_connection(self.host, self.port)
+        writer.close()
+        await writer.wait_closed()
+
+
+class ProxyEchoProbe:
+    """
+    Health probe: connect to an echo server through the SOCKS5 inbound of v2ray, then check the echoed payload.
+    """
+
+    def __init__(self, proxy_host: str, proxy_port: int, echo_host: str, echo_port: int,
+                 payload: bytes = b"wg_config_manager health probe"):
+        self.proxy = (proxy_host, proxy_port)
+        self.echo = (echo_host, echo_port)
+        self.payload = payload
+        self.name = f"proxy {proxy_host}:{proxy_port} -> {echo_host}:{echo_port}"
+
+    async def __call__(self):
+        reader, writer = await asyncio.open_connection(*self.proxy)
+        try:
+            # greeting, no authentication
+            writer.write(b"\x05\x01\x00")
+            if await reader.readexactly(2) != b"\x05\x00":
+                raise ConnectionError("SOCKS5 handshake refused")
+            # CONNECT
+            host = self.echo[0].encode("idna")
+            writer.write(b"\x05\x01\x00\x03" + bytes([len(host)]) + host + self.echo[1].to_bytes(2, "big"))
+            reply = await reader.readexactly(4)
+            if reply[1] != 0:
+                raise ConnectionError(f"SOCKS5 connect failed, code {reply[1]}")
+            # skip the bound address
+            if reply[3] == 1:
+                await reader.readexactly(4 + 2)
+            elif reply[3] == 4:
+                await reader.readexactly(16 + 2)
+            else:
+                await reader.readexactly((await reader.readexactly(1))[0] + 2)
+            writer.write(self.payload)
+            if await reader.readexactly(len(self.payload)) != self.payload:
+                raise ConnectionError("echoed payload mismatched")
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass  # reset by the proxy, the probe result is known already
+
+
+async def start_echo_server(host: str = "127.0.0.1", port: int = 0) -> asyncio.AbstractServer:
+    """
+    Start a local echo server as the target of `ProxyEchoProbe`, on the running loop.
+    """
+    async def echo(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while data := await reader.read(4096):
+                writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    return await asyncio.start_server(echo, host, port)
+
+
+class HealthMonitor:
+    """
+    Run probes every `interval` seconds, kill the process after `failure_threshold` continuous failures,
+    then the supervisor restarts it.
+    """
+
+    def __init__(self, probes: list, interval: float = 30.0, timeout: float = 5.0, failure_threshold: int = 3,
+                 history: int = 1000):
+        self.probes = probes
+        self.interval = interval
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.failures = 0  # continuous failures
+        self.latencies: dict[str, deque] = {p.name: deque(maxlen=history) for p in probes}
+
+    async def probe_once(self) -> float | None:
+        """
+        run all probes, return the total latency in seconds, None if one failed
+        """
+        total = 0.0
+        for probe in self.probes:
+            start = time.perf_counter()
+            try:
+                await asyncio.wait_for(probe(), self.timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as err:
+                logger.warning('health probe "%s" failed: %r', probe.name, err)
+                return None
+            latency = time.perf_counter() - start
+            self.latencies[probe.name].append(latency)
+            total += latency
+        return total
+
+    def set_probes(self, probes: list):
+        """
+        replace the probes, like after the config reloaded
+        """
+        self.probes = probes
+        for p in probes:
+            self.latencies.setdefault(p.name, deque(maxlen=next(iter(self.latencies.values())).maxlen
+                                                    if self.latencies else 1000))
+
+    def get_latency_percentiles(self) -> dict[str, dict[str, float | None]]:
+        """
+        return p50, p95 and p99 latency of each probe
+        """
+        return {name: {f"p{q}": percentile(values, q) for q in (50, 95, 99)}
+                for name, values in self.latencies.items()}
+
+    async def run(self, record):
+        """
+        the monitor loop, `record` is the `load_plugin.SupervisedProcess` of the service
+        """
+        while True:
+            await asyncio.sleep(self.interval)
+            process = record.process
+            if process is None or process.poll() is not None:
+                self.failures = 0  # the supervisor is restarting it
+                continue
+            latency = await self.probe_once()
+            record.stats.record_probe(latency)
+            if latency is not None:
+                self.failures = 0
+                continue
+            self.failures += 1
+            if self.failures >= self.failure_threshold and process is record.process:
+                logger.warning('service "%s" failed %d health probes, restart it', record.key, self.failures)
+                self.failures = 0
+                process.kill()
+
+
 class V2rayService:
     """
     the class for background service "v2ray"
+
+    The process is watched by `load_plugin.ServiceSupervisor` after started by `run_service`,
+    which calls `respawn` when v2ray exits.
     """
 
-    def __init__(self, v2ray_path: str, config_path: str):
+    def __init__(self, v2ray_path: str, config_path: str, probe_interval: float = 30.0, probe_timeout: float = 5.0,
+                 probe_failures: int = 3, probe_proxy: str = "", probe_echo: str = "",
+                 cpu_affinity: set[int] | None = None, watch_config: bool = True, reload_debounce: float = 0.5,
+                 reload_overlap: float = 1.0):
+        """
+        :param probe_interval: seconds between health probes, disable probes if not positive.
+        :param probe_timeout: timeout of each probe.
+        :param probe_failures: restart v2ray after these continuous failures.
+        :param probe_proxy: "host:port" of a SOCKS5 inbound to check end-to-end, disabled if empty.
+        :param probe_echo: "host:port" of the echo server, start a local one if empty.
+        :param cpu_affinity: pin the process to these CPUs.
+        :param watch_config: reload v2ray when the parsed config changed.
+        :param reload_debounce: seconds to wait the config file settled.
+        :param reload_overlap: seconds the new instance runs with the old one, if the inbound ports changed.
+        """
         self.v2ray_path = v2ray_path
         self.config_path = config_path
-        self.process = Popen([v2ray_path, "run", "-c", config_path])
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.probe_failures = probe_failures
+        self.probe_proxy = probe_proxy
+        self.probe_echo = probe_echo
+        self.monitor: HealthMonitor | None = None
+        self.cpu_affinity = cpu_affinity
+        self.watch_config = watch_config
+        self.reload_debounce = reload_debounce
+        self.reload_overlap = reload_overlap
+        self.reloads = 0
+        self.config_hash = canonical_config_hash(config_path)
+        self.inbound_ports = self._read_inbound_ports()
+        self.process = self.spawn()
+
+    def spawn(self) -> Popen:
+        """
+        start a v2ray process, pinned to `cpu_affinity` if set
+        """
+        args = [self.v2ray_path, "run", "-c", self.config_path]
+        if self.cpu_affinity and hasattr(os, "sched_setaffinity"):
+            # pinned before exec, so every thread of the Go runtime inherits the mask
+            args = [sys.executable, "-I", "-S", "-c", PIN_AND_EXEC, ",".join(map(str, sorted(self.cpu_affinity))),
+                    *args]
+        with PROFILER.span("subprocess v2ray start"):
+            process = Popen(args)
+        self.spawned_at = time.perf_counter()
+        return process
+
+    @staticmethod
+    def retire(process: Popen, spawned_at: float, timeout: float | None = 10.0):
+        """
+        terminate `process`, and record its lifetime as span "subprocess v2ray" if profiling
+        """
+        terminate_process(process, timeout)
+        if PROFILER.enabled:
+            PROFILER.record("subprocess v2ray", time.perf_counter() - spawned_at)
 
-        self.health_check_thread = Thread(target=self.get_health_check_thread_target(), daemon=True)
-        self.health_check_thread.start()
+    def respawn(self) -> Popen:
+        """
+        start a new v2ray process to replace the exited one
+        """
+        self.process = self.spawn()
+        return self.process
 
-    def down(self):
-        self.process.kill()
-        self.process.wait()
+    def down(self, timeout: float | None = 10.0):
+        """
+        stop v2ray by SIGTERM, then SIGKILL if it's still alive after `timeout` seconds, nothing if it's stopped
+        """
+        if self.process is None:
+            return
+        self.retire(self.process, self.spawned_at, timeout)
         self.process = None
 
     def health_check(self):
-        if self.process.poll() is not None:
-            self.process = Popen([self.v2ray_path, "run", "-c", self.config_path])
+        # a stopped service is not started again
+        if self.process is not None and self.process.poll() is not None:
+            self.respawn()
+
+    def _read_inbound_ports(self) -> set[int]:
+        try:
+            return {port for _, port, _ in read_inbounds(self.config_path)}
+        except (OSError, ValueError):
+            return set()
+
+    def _build_probes(self) -> list:
+        try:
+            return [TcpProbe(host, port) for host, port, _ in read_inbounds(self.config_path)]
+        except (OSError, ValueError) as err:
+            logger.warning('cannot read inbounds from "%s", %s', self.config_path, err)
+            return []
 
-    def get_health_check_thread_target(self):
-        return partial(asyncio.run, self._health_check_coroutine_loop())
+    async def health_monitor(self, record):
+        """
+        probe the health, and reload v2ray when the config changed, called by the supervisor
+        """
+        await asyncio.gather(self._probe_loop(record), self._config_watch_loop(record))
 
-    async def _health_check_coroutine_loop(self):
-        while self.process is not None:
-            self.health_check()
-            await asyncio.sleep(60)  # Check healthy every minute.
+    async def _probe_loop(self, record):
+        """
+        probe the inbound ports, and the proxy if `probe_proxy` is set
+        """
+        if self.probe_interval <= 0:
+            return
+        probes = self._build_probes()
+        echo_server = None
+        if self.probe_proxy:
+            if self.probe_echo:
+                echo_host, echo_port = parse_address(self.probe_echo)
+            else:
+                echo_server = await start_echo_server()
+                echo_host, echo_port = echo_server.sockets[0].getsockname()[:2]
+            probes.append(ProxyEchoProbe(*parse_address(self.probe_proxy), echo_host, echo_port))
+        if not probes:
+            return
+        self.monitor = HealthMonitor(probes, self.probe_interval, self.probe_timeout, self.probe_failures)
+        try:
+            await self.monitor.run(record)
+        finally:
+            if echo_server is not None:
+                echo_server.close()
+
+    async def _config_watch_loop(self, record):
+        """
+        watch `config_path` by inotify (or polling), and reload after changes settled for `reload_debounce`
+        """
+        if not self.watch_config:
+            return
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+        directory, name = os.path.split(os.path.abspath(self.config_path))
+        try:
+            watcher = InotifyWatcher(directory)
+        except OSError:
+            watcher = None
+        if watcher is not None:
+            loop.add_reader(watcher.fd, lambda: name in watcher.read_names() and changed.set())
+        try:
+            # the config may be changed before watching
+            await self.reload_if_changed(record)
+            last_stat = None
+            while True:
+                if watcher is None:
+                    # polling
+                    await asyncio.sleep(max(self.reload_debounce, 0.1))
+                    try:
+                        st = os.stat(self.config_path)
+                        stat = (st.st_mtime_ns, st.st_size)
+                    except OSError:
+                        stat = None
+                    if last_stat is None or stat == last_stat:
+                        last_stat = stat
+                        continue
+                    last_stat = stat
+                else:
+                    await changed.wait()
+                # debounce
+                while True:
+                    changed.clear()
+                    try:
+                        await asyncio.wait_for(changed.wait(), self.reload_debounce)
+                    except asyncio.TimeoutError:
+                        break
+                await self.reload_if_changed(record)
+        finally:
+            if watcher is not None:
+                loop.remove_reader(watcher.fd)
+                watcher.close()
+
+    async def reload_if_changed(self, record) -> bool:
+        """
+        Restart v2ray only if the parsed config changed.
+        If the inbound ports are changed, the new instance starts before the old one retires.
+
+        :return: reloaded or not
+        """
+        new_hash = canonical_config_hash(self.config_path)
+        if new_hash is None:
+            logger.warning('cannot parse "%s", keep the running v2ray', self.config_path)
+            return False
+        if new_hash == self.config_hash:
+            return False
+        old_process, old_spawned_at = self.process, self.spawned_at
+        old_ports = self.inbound_ports
+        self.inbound_ports = self._read_inbound_ports()
+        loop = asyncio.get_running_loop()
+        # the supervisor must stop watching the old process before it's terminated,
+        # or its exit counts as a failure and schedules a respawn
+        if old_ports.isdisjoint(self.inbound_ports):
+            # overlap the new instance with the old one, the new one is supervised at once
+            self.process = self.spawn()
+            record.supervisor.replace(record.key, self.process)
+            await asyncio.sleep(self.reload_overlap)
+            await loop.run_in_executor(None, self.retire, old_process, old_spawned_at, 10.0)
+        else:
+            record.supervisor.replace(record.key, None)
+            await loop.run_in_executor(None, self.retire, old_process, old_spawned_at, 10.0)
+            self.process = self.spawn()
+            record.supervisor.replace(record.key, self.process)
+        self.config_hash = new_hash
+        self.reloads += 1
+        if self.monitor is not None:
+            self.monitor.set_probes(self._build_probes())
+        logger.info('v2ray reloaded "%s"', self.config_path)
+        return True
+
+
+def parse_cpus(cpus: str) -> list[int]:
+    """
+    "0,2-3" -> [0, 2, 3]
+    """
+    ret = []
+    for part in filter(None, (i.strip() for i in cpus.split(","))):
+        first, _, last = part.partition("-")
+        ret.extend(range(int(first), int(last or first) + 1))
+    return ret
+
+
+class V2rayPool:
+    """
+    the class for background service "v2ray_pool", runs N v2ray instances to use more CPU cores.
+
+    Configs of instances are generated from a template. The inbound ports of instance `i` are
+    `port + i * port_stride`, or the same ports if `reuse_port` is set (the template should enable
+    SO_REUSEPORT by the sockopt of your v2ray build). Instances are watched by the supervisor one by one.
+    """
+
+    def __init__(self, v2ray_path: str, template_path: str, instances: int, work_dir: str,
+                 port_stride: int = 1, reuse_port: bool = False, cpus: str = ""):
+        """
+        :param instances: the number of v2ray processes.
+        :param work_dir: the directory to write configs of instances.
+        :param cpus: pin instance `i` to the `i % len(cpus)`th cpu, like "0-3" or "0,2", not pin if empty.
+        """
+        self.v2ray_path = v2ray_path
+        with open(template_path, "r", encoding="utf-8") as fp:
+            self.template = json.load(fp)
+        self.work_dir = Path(work_dir)
+        self.port_stride = port_stride
+        self.reuse_port = reuse_port
+        self.cpus = parse_cpus(cpus)
+        self.instances: dict[int, V2rayService] = {}
+        self.supervisor = None
+        self.key: str | None = None
+        self.scale(instances)
+
+    def instance_config(self, index: int) -> dict:
+        """
+        generate the config of instance `index` from template
+        """
+        config = copy.deepcopy(self.template)
+        if not self.reuse_port:
+            for inbound in config.get("inbounds", []):
+                if isinstance(inbound.get("port"), int):
+                    inbound["port"] += index * self.port_stride
+        return config
+
+    def instance_key(self, index: int) -> str:
+        return f"{self.key}#{index}"
+
+    def _start(self, index: int) -> V2rayService:
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        config_path = self.work_dir / f"instance-{index}.json"
+        with open(config_path, "w", encoding="utf-8") as fp:
+            json.dump(self.instance_config(index), fp, indent=2)
+        cpu_affinity = {self.cpus[index % len(self.cpus)]} if self.cpus else None
+        instance = V2rayService(self.v2ray_path, str(config_path), probe_interval=0, cpu_affinity=cpu_affinity,
+                                watch_config=False)
+        self.instances[index] = instance
+        if self.supervisor is not None:
+            self.supervisor.watch(self.instance_key(index), instance)
+        return instance
+
+    def _stop(self, indexes: list[int], timeout: float | None):
+        processes = []
+        for index in indexes:
+            instance = self.instances.pop(index)
+            if self.supervisor is not None:
+                self.supervisor.unwatch(self.instance_key(index))
+            if instance.process.poll() is None:
+                instance.process.terminate()
+            processes.append(instance.process)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for process in processes:
+            terminate_process(process, None if deadline is None else deadline - time.monotonic())
+
+    def scale(self, instances: int, timeout: float | None = 10.0):
+        """
+        add or remove instances, the other instances keep running
+        """
+        if instances < 0:
+            raise ValueError("the number of instances should not be negative", instances)
+        for index in range(len(self.instances), instances):
+            self._start(index)
+        self._stop(sorted(i for i in self.instances if i >= instances), timeout)
+
+    def supervise(self, supervisor, key: str):
+        """
+        watch instances by `supervisor`, called by `LoadPluginModule.run_service`
+        """
+        self.supervisor, self.key = supervisor, key
+        for index, instance in self.instances.items():
+            supervisor.watch(self.instance_key(index), instance)
+
+    def unsupervise(self):
+        """
+        stop watching instances
+        """
+        if self.supervisor is None:
+            return
+        for index in self.instances:
+            self.supervisor.unwatch(self.instance_key(index))
+        self.supervisor = None
+
+    def down(self, timeout: float | None = 10.0):
+        """
+        stop all instances at the same time
+        """
+        self._stop(sorted(self.instances), timeout)
 
 
 VERSION_REQ = ""
@@ -55,7 +611,85 @@ parameters_new = [
                       helper="path to the v2ray application"),
     FunctionParameter(name="config_path",
                       default="{CONFIG_DIR}/config.json",
-                      helper="path to the v2ray configuration")
+                      helper="path to the v2ray configuration"),
+    FunctionParameter(name="probe_interval",
+                      default="30",
+                      helper="seconds between health probes, 0 to disable",
+                      before_pass=float),
+    FunctionParameter(name="probe_timeout",
+                      default="5",
+                      helper="timeout of each health probe",
+                      before_pass=float),
+    FunctionParameter(name="probe_failures",
+                      default="3",
+                      helper="restart v2ray after these continuous failed probes",
+                      before_pass=int),
+    FunctionParameter(name="probe_proxy",
+                      default="",
+                      helper='"host:port" of a SOCKS5 inbound to probe end-to-end, empty to disable'),
+    FunctionParameter(name="probe_echo",
+                      default="",
+                      helper='"host:port" of the echo server for end-to-end probe, empty to start a local one'),
+    FunctionParameter(name="watch_config",
+                      default="1",
+                      helper="reload v2ray when the config changed, false to disable",
+                      before_pass=str2bool),
+    FunctionParameter(name="reload_debounce",
+                      default="0.5",
+                      helper="seconds to wait the config file settled before reloading",
+                      before_pass=float),
+    FunctionParameter(name="reload_overlap",
+                      default="1",
+                      helper="seconds the new v2ray runs with the old one when the inbound ports changed",
+                      before_pass=float),
+]
+parameters_down = [
+    ServiceSelfObject,
+    FunctionParameter(name="timeout",
+                      default="10",
+                      helper="seconds to wait v2ray exit before killing it",
+                      before_pass=float)
 ]
 BACKGROUND_SERVICE_v2ray = {"new": [V2rayService, parameters_new],
-                            "teardown": [V2rayService.down, [ServiceSelfObject]]}
+                            "teardown": [V2rayService.down, parameters_down]}
+
+parameters_pool_new = [
+    FunctionParameter(name="v2ray_path",
+                      default="v2ray",
+                      helper="path to the v2ray application"),
+    FunctionParameter(name="template_path",
+                      default="{CONFIG_DIR}/config.json",
+                      helper="path to the v2ray configuration template"),
+    FunctionParameter(name="instances",
+                      default=str(os.cpu_count() or 1),
+                      helper="the number of v2ray instances",
+                      before_pass=int),
+    FunctionParameter(name="work_dir",
+                      default="{CONFIG_DIR}/v2ray pool",
+                      helper="the directory to write configs of instances"),
+    FunctionParameter(name="port_stride",
+                      default="1",
+                      helper="inbound ports of instance i are port + i * port_stride",
+                      before_pass=int),
+    FunctionParameter(name="reuse_port",
+                      default="",
+                      helper="true to keep the same ports, the template should enable SO_REUSEPORT",
+                      before_pass=str2bool),
+    FunctionParameter(name="cpus",
+                      default="",
+                      helper='pin instances to CPUs, like "0-3", empty to not pin'),
+]
+parameters_pool_scale = [
+    ServiceSelfObject,
+    FunctionParameter(name="instances",
+                      helper="the number of v2ray instances",
+                      before_pass=int),
+    FunctionParameter(name="timeout",
+                      default="10",
+                      helper="seconds to wait removed instances exit before killing them",
+                      before_pass=float),
+]
+BACKGROUND_SERVICE_v2ray_pool = {"new": [V2rayPool, parameters_pool_new],
+                                 "scale": [V2rayPool.scale, parameters_pool_scale],
+                                 "teardown": [V2rayPool.down, parameters_down],
+                                 "autostart": False}
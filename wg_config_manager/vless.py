@@ -0,0 +1,280 @@
+"""
+Generate v2ray VLESS configs from the wireguard_core config, to tunnel WireGuard endpoints through the proxy.
+
+Every device gets a client config, in which each peer endpoint is mapped to a local dokodemo-door port
+and forwarded by the VLESS outbound. The server config accepts the UUIDs of all devices.
+"""
+import os
+import json
+import uuid
+import typing
+import hashlib
+from pathlib import Path
+from dataclasses import dataclass
+from configparser import ConfigParser
+
+from .logger import Logger
+from .errors import WireguardConfError
+from .wireguard_core import RESERVED_KEYS
+
+logger = Logger(__name__)
+
+WRITE_BUFFER_SIZE = 64 * 1024
+STREAM_LIST_SIZE = 64  # encode a longer list item by item
+
+
+@dataclass
+class VlessServer:
+    """
+    The VLESS inbound of the v2ray server, on a WebSocket transport.
+    """
+    address: str  # address for clients to connect
+    port: int = 443
+    path: str = "/vless-web-sockets"
+    listen: str = "0.0.0.0"
+
+
+@dataclass
+class EndpointMapping:
+    """
+    The WireGuard endpoint of `device` is reached by the local port `local_port` on clients.
+    """
+    device: str
+    local_port: int
+    host: str
+    port: int
+
+
+def get_devices(config: ConfigParser) -> list[str]:
+    """
+    the device names in the config order
+    """
+    return [i for i in config.sections() if i not in RESERVED_KEYS]
+
+
+def get_device_uuid(device: str, config: ConfigParser) -> str:
+    """
+    Get `vless uuid` of `device`, generate one if it's not set.
+    Like the generated public key, save the config to keep it.
+    """
+    value = config.get(device, "vless uuid", fallback=None)
+    if value:
+        try:
+            return str(uuid.UUID(value))
+        except ValueError:
+            raise WireguardConfError(f'invalid `vless uuid` for "{device}"', value) from None
+    value = str(uuid.uuid4())
+    config.set(device, "vless uuid", value)
+    config.set(device, "vless uuid is auto generated", "True")
+    return value
+
+
+def parse_endpoint(endpoint: str) -> tuple[str, int]:
+    """
+    "host:port" or "[ipv6]:port" -> (host, port)
+    """
+    host, _, port = endpoint.strip().rpartition(":")
+    if not host or not port.isnumeric():
+        raise WireguardConfError("endpoint should be like `host:port`, get", endpoint)
+    return host.strip("[]"), int(port)
+
+
+def get_endpoint_mappings(config: ConfigParser, local_port_base: int = 41820,
+                          devices: typing.Optional[list[str]] = None) -> list[EndpointMapping]:
+    """
+    Map the endpoint of every device to a local port, the same one on all clients.
+    The port is `local_port_base + index` of the device, or its `vless local port`.
+    Devices sharing an endpoint share its local port, unless `vless local port` is set.
+    """
+    if devices is None:
+        devices = get_devices(config)
+    ret = []
+    used = {}  # local port -> (device, endpoint)
+    by_endpoint = {}
+    for index, device in enumerate(devices):
+        endpoint = config.get(device, "endpoint", fallback=None)
+        if not endpoint:
+            continue
+        host, port = parse_endpoint(endpoint)
+        local_port = config.get(device, "vless local port", fallback=None)
+        if local_port:
+            if not local_port.isnumeric():
+                raise WireguardConfError('"vless local port" should be numeric, get', local_port)
+            local_port = int(local_port)
+        else:
+            local_port = by_endpoint.get((host, port), local_port_base + index)
+        if local_port in used and used[local_port][1] != (host, port):
+            raise WireguardConfError(f'local port {local_port} of "{device}" is used by "{used[local_port][0]}"')
+        used.setdefault(local_port, (device, (host, port)))
+        by_endpoint.setdefault((host, port), local_port)
+        ret.append(EndpointMapping(device, local_port, host, port))
+    return ret
+
+
+def _stream_settings(server: VlessServer) -> dict:
+    return {"network": "ws", "wsSettings": {"path": server.path}}
+
+
+def get_server_config(config: ConfigParser, server: VlessServer,
+                      devices: typing.Optional[list[str]] = None) -> dict:
+    """
+    the v2ray config of the VLESS server, accepting all devices
+    """
+    if devices is None:
+        devices = get_devices(config)
+    clients = [{"id": get_device_uuid(device, config), "email": device} for device in devices]
+    return {
+        "log": {"loglevel": "warning"},
+        "inbounds": [{
+            "listen": server.listen,
+            "port": server.port,
+            "protocol": "vless",
+            "settings": {"clients": clients, "decryption": "none"},
+            "streamSettings": _stream_settings(server),
+        }],
+        "outbounds": [{"tag": "direct", "protocol": "freedom", "settings": {}}],
+        "routing": {},
+    }
+
+
+def get_client_config(device: str, config: ConfigParser, server: VlessServer,
+                      mappings: list[EndpointMapping]) -> dict:
+    """
+    The v2ray config of `device`, listen `127.0.0.1:{local_port}` for the endpoint of each peer,
+    the devices in `peers` if it's set, else all other devices. One inbound serves the peers sharing a port.
+    Set `Endpoint = 127.0.0.1:{local_port}` in the WireGuard config of `device` to use the tunnel.
+    """
+    peers = config.get(device, "peers", fallback=None)
+    if peers:
+        peers = {i.strip() for i in peers.split(",")}
+    inbounds = {}
+    for m in mappings:
+        if m.device == device or (peers and m.device not in peers) or ("127.0.0.1", m.local_port) in inbounds:
+            continue
+        inbounds["127.0.0.1", m.local_port] = {
+            "tag": f"wg-{m.device}",
+            "listen": "127.0.0.1",
+            "port": m.local_port,
+            "protocol": "dokodemo-door",
+            "settings": {"address": m.host, "port": m.port, "network": "udp"},
+        }
+    inbounds = list(inbounds.values())
+    outbound = {
+        "tag": "vless",
+        "protocol": "vless",
+        "settings": {"vnext": [{
+            "address": server.address,
+            "port": server.port,
+            "users": [{"id": get_device_uuid(device, config), "encryption": "none"}],
+        }]},
+        "streamSettings": _stream_settings(server),
+    }
+    return {"log": {"loglevel": "warning"}, "inbounds": inbounds, "outbounds": [outbound], "routing": {}}
+
+
+def _file_sha256(path: Path) -> str | None:
+    h = hashlib.sha256()
+    try:
+        with open(path, "rb") as fp:
+            while chunk := fp.read(WRITE_BUFFER_SIZE):
+                h.update(chunk)
+    except FileNotFoundError:
+        return None
+    return h.hexdigest()
+
+
+def _read_bytes(path: Path) -> bytes | None:
+    try:
+        with open(path, "rb") as fp:
+            return fp.read()
+    except FileNotFoundError:
+        return None
+
+
+def iterencode(obj: typing.Any) -> typing.Iterator[str]:
+    """
+    Encode `obj` to compact json piece by piece, a long list is split into items, one item per line.
+    Unlike `json.JSONEncoder.iterencode`, the pieces are encoded by the C accelerated `json.dumps`.
+    """
+    if isinstance(obj, dict):
+        yield "{"
+        for i, (key, value) in enumerate(obj.items()):
+            yield f'{"," if i else ""}{json.dumps(str(key), ensure_ascii=False)}:'
+            yield from iterencode(value)
+        yield "}"
+    elif isinstance(obj, list) and len(obj) > STREAM_LIST_SIZE:
+        yield "[\n"
+        for i, item in enumerate(obj):
+            yield f'{"," if i else ""}{json.dumps(item, ensure_ascii=False, separators=(",", ":"))}\n'
+        yield "]"
+    else:
+        yield json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def write_json(path: str | os.PathLike, obj: typing.Any) -> bool:
+    """
+    Write `obj` as json to `path` only if the content changed, so the mtime of an unchanged file is kept.
+    A small document is compared in memory, a large one is encoded by `iterencode` into a temporary file
+    while hashing it, so it's never held in memory as a whole.
+
+    :return: the file is written or not
+    """
+    path = Path(path)
+    tmp = path.with_name(f"{path.name}.tmp")
+    chunks = iterencode(obj)
+    buffer = []
+    size = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= WRITE_BUFFER_SIZE:
+            break
+    else:
+        data = ("".join(buffer) + "\n").encode("utf-8")
+        if data == _read_bytes(path):
+            return False
+        with open(tmp, "wb") as fp:
+            fp.write(data)
+        os.replace(tmp, path)
+        return True
+    # stream
+    h = hashlib.sha256()
+    with open(tmp, "wb") as fp:
+        for chunk in chunks:
+            buffer.append(chunk)
+            size += len(chunk)
+            if size >= WRITE_BUFFER_SIZE:
+                data = "".join(buffer).encode("utf-8")
+                h.update(data)
+                fp.write(data)
+                buffer.clear()
+                size = 0
+        data = ("".join(buffer) + "\n").encode("utf-8")
+        h.update(data)
+        fp.write(data)
+    if h.hexdigest() == _file_sha256(path):
+        os.remove(tmp)
+        return False
+    os.replace(tmp, path)
+    return True
+
+
+@logger.important_function(print_parameters=["out_dir"])
+def generate_configs(config: ConfigParser, server: VlessServer, out_dir: str | os.PathLike,
+                     local_port_base: int = 41820) -> dict[str, bool]:
+    """
+    Write `server.json` and `clients/{device}.json` for every device into `out_dir`.
+
+    :return: relative path - written or not (unchanged)
+    """
+    out_dir = Path(out_dir)
+    (out_dir / "clients").mkdir(parents=True, exist_ok=True)
+    devices = get_devices(config)
+    mappings = get_endpoint_mappings(config, local_port_base, devices)
+    ret = {"server.json": write_json(out_dir / "server.json", get_server_config(config, server, devices))}
+    for device in devices:
+        if os.sep in device or (os.altsep and os.altsep in device) or device in (".", ".."):
+            raise WireguardConfError("device name cannot be a path, get", device)
+        name = f"clients/{device}.json"
+        ret[name] = write_json(out_dir / name, get_client_config(device, config, server, mappings))
+    return ret
@@ -3,11 +3,11 @@ WireGuard Functions
 """
 import re
 import typing
-from subprocess import run
 from configparser import ConfigParser
 
 from .logger import Logger
 from .storage import get_parser_from_config
+from .profiling import run_subprocess
 from .errors import ConfigParseError, WireguardConfError
 
 RESERVED_KEYS = set()
@@ -24,7 +24,7 @@ def gen_private_key(wg_path: typing.Optional[str] = None) -> str:
         if not wg_path:
             raise ConfigParseError("Can not get `WireGuard.path` from config.")
     # key gen command
-    r = run([wg_path, "gen""key"], capture_output=True)
+    r = run_subprocess([wg_path, "gen""key"], capture_output=True)
     return r.stdout.decode(encoding="ascii")
 
 
@@ -38,7 +38,7 @@ def gen_public_key(private_key: str, wg_path: typing.Optional[str] = None) -> st
         if not wg_path:
             raise ConfigParseError("Can not get `WireGuard.path` from config.")
     # key gen command
-    r = run([wg_path, "pubkey"], capture_output=True, input=private_key.encode("ascii"))
+    r = run_subprocess([wg_path, "pubkey"], capture_output=True, input=private_key.encode("ascii"))
     if not r.stdout:
         raise WireguardConfError("Command returns an empty key, please check input private key.")
     return r.stdout.decode(encoding="ascii")
@@ -80,9 +80,34 @@ RE_IPS = re.compile(r"^([\d.:a-fA-F/])(:? *, *)?$")
 
 
 def get_peer_config(device: str, config: ConfigParser, interface_name: typing.Optional[str] = None,
-                    annotation: typing.Optional[str] = None) -> str:
+                    annotation: typing.Optional[str] = None, cache: typing.Optional[dict] = None) -> str:
     """
     get a peer config from wireguard_core config
+    :param cache: a dict to reuse the lines not depending on `interface_name` when rendering many configs,
+    valid while `config` is unchanged
+    """
+    parts = None if cache is None else cache.get((device, annotation))
+    if parts is None:
+        parts = _get_peer_parts(device, config, annotation)
+        if cache is not None:
+            cache[(device, annotation)] = parts
+    head, tail, staged = parts
+    # PresharedKey
+    psk = ""
+    if interface_name:
+        pk = config.get(device, f"pre-shared key[{interface_name}]", fallback=None)
+        if pk:
+            psk = f"\nPresharedKey = {pk}"
+    if staged:
+        return f"{head}{psk}{tail}\n{staged}{psk}"
+    return f"{head}{psk}{tail}"
+
+
+def _get_peer_parts(device: str, config: ConfigParser,
+                    annotation: typing.Optional[str] = None) -> tuple[str, str, str]:
+    """
+    The lines of a peer config before and after `PresharedKey`,
+    and the peer of the staged `next public key` without `PresharedKey`.
     """
     s = ["[Peer]"]
     # annotation
@@ -91,22 +116,22 @@ def get_peer_config(device: str, config: ConfigParser, interface_name: typing.Op
             annotation = f"# {annotation}"
         s.append(annotation)
     # PublicKey
-    public_key = config.get(device, "public key")
-    if public_key is None:
+    public_key = config.get(device, "public key", fallback=None)
+    if not public_key:
         # try to generate public key from private key
-        private_key = config.get(device, "private key")
+        private_key = config.get(device, "private key", fallback=None)
         if private_key is None:
             raise WireguardConfError(f"cannot get or generate the public key for `{device}`")
         # update information after generate
-        public_key = gen_public_key(private_key)
+        public_key = gen_public_key(private_key).strip()
         config.set(device, "public key", public_key)
         config.set(device, "public key is auto generated", "True")
     s.append(f"PublicKey = {public_key}")
     # AllowedIPs
-    allowed_ips = config.get(device, "allowed ips")
+    allowed_ips = config.get(device, "allowed ips", fallback=None)
     if not allowed_ips:
         # try to set it from address
-        allowed_ips = config.get(device, "address")
+        allowed_ips = config.get(device, "address", fallback=None)
         if not allowed_ips:
             raise WireguardConfError(f'cannot get `allowed ips` for "{device}"')
     # --- check ip
@@ -115,21 +140,23 @@ def get_peer_config(device: str, config: ConfigParser, interface_name: typing.Op
             raise WireguardConfError("please check ipaddress", ip)
     s.append(f"AllowedIPs = {allowed_ips}")
     # Endpoint
-    endpoint = config.get(device, "endpoint")
+    endpoint = config.get(device, "endpoint", fallback=None)
     if endpoint:
         s.append(f"Endpoint = {endpoint}")
-    # PresharedKey
-    if interface_name:
-        pk = config.get(device, f"pre-shared key[{interface_name}]")
-        if pk:
-            s.append("PresharedKey = {pk}")
     # PersistentKeepalive
-    pka = config.get(device, "persistent keep alive")
+    tail = ""
+    pka = config.get(device, "persistent keep alive", fallback=None)
     if pka:
         if not pka.isnumeric():
             raise WireguardConfError('value for "persistent keep alive" should numer-like, get', pka)
-        s.append(f"PersistentKeepalive = {pka}")
-    return "\n".join(s)
+        tail = f"\nPersistentKeepalive = {pka}"
+    # the next key of a staged key rotation, without AllowedIPs which must be unique among the peers,
+    # so it's only provisioned and carries no traffic until the cutover
+    staged = ""
+    next_public_key = config.get(device, "next public key", fallback=None)
+    if next_public_key:
+        staged = "[Peer]\n" + (f"{s[1]} (next key)\n" if annotation else "") + f"PublicKey = {next_public_key}"
+    return "\n".join(s), tail, staged
 
 
 def get_interface_config(device: str, config: ConfigParser, annotation: typing.Optional[str] = None) -> str:
@@ -148,12 +175,12 @@ def get_interface_config(device: str, config: ConfigParser, annotation: typing.O
         s.append(annotation)
 
     # PrivateKey
-    private_key = config.get(device, "private key")
-    if private_key is None:
-        raise WireguardConfError(f"private key not found")
+    private_key = config.get(device, "private key", fallback=None)
+    if not private_key:
+        raise WireguardConfError(f'private key not found for "{device}"')
     s.append(f"PrivateKey = {private_key}")
     # Address
-    address = config.get(device, "address")
+    address = config.get(device, "address", fallback=None)
     if not address:
         raise WireguardConfError(f'cannot get interface `address` for "{device}"')
     # --- check ip
@@ -162,48 +189,61 @@ def get_interface_config(device: str, config: ConfigParser, annotation: typing.O
             raise WireguardConfError("please check ipaddress", ip)
     s.append(f"address = {address}")
     # ListenPort
-    lp = config.get(device, "listen port")
+    lp = config.get(device, "listen port", fallback=None)
     if lp:
         if not lp.isnumeric():
             raise WireguardConfError('"ListenPort" should be numeric, get', lp)
         s.append(f"ListenPort = {lp}")
     # MTU
-    mtu = config.get(device, "listen port")
+    mtu = config.get(device, "mtu", fallback=None)
     if mtu:
         if not mtu.isnumeric():
             raise WireguardConfError('"MTU" should be numeric, get', mtu)
         s.append(f"MTU = {mtu}")
     # DNS
-    dns = config.get(device, "listen port")
+    dns = config.get(device, "dns", fallback=None)
     if dns:
         s.append(f"dns = {dns}")
     return "\n".join(s)
 
 
+def get_peer_devices(device: str, config: ConfigParser) -> list[str]:
+    """
+    The peers of `device`: the comma separated `peers` of the device if it's set, like the servers of a client,
+    or all other devices in the config order.
+    """
+    peers = config.get(device, "peers", fallback=None)
+    if peers:
+        return [i.strip() for i in peers.split(",") if i.strip()]
+    return [i for i in config.sections() if i not in RESERVED_KEYS and i != device]
+
+
 @logger.important_function()
-def get_config_for(device: str, config: ConfigParser, peer_devices=typing.Optional[list[str]]) -> str:
+def get_config_for(device: str, config: ConfigParser, peer_devices: typing.Optional[list[str]] = None,
+                   peer_cache: typing.Optional[dict] = None) -> str:
     """
     get the config for `name`
     :param device:
     :param config: config for wireguard
-    :param peer_devices:
+    :param peer_devices: the peers, `get_peer_devices` if None
+    :param peer_cache: see `get_peer_config`
     :return:
     """
     s = []
-    if device not in config.sections():
+    if not config.has_section(device):
         raise WireguardConfError(f"cannot get device named `{device}` from config")
     # Interface
     s.append(get_interface_config(device, config, annotation=device))
     # Peers
     if peer_devices is None:
-        peer_devices = set(config.sections()) - RESERVED_KEYS
-        peer_devices.remove(device)
+        peer_devices = get_peer_devices(device, config)
     for device_name in peer_devices:
-        s.append(get_peer_config(device_name, config, interface_name=device, annotation=device_name))
+        s.append(get_peer_config(device_name, config, interface_name=device, annotation=device_name,
+                                 cache=peer_cache))
     return "\n".join(s)
 
 
-def read_config(string: str):
+def read_config(string: str) -> ConfigParser:
     """
     read config from string
     A wireguard-manager config is like:
@@ -215,4 +255,81 @@ def read_config(string: str):
     ```
     :return:
     """
-    return ConfigParser(allow_no_value=True).read_string(string)
+    parser = ConfigParser(allow_no_value=True)
+    parser.read_string(string)
+    return parser
+
+
+INTERFACE_KEYWORDS_NAMES = [("PrivateKey", "private key"),
+                            ("Address", "address"),
+                            ("ListenPort", "listen port"),
+                            ("MTU", "mtu"),
+                            ("DNS", "dns"),
+                            ("PostUp", "post up"),
+                            ("PostDown", "post down")]
+
+
+def parse_wg_quick(string: str) -> list[tuple[str, str | None, dict[str, str]]]:
+    """
+    Parse a wg-quick config, which may have many `[Peer]` sections (ConfigParser can't read it).
+    The first comment line of a section is taken as its name, like the annotation written by `get_config_for`.
+    :return: [(section, name, {key: value})]
+    """
+    sections = []
+    for line in string.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("[") and line.endswith("]"):
+            sections.append((line[1:-1].strip(), None, {}))
+        elif line.startswith("#"):
+            if sections and sections[-1][1] is None and not sections[-1][2]:
+                section, _, values = sections.pop()
+                sections.append((section, line.lstrip("#").strip() or None, values))
+        elif "=" in line and sections:
+            key, _, value = line.partition("=")
+            sections[-1][2][key.strip().lower()] = value.strip()
+        else:
+            raise WireguardConfError("cannot parse the wg-quick config line", line)
+    return sections
+
+
+def import_wg_quick(device: str, string: str, config: ConfigParser) -> list[str]:
+    """
+    Import a wg-quick config of `device` into `config`.
+    A peer is matched to a device by its public key or name, unknown peers are added as new devices.
+    Values already in `config` are kept.
+    :return: the changed devices
+    """
+    interface_names = {k.lower(): v for k, v in INTERFACE_KEYWORDS_NAMES}
+    peer_names = {k.lower(): v for k, v in PEER_KEYWORDS_NAMES}
+    by_public_key = {config.get(i, "public key", fallback=""): i for i in config.sections()}
+    changed = []
+
+    def update(section: str, values: dict[str, str]):
+        if not config.has_section(section):
+            config.add_section(section)
+        updated = False
+        for key, value in values.items():
+            if not config.get(section, key, fallback=None):
+                config.set(section, key, value)
+                updated = True
+        if updated and section not in changed:
+            changed.append(section)
+
+    for section, name, values in parse_wg_quick(string):
+        if section.lower() == "interface":
+            update(device, {interface_names[k]: v for k, v in values.items() if k in interface_names})
+        elif section.lower() == "peer":
+            public_key = values.get("publickey")
+            if not public_key:
+                raise WireguardConfError(f'a peer without `PublicKey` in the config of "{device}"')
+            peer = by_public_key.get(public_key) or name or f"peer-{public_key[:8]}"
+            peer_values = {peer_names[k]: v for k, v in values.items() if k in peer_names}
+            if "presharedkey" in values:
+                peer_values[f"pre-shared key[{device}]"] = values["presharedkey"]
+            update(peer, peer_values)
+            by_public_key[public_key] = peer
+        else:
+            raise WireguardConfError(f"unknown section `{section}` in the config of \"{device}\"")
+    return changed